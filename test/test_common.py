@@ -1,3 +1,4 @@
+import time
 from unittest.mock import mock_open, patch
 
 import pytest
@@ -23,3 +24,39 @@ class Testyamlfile:
                     "some_yaml_file.yml"
                 )
                 assert yaml == {"bla": {"foo": 2}}
+
+    def test_read_file_ignores_free_form_comments(self, tmp_path):
+        path = tmp_path / "state.yaml"
+        vula.common.yamlfile({'a': 1}).write_yaml_file(
+            str(path), header=dict(journal_seq=7)
+        )
+        path.write_text(
+            "# edited by hand\n#no space\n# note: [unbalanced\n"
+            + path.read_text()
+        )
+        data, header, fmt = vula.common.yamlfile.read_file(str(path))
+        assert (data, header, fmt) == ({'a': 1}, {'journal_seq': 7}, 'yaml')
+
+
+class TestFlusher:
+    def test_failed_flush_is_retried(self):
+        calls = []
+
+        def flush():
+            calls.append(time.monotonic())
+            if len(calls) == 1:
+                raise OSError(28, "No space left on device")
+
+        flusher = vula.common.Flusher(flush, max_delay=0)
+        flusher.max_retry_delay = 0.05
+        flusher.mark_dirty()
+        deadline = time.monotonic() + 5
+        while len(calls) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        flusher.stop()
+
+        assert len(calls) == 2
+        assert calls[1] - calls[0] >= 0.05
+        stats = flusher.metrics.snapshot()
+        assert stats['errors'] == 1
+        assert stats['flushes'] == 1
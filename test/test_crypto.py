@@ -1,5 +1,9 @@
+import os
+import tempfile
 from unittest import TestCase, main
 
+from vula.csidh import _TabledCSIDH, csidh_parameters, make_csidh
+
 
 class TestX25519(TestCase):
 
@@ -17,5 +21,18 @@ class TestX25519(TestCase):
         )
 
 
+class TestCsidhTables(TestCase):
+    def test_cached_tables(self):
+        tables_file = os.path.join(tempfile.mkdtemp(), 'csidh.json')
+        computed = make_csidh(csidh_parameters, tables_file)
+        cached = make_csidh(csidh_parameters, tables_file)
+        self.assertIsInstance(cached, _TabledCSIDH)
+        for table in ('L_out', 'R_out', 'S_out', 'r_out'):
+            self.assertEqual(
+                getattr(cached.gae, table), getattr(computed.gae, table)
+            )
+        self.assertEqual(cached.p_bytes, computed.p_bytes)
+
+
 if __name__ == '__main__':
     main()
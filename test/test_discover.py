@@ -1,4 +1,6 @@
-from unittest.mock import MagicMock
+from collections import deque
+from ipaddress import ip_address, ip_network
+from unittest.mock import MagicMock, patch
 
 import vula.discover
 
@@ -70,6 +72,29 @@ class TestWireGuardServiceListener:
 
         listener.add_service.assert_called_once_with(m, "bar", "foo")
 
+    def test_add_service_deduplicates_in_flight_names(self):
+        callback = MagicMock()
+        zeroconf = MagicMock()
+        zeroconf.get_service_info().properties = {b'foo': b'bar'}
+        executor = MagicMock()
+        listener = vula.discover.WireGuardServiceListener(
+            callback, executor=executor
+        )
+
+        with patch('vula.discover.Descriptor'):
+            for _ in range(3):
+                listener.update_service(zeroconf, "test_type", "test_name")
+            executor.submit.assert_called_once()
+            # updates while it is being resolved cause one more lookup
+            fn, *args = executor.submit.call_args.args
+            fn(*args)
+
+        assert callback.call_count == 2
+        stats = listener.metrics.snapshot()
+        assert stats['deduplicated'] == 2
+        assert stats['resolve_latency']['count'] == 2
+        assert listener._in_flight == {}
+
 
 def alive_mock(x):
     m = MagicMock()
@@ -77,70 +102,181 @@ def alive_mock(x):
     return m
 
 
+def _desc(vk, vf=1, pk='pk', addrs='10.0.0.2', hostname='a.local.'):
+    desc = MagicMock(
+        vk=vk,
+        vf=vf,
+        s=bytes([vf]),
+        pk=pk,
+        addrs=[ip_address(addrs)],
+        hostname=hostname,
+    )
+    desc.__str__.return_value = vk
+    return desc
+
+
 class TestDiscover:
     def test_callback_calls_all(self):
         a = MagicMock()
         b = MagicMock()
         c = MagicMock()
 
+        descriptor = MagicMock()
+
         discover = vula.discover.Discover()
         discover.callbacks = [a, b, c]
 
-        discover.callback("foo")
+        discover.callback(descriptor)
+
+        a.assert_called_once_with(descriptor)
+        b.assert_called_once_with(descriptor)
+        c.assert_called_once_with(descriptor)
+
+    @patch('vula.discover.GLib')
+    def test_enqueue_emits_batches_and_drops_oldest(self, glib):
+        discover = vula.discover.Discover()
+        discover.queue = deque(maxlen=5)
+        discover.batch_size = 2
+        emitted = []
+        discover.Descriptors.connect(emitted.append)
+
+        for i in range(7):
+            discover.enqueue(_desc(str(i)))
+        glib.idle_add.assert_called_once_with(discover._emit)
+        while discover._emit():
+            pass
+
+        assert emitted == [['2', '3'], ['4', '5'], ['6']]
+        assert discover.metrics.snapshot()['dropped'] == 2
+        # only the emitted descriptors are remembered as forwarded
+        assert sorted(discover.forwarded) == ['2', '3', '4', '5', '6']
+        discover.enqueue(_desc('7'))
+        assert glib.idle_add.call_count == 2
+
+    def test_callback_suppresses_filtered_and_repeats(self):
+        callback = MagicMock()
+        discover = vula.discover.Discover()
+        discover.callbacks = [callback]
+        with patch('vula.discover._local_networks', dict.fromkeys):
+            discover.listen(
+                [],
+                dict(
+                    pk=['ourpk'], subnets=['10.0.0.0/24'], domains=['local.']
+                ),
+            )
+
+        for d in (
+            _desc('a'),
+            _desc('a'),
+            _desc('a', vf=2),
+            _desc('b', pk='ourpk'),
+            _desc('c', addrs='10.0.1.2'),
+            _desc('d', hostname='d.example.'),
+        ):
+            discover.callback(d)
+
+        assert [c.args[0].vk for c in callback.call_args_list] == ['a', 'a']
+        stats = discover.metrics.snapshot()
+        assert [
+            stats['suppressed_' + reason]
+            for reason in ('repeat', 'own', 'subnet', 'domain')
+        ] == [1, 1, 1, 1]
+        assert 'suppressed' in discover.stats()
+
+    def test_repeats_are_forwarded_again_later(self):
+        callback = MagicMock()
+        discover = vula.discover.Discover()
+        discover.callbacks = [callback]
+        filters = dict(subnets=['10.0.0.0/24'])
+        with patch('vula.discover._local_networks', dict.fromkeys):
+            discover.listen([], filters)
+
+            discover.callback(_desc('a'))
+            discover.callback(_desc('a'))
+            assert callback.call_count == 1
+
+            # eg, organize has removed the peer since, and the filters are
+            # unchanged: it is forwarded again once forwarded_ttl has passed
+            discover.forwarded_ttl = 0
+            discover.callback(_desc('a'))
+            assert callback.call_count == 2
+
+            # and whenever the IPs or the filters change
+            discover.forwarded_ttl = 300
+            discover.listen([], filters)
+            discover.callback(_desc('a'))
+            assert callback.call_count == 2
+            discover.listen([], dict(filters, domains=['local.']))
+            discover.callback(_desc('a'))
+            assert callback.call_count == 3
+
+    def test_callback_drops_other_networks(self):
+        callback = MagicMock()
+        discover = vula.discover.Discover()
+        discover.callbacks = [callback]
+        discover.networks = {'10.0.0.1': ip_network('10.0.0.0/24')}
+
+        discover.callback(MagicMock(addrs=[ip_address('10.0.1.2')]))
+        callback.assert_not_called()
+        discover.callback(MagicMock(addrs=[ip_address('10.0.0.2')]))
+        callback.assert_called_once()
+
+    @patch('vula.discover._local_networks', dict.fromkeys)
+    @patch('vula.discover.ServiceBrowser')
+    @patch('vula.discover.Zeroconf')
+    def test_listen_shares_one_zeroconf(self, zeroconf, browser):
+        zeroconf.side_effect = lambda **kw: MagicMock()
+        discover = vula.discover.Discover()
+
+        discover.listen(['10.0.0.1', 'fe80::1'])
+        zeroconf.assert_called_once_with(interfaces=['10.0.0.1', 'fe80::1'])
+        browser.assert_called_once()
+        first = discover.zeroconfs[('10.0.0.1', 'fe80::1')][0]
+
+        # removing an IP does not replace the instance
+        discover.listen(['10.0.0.1'])
+        assert zeroconf.call_count == 1
+        assert list(discover.networks) == ['10.0.0.1']
 
-        a.assert_called_once_with("foo")
-        b.assert_called_once_with("foo")
-        c.assert_called_once_with("foo")
+        # adding one starts an instance for it, and keeps the running one
+        discover.listen(['10.0.0.1', '10.0.1.1'])
+        assert zeroconf.call_args_list[1].kwargs == dict(
+            interfaces=['10.0.1.1']
+        )
+        first.close.assert_not_called()
+        assert discover.interfaces == ('10.0.0.1', 'fe80::1', '10.0.1.1')
+
+        # an instance is closed when none of its IPs are listened on
+        discover.listen(['10.0.1.1'])
+        first.close.assert_called_once()
+        assert discover.interfaces == ('10.0.1.1',)
+
+        discover.listen([])
+        assert discover.zeroconfs == {} and discover.interfaces == ()
 
     def test_is_not_alive(self):
         discover = vula.discover.Discover()
-        discover.browsers = {
-            '192.168.1.1': alive_mock(False),
-            '192.168.1.2': alive_mock(False),
-            '192.168.1.3': alive_mock(False),
-        }
+        assert discover.is_alive() is False
+        discover.zeroconfs[('10.0.0.1',)] = MagicMock(), alive_mock(False)
 
         alive = discover.is_alive()
-        print(alive)
         assert alive is False
 
     def test_is_alive(self):
         discover = vula.discover.Discover()
-        discover.browsers = {
-            '192.168.1.1': alive_mock(False),
-            '192.168.1.2': alive_mock(False),
-            '192.168.1.3': alive_mock(True),
-            '192.168.1.4': alive_mock(False),
-        }
+        discover.zeroconfs[('10.0.0.1',)] = MagicMock(), alive_mock(True)
 
         alive = discover.is_alive()
         assert alive is True
 
-    def test_shutdown_removes_browsers(self):
-        discover = vula.discover.Discover()
-        discover.browsers = {
-            '192.168.1.1': MagicMock(),
-            '192.168.1.2': MagicMock(),
-            '192.168.1.3': MagicMock(),
-        }
-
-        discover.shutdown()
-
-        assert discover.browsers == {}
-
-    def test_shutdown_cancels_browsers(self):
-        browser1 = MagicMock()
-        browser2 = MagicMock()
-        browser3 = MagicMock()
+    def test_shutdown_cancels_browser(self):
+        browser = MagicMock()
+        zeroconf = MagicMock()
         discover = vula.discover.Discover()
-        discover.browsers = {
-            '192.168.1.1': browser1,
-            '192.168.1.2': browser2,
-            '192.168.1.3': browser3,
-        }
+        discover.zeroconfs[('10.0.0.1',)] = zeroconf, browser
 
         discover.shutdown()
 
-        browser1.cancel.assert_called_once()
-        browser2.cancel.assert_called_once()
-        browser3.cancel.assert_called_once()
+        browser.cancel.assert_called_once()
+        zeroconf.close.assert_called_once()
+        assert discover.zeroconfs == {}
@@ -1,6 +1,10 @@
+import copy
+import os
+import tempfile
 import unittest
 import schema
 
+from vula.journal import Journal
 from vula.organize import OrganizeState, SystemState
 from vula.common import raw
 
@@ -389,6 +393,232 @@ class TestOrganizeEngine(unittest.TestCase):
                 res.error.args[0], 'conflicting peers: ' + mkk('alicevk')
             )
 
+    def test_writes_do_not_modify_committed_state(self):
+        self._add_alice_ok()
+        self._add_bob_maybe()
+        before = self.state._dict()
+        expected = copy.deepcopy(before)
+        vk = mkk('alicevk')
+        for op, path, value in (
+            ('SET', ['peers', vk, 'petname'], 'carol'),
+            ('ADD', ['peers', vk, 'nicknames'], 'carol.local'),
+            ('REMOVE', ['peers', vk, 'nicknames'], 'alice.local'),
+            ('ADD', 'prefs.local_domains', 'example'),
+        ):
+            self._assert_res_no_error(
+                self.state.event_USER_EDIT(op, path, value)
+            )
+        self.assertEqual(before, expected)
+        self.assertEqual(self.state.peers[vk].nicknames, {'carol.local': True})
+
+    def test_incremental_validation(self):
+        self.state.validation = 'check'
+        self._add_alice_ok()
+        alice = self.state.peers[mkk('alicevk')]
+        self._proc_desc(
+            hostname='carol.local', vk=mkk('carolvk'), addrs='10.0.0.3'
+        )
+        self.assertIs(self.state.peers[mkk('alicevk')], alice)
+        self._assert_res_actions(
+            self._add_bob_maybe(addrs='10.0.0.1', pk=mkk('alicepk')),
+            ['REMOVE_PEER', 'ACCEPT_NEW_PEER'],
+        )
+        res = self.state.event_USER_EDIT(
+            'SET', ['peers', mkk('bobvk'), 'petname'], 'carol.local'
+        )
+        self.assertFalse(res.ok)
+        self._assert_res_no_error(
+            self.state.event_USER_EDIT(
+                'SET', ['peers', mkk('bobvk'), 'petname'], 'bob'
+            )
+        )
+
+    def test_edit_triggers(self):
+        self._add_alice_ok()
+        vk = mkk('alicevk')
+        res = self._assert_res_no_error(
+            self.state.event_USER_PEER_ADDR_ADD(vk, '10.0.0.5')
+        )
+        self.assertEqual(res.triggers, [('sync_peer', (vk,))])
+        res = self._assert_res_no_error(
+            self.state.event_USER_EDIT(
+                'SET', ['peers', vk, 'IPv4addrs', '10.0.0.5'], False
+            )
+        )
+        self.assertEqual(
+            res.triggers,
+            [
+                ('remove_routes', (('10.0.0.5/32',),)),
+                ('sync_peer', (vk,)),
+            ],
+        )
+        res = self._assert_res_no_error(
+            self.state.event_USER_EDIT('REMOVE', ['peers'], vk)
+        )
+        self.assertEqual(
+            res.triggers,
+            [
+                ('remove_wg_peer', (mkk('alicepk'),)),
+                ('remove_routes', (('10.0.0.1/32',),)),
+            ],
+        )
+
+    def test_journal(self):
+        journal = Journal(os.path.join(tempfile.mkdtemp(), 'journal'))
+        self.state.journal = journal
+        self._assert_res_no_error(
+            self.state.event_USER_EDIT('SET', 'prefs.record_events', True)
+        )
+        self._add_alice_ok()
+        self._add_bob_maybe()
+        journal.flush()
+        self.assertEqual(self.state.event_log, [])
+        self.assertEqual(
+            [e['event'] for e in journal.read(kind='result')],
+            ['USER_EDIT', 'INCOMING_DESCRIPTOR', 'INCOMING_DESCRIPTOR'],
+        )
+        vk = mkk('bobvk')
+        entries = list(journal.read(peers=vk))
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['result']['event'][1]['vk'], vk)
+        journal.close()
+
+    def test_synced_commit_waits_outside_the_lock(self):
+        journal = Journal(os.path.join(tempfile.mkdtemp(), 'journal'))
+        append_durable = journal.append_durable
+        waited = []
+
+        def _append_durable(**fields):
+            wait = append_durable(**fields)
+
+            def _wait():
+                waited.append(self.state._lock.locked())
+                wait()
+
+            return _wait
+
+        journal.append_durable = _append_durable
+        self.state.journal = journal
+        self.state.sync_commits = True
+        self._add_alice_ok()
+        self.assertEqual(waited, [False])
+        self.assertEqual(
+            [e['seq'] for e in journal.read()], [self.state.journal_seq]
+        )
+        journal.close()
+
+    def test_synced_commit_write_error(self):
+        journal = Journal(os.path.join(tempfile.mkdtemp(), 'journal'))
+
+        def _write(t, fields):
+            raise OSError("disk full")
+
+        journal._write = _write
+        with self.assertRaises(OSError):
+            journal.append_synced(seq=1)
+        self.state.journal = journal
+        self.state.sync_commits = True
+        res = self.state.event_USER_EDIT('SET', 'prefs.pin_new_peers', True)
+        self.assertIsInstance(res.error, OSError)
+        # the state has been changed, but the change is not durable
+        self.assertTrue(self.state.prefs.pin_new_peers)
+        journal.close()
+
+    def test_replay(self):
+        journal = Journal(os.path.join(tempfile.mkdtemp(), 'journal'))
+        snapshot = copy.deepcopy(raw(self.state))
+        seq = self.state.journal_seq
+        self.state.journal = journal
+        self._add_alice_ok()
+        self._add_bob_maybe()
+        self._assert_res_no_error(
+            self.state.event_USER_PEER_ADDR_ADD(mkk('bobvk'), '10.0.0.3')
+        )
+        self._assert_res_no_error(
+            self.state.event_NEW_SYSTEM_STATE(
+                SystemState(current_subnets={'10.0.0.0/16': ['10.0.1.9']})
+            )
+        )
+        journal.flush()
+        self.assertEqual(self.state.journal_seq, seq + 4)
+
+        state = OrganizeState(snapshot)
+        state.journal_seq = seq
+        results = list(state.replay(journal.tail('seq', seq)))
+        self.assertEqual([res.ok for res in results], [True] * 4)
+        self.assertEqual(raw(state), raw(self.state))
+        self.assertEqual(state.journal_seq, self.state.journal_seq)
+        journal.close()
+
+    def test_incoming_descriptors(self):
+        journal = Journal(os.path.join(tempfile.mkdtemp(), 'journal'))
+        snapshot = copy.deepcopy(raw(self.state))
+        seq = self.state.journal_seq
+        self.state.journal = journal
+        descriptors = [
+            desc(
+                hostname='alice.local',
+                vk=mkk('alicevk'),
+                pk=mkk('alicepk'),
+                addrs='10.0.0.1',
+            ),
+            # bob sees alice's peer, and replaces it
+            desc(hostname='bob.local', vk=mkk('bobvk'), addrs='10.0.0.1'),
+            desc(hostname='bob.local', vk=mkk('bobvk'), addrs='10.0.0.3'),
+            desc(
+                hostname='bob.local', vk=mkk('bobvk'), addrs='10.0.0.1', vf=1
+            ),
+            desc(
+                hostname='carol.example', vk=mkk('carolvk'), addrs='10.0.0.4'
+            ),
+        ]
+        res = self._assert_res_actions(
+            self.state.event_INCOMING_DESCRIPTORS(descriptors),
+            [
+                'ACCEPT_NEW_PEER',
+                'REMOVE_PEER',
+                'ACCEPT_NEW_PEER',
+                'IGNORE',
+                'UPDATE_PEER_DESCRIPTOR',
+                'REJECT',
+            ],
+        )
+        self.assertEqual(
+            list(self.state.descriptor_results(res)),
+            [
+                ('accepted', None),
+                ('accepted', None),
+                ('ignored', 'replay'),
+                ('updated', None),
+                ('rejected', 'invalid domain'),
+            ],
+        )
+        # alice's peer, which bob's replaced, is not synced, and bob's peer
+        # is only synced once, after both of its changes
+        self.assertEqual(
+            [name for name, args in res.triggers],
+            ['remove_wg_peer', 'remove_routes', 'sync_peer'],
+        )
+        self.assertEqual(
+            res.triggers[0], ('remove_wg_peer', (mkk('alicepk'),))
+        )
+        self.assertEqual(res.triggers[-1], ('sync_peer', (mkk('bobvk'),)))
+        batch = raw(self.state)
+
+        # the same as processing the descriptors one at a time
+        self.state = OrganizeState(copy.deepcopy(snapshot))
+        for descriptor in descriptors:
+            self.state.event_INCOMING_DESCRIPTOR(descriptor)
+        self.assertEqual(raw(self.state), batch)
+
+        journal.flush()
+        state = OrganizeState(snapshot)
+        state.journal_seq = seq
+        results = list(state.replay(journal.tail('seq', seq)))
+        self.assertEqual([r.ok for r in results], [True])
+        self.assertEqual(raw(state), batch)
+        journal.close()
+
 
 if __name__ == '__main__':
     unittest.main()
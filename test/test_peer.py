@@ -1,10 +1,12 @@
+import json
+import time
 import unittest
 import schema
 from ipaddress import IPv6Address, IPv4Address
 from base64 import b64encode, b64decode
 
 from vula.common import yamlrepr
-from vula.peer import Descriptor
+from vula.peer import Descriptor, Peer, show_summary
 
 
 def desc(vk, addrs, hostname, **kw):
@@ -131,6 +133,41 @@ class TestPeerShow(unittest.TestCase):
     """
 
 
+class TestPeerSummary(unittest.TestCase):
+    def test_summary_json_roundtrip(self):
+        peer = desc(
+            hostname='alice.local',
+            vk=mkk('Alice'),
+            vf=int(time.time()),
+            addrs='10.0.0.1',
+        ).make_peer(pinned=True, _allow_unsigned_descriptor=True)
+        stats = dict(rx_bytes=1, tx_bytes=2, latest_handshake=0)
+        summary = json.loads(json.dumps(peer.summary(stats)))
+        self.assertEqual(summary['allowed_ips'], ['10.0.0.1/32'])
+        self.assertEqual(summary['stats'], stats)
+        self.assertEqual(
+            (summary['enabled'], summary['pinned'], summary['verified']),
+            (True, True, False),
+        )
+        self.assertEqual(show_summary(summary), peer.show(stats))
+        self.assertIsNone(peer.summary()['stats'])
+
+    def test_summary_fields(self):
+        peer = desc(
+            hostname='alice.local',
+            vk=mkk('Alice'),
+            vf=int(time.time()),
+            addrs='10.0.0.1',
+        ).make_peer(_allow_unsigned_descriptor=True)
+        self.assertEqual(list(peer.summary()), list(Peer.summary_fields))
+        self.assertEqual(
+            peer.summary(fields=['id', 'enabled']),
+            dict(id=peer.id, enabled=True),
+        )
+        with self.assertRaises(KeyError):
+            peer.summary(fields=['nope'])
+
+
 # fmt: off
 class TestDescriptor_qrcode(unittest.TestCase):
     """
@@ -0,0 +1,42 @@
+from unittest.mock import MagicMock, patch
+
+from vula.publish import Publish
+
+
+def _desc(addrs, vf='1'):
+    return dict(addrs=addrs, port='5354', hostname='alice.local.', vf=vf)
+
+
+class TestPublish:
+    def test_listen_announces_each_network_on_its_own_ips(self):
+        with patch("vula.publish.Zeroconf") as mock_zeroconf:
+            mock_zeroconf.side_effect = lambda **kw: MagicMock()
+            publish = Publish()
+            a, b = _desc('10.0.0.2,10.0.0.3'), _desc('192.168.1.2')
+            publish.listen({'10.0.0.2': a, '10.0.0.3': a, '192.168.1.2': b})
+
+            interfaces = [
+                call.kwargs['interfaces']
+                for call in mock_zeroconf.call_args_list
+            ]
+            assert interfaces == [['10.0.0.2', '10.0.0.3'], ['192.168.1.2']]
+            for ips, service_info in publish.services.items():
+                assert service_info.properties == {
+                    k.encode(): v.encode()
+                    for k, v in (a if '10.0.0.2' in ips else b).items()
+                }
+
+            # a new descriptor for one network updates only its instance
+            zeroconf_a = publish.zeroconfs[('10.0.0.2', '10.0.0.3')]
+            zeroconf_b = publish.zeroconfs[('192.168.1.2',)]
+            b2 = _desc('192.168.1.2', vf='2')
+            publish.listen({'10.0.0.2': a, '10.0.0.3': a, '192.168.1.2': b2})
+            assert mock_zeroconf.call_count == 2
+            zeroconf_a.update_service.assert_not_called()
+            zeroconf_b.update_service.assert_called_once()
+
+            # a network which is no longer announced is closed
+            publish.listen({'192.168.1.2': b2})
+            zeroconf_a.close.assert_called_once()
+            zeroconf_b.close.assert_not_called()
+            assert list(publish.zeroconfs) == [('192.168.1.2',)]
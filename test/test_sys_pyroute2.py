@@ -1,7 +1,13 @@
+import threading
 import time
+from base64 import b64encode
+from ipaddress import ip_address, ip_network
 from unittest.mock import MagicMock, patch
 
+from pyroute2.netlink.generic.wireguard import AsyncWireGuard
+
 import vula.sys_pyroute2
+from vula.prefs import Prefs
 
 
 class TestSys:
@@ -25,6 +31,28 @@ class TestSys:
             )
             mock_ipr.return_value.close.assert_called_once()
 
+    def test_start_monitor_subscribes_before_returning(self):
+        mock_organize = MagicMock()
+        with patch("vula.sys_pyroute2.IPRSocket") as mock_ipr, patch(
+            "vula.sys_pyroute2.WgInterface"
+        ):
+            release = threading.Event()
+
+            def get():
+                release.wait()
+                return [{"event": "NON_EXISTING"}]
+
+            mock_ipr.return_value.get.side_effect = get
+            sys = vula.sys_pyroute2.Sys(mock_organize)
+
+            sys.start_monitor()
+            # the socket is bound before the monitor thread gets a message
+            mock_ipr.return_value.bind.assert_called_once()
+            thread = sys._monitor_thread
+            sys.stop_monitor()
+            release.set()
+            thread.join()
+
     def test_monitor_newneigh(self):
         mock_organize = MagicMock()
         with patch("vula.sys_pyroute2.IPRSocket") as mock_ipr, patch(
@@ -37,7 +65,7 @@ class TestSys:
             sys.get_new_system_state = MagicMock()
             sys._stop_monitor = True
 
-            sys._monitor()
+            sys._monitor(mock_ipr.return_value)
 
             sys.get_new_system_state.assert_not_called()
 
@@ -51,7 +79,7 @@ class TestSys:
             sys.get_new_system_state = MagicMock()
             sys._stop_monitor = True
 
-            sys._monitor()
+            sys._monitor(mock_ipr.return_value)
 
             sys.get_new_system_state.assert_called_once()
 
@@ -68,7 +96,226 @@ class TestSys:
             sys.get_new_system_state = MagicMock()
             sys._stop_monitor = True
 
-            sys._monitor()
+            sys._monitor(mock_ipr.return_value)
 
             sys.get_new_system_state.assert_not_called()
             assert mock_organize.log.info.call_count == 2
+
+    def test_netlink_events_coalesced(self):
+        mock_organize = MagicMock()
+        with patch("vula.sys_pyroute2.WgInterface"):
+            sys = vula.sys_pyroute2.Sys(mock_organize)
+            sys.get_new_system_state = MagicMock()
+            sys.netlink_window = 10
+
+            for _ in range(3):
+                sys._netlink_event()
+            sys.get_new_system_state.assert_not_called()
+
+            sys._flush_netlink_events()
+            sys._flush_netlink_events()
+
+            sys.get_new_system_state.assert_called_once()
+            stats = sys.metrics.snapshot()
+            assert stats['netlink_events'] == 3
+            assert stats['netlink_events_processed'] == 1
+
+    def test_netlink_max_latency(self):
+        mock_organize = MagicMock()
+        with patch("vula.sys_pyroute2.WgInterface"):
+            sys = vula.sys_pyroute2.Sys(mock_organize)
+            sys.get_new_system_state = MagicMock()
+            sys.netlink_window = 10
+            sys.netlink_max_latency = 0
+
+            sys._netlink_event()
+            time.sleep(0.1)
+
+            sys.get_new_system_state.assert_called_once()
+
+    def test_netlink_burst_uses_one_thread(self):
+        mock_organize = MagicMock()
+        with patch("vula.sys_pyroute2.WgInterface"):
+            sys = vula.sys_pyroute2.Sys(mock_organize)
+            sys.get_new_system_state = MagicMock()
+            sys.netlink_window = 0.05
+
+            before = threading.active_count()
+            for _ in range(100):
+                sys._netlink_event()
+            assert threading.active_count() == before + 1
+            time.sleep(0.2)
+
+            sys.get_new_system_state.assert_called_once()
+            sys._netlink_event()
+            time.sleep(0.2)
+            assert sys.get_new_system_state.call_count == 2
+            assert threading.active_count() == before + 1
+
+    def test_system_state_model(self):
+        mock_organize = MagicMock()
+        mock_organize.prefs = Prefs()
+        with patch("vula.sys_pyroute2.WgInterface"):
+            sys = vula.sys_pyroute2.Sys(mock_organize)
+            sys.ipr = MagicMock()
+            sys.ipr.get_addr.return_value = [
+                {
+                    'index': 2,
+                    'prefixlen': 24,
+                    'attrs': [
+                        ('IFA_ADDRESS', '10.0.0.2'),
+                        ('IFA_LABEL', 'eth0'),
+                    ],
+                }
+            ]
+            route = {
+                'family': 2,
+                'table': 254,
+                'dst_len': 0,
+                'attrs': [('RTA_GATEWAY', '10.0.0.1'), ('RTA_OIF', 2)],
+            }
+            sys.ipr.get_routes.return_value = [route]
+            sys._monitor_thread = MagicMock()
+
+            assert sys._get_system_state() == (
+                {ip_network('10.0.0.0/24'): [ip_address('10.0.0.2')]},
+                ['10.0.0.1'],
+            )
+
+            sys._apply_netlink_message(dict(route, event='RTM_DELROUTE'))
+            sys._apply_netlink_message(
+                {
+                    'event': 'RTM_NEWADDR',
+                    'index': 3,
+                    'prefixlen': 16,
+                    'attrs': [
+                        ('IFA_ADDRESS', '192.168.1.2'),
+                        ('IFA_LABEL', 'wlan0'),
+                    ],
+                }
+            )
+
+            assert sys._get_system_state() == (
+                {
+                    ip_network('10.0.0.0/24'): [ip_address('10.0.0.2')],
+                    ip_network('192.168.0.0/16'): [ip_address('192.168.1.2')],
+                },
+                [],
+            )
+            sys.ipr.get_addr.assert_called_once()
+
+            sys._apply_netlink_message({'event': 'RTM_NEWADDR'})
+            sys._get_system_state()
+            assert sys.ipr.get_addr.call_count == 2
+
+            sys._apply_netlink_message(dict(route, event='RTM_NEWROUTE'))
+            assert sys._get_system_state()[1] == ['10.0.0.1']
+            # the kernel drops a downed link's routes without RTM_DELROUTE
+            sys.ipr.get_routes.return_value = []
+            sys._apply_netlink_message({'event': 'RTM_NEWLINK', 'index': 2})
+            assert sys._get_system_state()[1] == []
+            assert sys.ipr.get_addr.call_count == 3
+
+    def test_resync_replays_concurrent_deltas(self):
+        mock_organize = MagicMock()
+        mock_organize.prefs = Prefs()
+        addr = {
+            'index': 2,
+            'prefixlen': 24,
+            'attrs': [('IFA_ADDRESS', '10.0.0.2'), ('IFA_LABEL', 'eth0')],
+        }
+        with patch("vula.sys_pyroute2.WgInterface"):
+            sys = vula.sys_pyroute2.Sys(mock_organize)
+            sys.ipr = MagicMock()
+            sys._monitor_thread = MagicMock()
+
+            def get_addr():
+                # the address is removed after the dump has been taken
+                sys._apply_netlink_message(dict(addr, event='RTM_DELADDR'))
+                return [addr]
+
+            sys.ipr.get_addr.side_effect = get_addr
+            sys.ipr.get_routes.return_value = []
+
+            assert sys._get_system_state() == ({}, [])
+            assert sys.metrics.snapshot()['resync_replayed_deltas'] == 1
+
+    def test_snapshot_sync_routes(self):
+        mock_organize = MagicMock()
+        mock_organize.state.system_state.current_subnets = {
+            ip_network('10.0.0.0/24'): [ip_address('10.0.0.9')]
+        }
+        routes = [
+            {
+                'dst_len': 32,
+                'scope': 253,
+                'attrs': [
+                    ('RTA_TABLE', 666),
+                    ('RTA_DST', '10.0.0.1'),
+                    ('RTA_OIF', 7),
+                ],
+            }
+        ]
+        dests = ['10.0.0.1/32', '10.0.0.2/32']
+        with patch("vula.sys_pyroute2.WgInterface"):
+            sys = vula.sys_pyroute2.Sys(mock_organize)
+            sys.ipr = MagicMock()
+            sys.ipr.get_routes.return_value = routes
+            sys.ipr.link_lookup.return_value = [7]
+            sys.ipr.route.side_effect = lambda cmd, dst, table, **kw: [
+                r for r in routes if dict(r['attrs'])['RTA_DST'] + '/32' == dst
+            ]
+            expected = sys.sync_routes(dests, 666, dryrun=True)
+            assert sys.ipr.route.call_count == 2
+
+            with sys.snapshot():
+                assert sys.sync_routes(dests, 666, dryrun=True) == expected
+                sys.sync_routes(dests, 666)
+                assert sys.sync_routes(dests, 666, dryrun=True) == ''
+
+            sys.ipr.get_routes.assert_called_once()
+            assert sys.ipr.route.call_count == 3  # just the one route add
+
+    def test_snapshots_in_other_threads_keep_their_peers(self):
+        mock_organize = MagicMock()
+        sys = vula.sys_pyroute2.Sys(mock_organize)
+        sys.ipr = MagicMock()
+        sys.ipr.get_routes.return_value = []
+        sys.wg = MagicMock()
+        sys.wg.info.side_effect = Exception("no such interface")
+        sys.wg.asyncore = AsyncWireGuard.__new__(AsyncWireGuard)
+        pk = b64encode(b'A' * 32).decode()
+        applied, queried = threading.Event(), threading.Event()
+        seen = []
+
+        def other():
+            applied.wait(5)
+            # a new (empty) dump, which must not replace the first thread's
+            with sys.snapshot():
+                seen.append(list(sys.wgi.peers))
+                queried.set()
+
+        thread = threading.Thread(target=other)
+        thread.start()
+        with sys.snapshot():
+            sys.wgi.apply_peerconfig(
+                dict(public_key=pk, allowed_ips=['10.0.0.1/32']),
+                refresh=False,
+            )
+            applied.set()
+            assert queried.wait(5)
+            assert [p['public_key'] for p in sys.wgi.peers] == [pk]
+        thread.join()
+        assert seen == [[]]
+
+    def test_netlink_calls_are_counted_per_thread(self):
+        with patch("vula.sys_pyroute2.IPRoute"):
+            sys = vula.sys_pyroute2.Sys(MagicMock())
+            sys.ipr.get_routes()
+            thread = threading.Thread(
+                target=lambda: [sys.ipr.get_addr() for _ in range(3)]
+            )
+            thread.start()
+            thread.join()
+            assert sys.netlink_calls == 1
+            assert sys.metrics.snapshot()['netlink_calls'] == 4
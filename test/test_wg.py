@@ -0,0 +1,66 @@
+from base64 import b64encode
+from unittest.mock import MagicMock, patch
+
+from pyroute2.netlink.generic.wireguard import AsyncWireGuard, wgmsg
+
+from vula.wg import Interface
+
+
+def _key(i):
+    return b64encode(bytes([i]) * 32).decode()
+
+
+class TestInterface:
+    def test_apply_peerconfigs(self):
+        wg = MagicMock()
+        wg.info.side_effect = Exception("no such interface")
+        # the real peer encoder, which does not use the socket
+        wg.asyncore = AsyncWireGuard.__new__(AsyncWireGuard)
+        wgi = Interface('vula', ipr=MagicMock(), wg=wg)
+        configs = [
+            dict(
+                public_key=_key(i),
+                endpoint_addr='10.0.0.%s' % (i,),
+                endpoint_port=5354,
+                allowed_ips=['10.0.0.%s/32' % (i,)],
+            )
+            for i in range(1, 6)
+        ]
+
+        dryrun = wgi.apply_peerconfigs([dict(c) for c in configs], True)
+        assert dryrun == [
+            wgi.apply_peerconfig(dict(c), True, refresh=False) for c in configs
+        ]
+        assert wg.nlm_request.call_count == 0
+
+        with patch("vula.wg._WG_SET_MAX_MESSAGE_SIZE", 300):
+            res = wgi.apply_peerconfigs([dict(c) for c in configs])
+        assert res == dryrun
+        # each message has room for two peers
+        assert wg.nlm_request.call_count == 3
+        sent = []
+        for call in wg.nlm_request.call_args_list:
+            msg = wgmsg(call.args[0].data)
+            msg.decode()
+            peers = msg.get_attr('WGDEVICE_A_PEERS')
+            sent += [p.get_attr('WGPEER_A_PUBLIC_KEY') for p in peers]
+        assert sent == [c['public_key'].encode() for c in configs]
+        assert [p['public_key'] for p in wgi.peers] == [
+            c['public_key'] for c in configs
+        ]
+
+        # the peers from the last query were updated, so nothing is resent
+        assert wgi.apply_peerconfigs(configs, refresh=False) == [''] * 5
+        assert wg.nlm_request.call_count == 3
+
+    def test_set_peers_without_pyroute2_internals(self):
+        # a pyroute2 without the internals which batching uses
+        wg = MagicMock(spec=['info', 'set'])
+        wg.info.side_effect = Exception("no such interface")
+        wgi = Interface('vula', ipr=MagicMock(), wg=wg)
+        peers = [
+            dict(public_key=_key(i), allowed_ips=['10.0.0.%s/32' % (i,)])
+            for i in range(1, 4)
+        ]
+        assert wgi.set_peers(peers) == 3
+        assert [call.kwargs['peer'] for call in wg.set.call_args_list] == peers
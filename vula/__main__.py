@@ -16,6 +16,7 @@ from . import (  # noqa: F40
     wg,
     engine,
     common,
+    bench,
 )
 
 from .notclick import Debuggable
@@ -137,6 +138,12 @@ def release_gateway():
     click.echo(common.organize_dbus_if_active().release_gateway())
 
 
+@main.command()
+def stats():
+    "Print organize's performance counters"
+    click.echo(common.organize_dbus_if_active().stats())
+
+
 for name, value in list(globals().items()):
     if name == 'wg':
         wg = wg.main
@@ -0,0 +1,215 @@
+"""
+*vula-bench* contains micro-benchmarks for measuring the performance of
+vula's components. They do not require root and do not touch the system's
+configuration.
+"""
+
+import os
+import tempfile
+import threading
+import time
+from base64 import b64encode
+
+import click
+from zeroconf import ServiceBrowser, ServiceListener, Zeroconf
+
+from .constants import _LABEL
+from .csidh import csidh_parameters, make_csidh
+from .discover import Discover
+from .peer import Descriptor
+from .organize import OrganizeState, SystemState
+
+
+def _key(kind, i, length=32):
+    """
+    Make a deterministic base64 key-shaped string.
+
+    >>> _key('pk', 1)
+    'cGsBAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA='
+    """
+    raw = kind.encode() + i.to_bytes(4, 'little')
+    return b64encode(raw.ljust(length, b'\0')).decode()
+
+
+def _descriptor(i, vf=0):
+    return Descriptor(
+        pk=_key('pk', i),
+        c=_key('c', i, 64),
+        vk=_key('vk', i),
+        s=_key('s', i, 64),
+        addrs='10.%s.%s.%s' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+        hostname='peer%s.local.' % (i,),
+        port=5354,
+        dt=86400,
+        vf=vf,
+        e=False,
+        r='',
+    )
+
+
+def _state(n):
+    """
+    Returns an OrganizeState with n peers, constructed directly rather than
+    through events so that setting up large states is not too slow.
+
+    >>> len(_state(3).peers)
+    3
+    """
+    return OrganizeState(
+        prefs=dict(local_domains=['local.']),
+        system_state=SystemState(current_subnets={'10.0.0.0/8': ['10.0.0.0']}),
+        peers={
+            str(d.vk): d.make_peer() for d in map(_descriptor, range(1, n + 1))
+        },
+    )
+
+
+def _time_events(fn, count):
+    start = time.perf_counter()
+    for i in range(count):
+        res = fn(i)
+        assert res.ok, res
+    return (time.perf_counter() - start) / count
+
+
+@click.group()
+def main():
+    """
+    Run micro-benchmarks
+    """
+
+
+@main.command()
+@click.option(
+    '-n',
+    '--peers',
+    type=int,
+    multiple=True,
+    default=(10, 100, 1000),
+    show_default=True,
+    help="Number of peers in the state (may be given multiple times)",
+)
+@click.option(
+    '-e',
+    '--events',
+    type=int,
+    default=20,
+    show_default=True,
+    help="Number of events of each type to time",
+)
+def engine(peers, events):
+    """
+    Time organize engine events as a function of the number of peers.
+
+    The per-event cost should not grow with the number of peers.
+    """
+    click.echo("%8s %24s %24s" % ("peers", "USER_EDIT", "INCOMING_DESCRIPTOR"))
+    for n in peers:
+        state = _state(n)
+        vk = _key('vk', 1)
+        edit = _time_events(
+            lambda i: state.event_USER_EDIT(
+                'SET', ['peers', vk, 'petname'], 'bench%s' % (i,)
+            ),
+            events,
+        )
+        update = _time_events(
+            lambda i: state.event_INCOMING_DESCRIPTOR(
+                _descriptor(1 + i % n, vf=1 + i)
+            ),
+            events,
+        )
+        click.echo("%8s %21.1f us %21.1f us" % (n, edit * 1e6, update * 1e6))
+
+
+@main.command()
+@click.option(
+    '-n',
+    '--dh',
+    type=int,
+    default=3,
+    show_default=True,
+    help="Number of dh operations to time",
+)
+def csidh(dh):
+    """
+    Time CSIDH initialization (with and without cached tables) and dh.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        tables_file = os.path.join(tmp, 'csidh.json')
+        for label in ('init (computing tables)', 'init (cached tables)'):
+            start = time.perf_counter()
+            instance = make_csidh(csidh_parameters, tables_file)
+            click.echo("%-28s %8.3f s" % (label, time.perf_counter() - start))
+    sk, pk = instance.keygen()
+    times = []
+    for _ in range(dh):
+        start = time.perf_counter()
+        instance.dh(sk, pk)
+        times.append(time.perf_counter() - start)
+    for i, seconds in enumerate(times):
+        click.echo("%-28s %8.3f s" % ("dh %s" % (i + 1,), seconds))
+
+
+def _threads_and_sockets():
+    "The numbers of threads and sockets this process has"
+    sockets = 0
+    for fd in os.listdir('/proc/self/fd'):
+        try:
+            sockets += os.readlink('/proc/self/fd/' + fd).startswith('socket:')
+        except OSError:
+            continue
+    return threading.active_count(), sockets
+
+
+@main.command()
+@click.option(
+    '-n',
+    '--ips',
+    type=int,
+    default=4,
+    show_default=True,
+    help="Number of (loopback) IPs to listen on",
+)
+def zeroconf(ips):
+    """
+    Count the threads and sockets used to listen for services on many IPs.
+
+    Compares one zeroconf instance and service browser per IP (as discover
+    used to have) with discover's shared instance, when the IPs are given at
+    once and when they are added one at a time.
+    """
+    addrs = ['127.0.0.%s' % (i,) for i in range(1, ips + 1)]
+    click.echo("%-32s %8s %8s" % ("", "threads", "sockets"))
+    base_threads, base_sockets = _threads_and_sockets()
+
+    def report(label):
+        threads, sockets = _threads_and_sockets()
+        click.echo(
+            "%-32s %8s %8s"
+            % (label, threads - base_threads, sockets - base_sockets)
+        )
+
+    instances = [Zeroconf(interfaces=[addr]) for addr in addrs]
+    browsers = [
+        ServiceBrowser(instance, _LABEL, ServiceListener())
+        for instance in instances
+    ]
+    report("one instance per IP")
+    for browser, instance in zip(browsers, instances):
+        browser.cancel()
+        instance.close()
+    discover = Discover()
+    discover.listen(addrs)
+    report("discover, IPs at once")
+    discover.shutdown()
+    for i in range(1, ips + 1):
+        discover.listen(addrs[:i])
+    report("discover, IPs one at a time")
+    discover.shutdown()
+    if discover.executor is not None:
+        discover.executor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
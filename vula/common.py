@@ -11,8 +11,12 @@ from base64 import b64decode, b64encode
 import yaml
 import json
 import copy
+import re
+from collections import OrderedDict
 from ipaddress import ip_address, ip_network
 from pathlib import Path
+from threading import Condition, Lock, Thread
+import time
 import pydbus
 import click
 from .notclick import DualUse, Exit  # noqa: F401
@@ -309,29 +313,170 @@ class schemadict(ro_dict, serializable):
             self._as_dict = super(schemadict, self)._dict()
         return self._as_dict
 
+    def _updated(self, changed, removed=()):
+        """
+        Returns a new object of the same type, with the items in changed added
+        or replaced and the keys in removed removed.
+
+        Only the changed items are validated, so this is only correct for
+        schemas which validate each item of the dictionary independently.
+
+        >>> class Ints(schemadict):
+        ...     schema = Schema({str: Use(int)})
+        >>> a = Ints(one='1', two='2')
+        >>> b = a._updated({'three': '3'}, removed=['one'])
+        >>> type(b).__name__, b, a
+        ('Ints', {'two': 2, 'three': 3}, {'one': 1, 'two': 2})
+        >>> a._updated({'four': 'four'})
+        Traceback (most recent call last):
+            ...
+        schema.SchemaError: ...
+        """
+        changed = self.schema.validate(dict(changed))
+        new = type(self).__new__(type(self))
+        dict.update(new, self)
+        dict.update(new, changed)
+        for key in removed:
+            dict.__delitem__(new, key)
+        new._as_dict = None
+        if self._as_dict is not None:
+            # keep the cached serialization too, so that it doesn't need to
+            # be recomputed from all of the items
+            new._as_dict = dict(self._as_dict)
+            new._as_dict.update(serializable._dict(changed))
+            for key in removed:
+                del new._as_dict[raw(key)]
+        return new
+
 
 class schemattrdict(attrdict, schemadict):
     pass
 
 
+# libyaml's C implementations are much faster than the pure python ones, so we
+# use them when PyYAML was built with them.
+_YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_YamlDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
 class yamlfile(serializable):
-    def write_yaml_file(self, path, mode=None, autochown=False):
+    """
+    A serializable which can be written to a file as YAML or as versioned
+    JSON, with a header of extra values (which are written as comments in
+    YAML files), and read back with read_file.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'file')
+    >>> for fmt in yamlfile.file_formats:
+    ...     getattr(yamlfile({'a': [1]}), 'write_%s_file' % fmt)(
+    ...         path, header=dict(seq=3)
+    ...     )
+    ...     yamlfile.read_file(path)
+    ({'a': [1]}, {'seq': 3}, 'yaml')
+    ({'a': [1]}, {'seq': 3}, 'json')
+
+    Other comments before the header's items are ignored:
+
+    >>> _ = open(path, 'w').write("# edited by hand\\n# seq: 4\\na: [2]\\n")
+    >>> yamlfile.read_file(path)
+    ({'a': [2]}, {'seq': 4}, 'yaml')
+    """
+
+    file_formats = ('yaml', 'json')
+
+    # The "format" and "version" of the JSON files; read_file refuses to read
+    # files with a newer version.
+    json_format = 'vula'
+    json_version = 1
+
+    def write_yaml_file(
+        self, path, mode=None, autochown=False, fsync=False, header=None
+    ):
+        """
+        Writes self to path as YAML, after the header's items (if any) as YAML
+        comments. If fsync is True, the file is synced to disk before it
+        replaces the old one.
+        """
+        text = yaml.dump(
+            self._dict(),
+            Dumper=_YamlDumper,
+            default_style='',
+            sort_keys=False,
+        )
+        if header:
+            text = (
+                "".join("# %s: %s\n" % item for item in header.items()) + text
+            )
+        self._write_file(path, text, mode, autochown, fsync)
+
+    def write_json_file(
+        self, path, mode=None, autochown=False, fsync=False, header=None
+    ):
+        """
+        Writes self to path as JSON, in an object with the json_format and
+        json_version and the header's items.
+        """
+        data = dict(format=self.json_format, version=self.json_version)
+        data.update(header or {})
+        data['state'] = self._dict()
+        text = json.dumps(data, separators=(',', ':'))
+        self._write_file(path, text, mode, autochown, fsync)
+
+    @staticmethod
+    def _write_file(path, text, mode, autochown, fsync):
         if mode:
             Path(path).touch(mode=mode)
 
         with click.open_file(
             path, mode='w', encoding='utf-8', atomic=True
         ) as fh:
-            fh.write(
-                yaml.safe_dump(self._dict(), default_style='', sort_keys=False)
-            )
+            fh.write(text)
+            if fsync:
+                fh.flush()
+                os.fsync(fh.fileno())
         if autochown:
             chown_like_dir_if_root(path)
 
     @classmethod
     def from_yaml_file(cls, path):
         with click.open_file(path, mode='r', encoding='utf-8') as fh:
-            return cls(yaml.safe_load(fh))
+            return cls(yaml.load(fh, Loader=_YamlLoader))
+
+    @classmethod
+    def read_file(cls, path):
+        """
+        Reads a file written by write_yaml_file or write_json_file, and returns
+        an instance, the header, and the name of the file's format.
+        """
+        with click.open_file(path, mode='r', encoding='utf-8') as fh:
+            text = fh.read()
+        if text.startswith('{'):
+            data = json.loads(text)
+            fmt, version = data.pop('format', None), data.pop('version', 0)
+            if fmt != cls.json_format or version > cls.json_version:
+                raise ValueError(
+                    "%s is not a %s file of version <= %s"
+                    % (path, cls.json_format, cls.json_version)
+                )
+            return cls(data.pop('state')), data, 'json'
+        header = {}
+        for line in text.split("\n"):
+            if not line.startswith('#'):
+                break
+            # other comments (eg, added by hand) are not part of the header
+            match = _YAML_HEADER_LINE.match(line)
+            if match is None:
+                continue
+            try:
+                value = yaml.load(match.group(2), Loader=_YamlLoader)
+            except yaml.YAMLError:
+                continue
+            header[match.group(1)] = value
+        return cls(yaml.load(text, Loader=_YamlLoader)), header, 'yaml'
+
+
+# The lines written by write_yaml_file for the header's items
+_YAML_HEADER_LINE = re.compile(r'^# (\w+): (.*)$')
 
 
 class yamlrepr(serializable):
@@ -997,6 +1142,226 @@ class chunkable_values(dict):
         return type(self)(res)
 
 
+class Metrics(object):
+    """
+    Thread-safe counters, gauges, and latency histograms, for reporting
+    performance statistics.
+
+    >>> m = Metrics()
+    >>> m.count('events')
+    >>> m.count('events', 2)
+    >>> m.gauge('answer', lambda: 42)
+    >>> m.observe('latency', 0.003)
+    >>> m.observe('latency', 0.5)
+    >>> m.snapshot()['events'], m.snapshot()['answer']
+    (3, 42)
+    >>> latency = m.snapshot()['latency']
+    >>> latency['count'], latency['mean'], latency['max']
+    (2, 0.2515, 0.5)
+    >>> latency['histogram']
+    {'<1ms': 0, '<10ms': 1, '<100ms': 0, '<1s': 1, '<10s': 0, '>=10s': 0}
+    """
+
+    buckets = ((0.001, '<1ms'), (0.01, '<10ms'), (0.1, '<100ms'))
+    buckets += ((1, '<1s'), (10, '<10s'), (float('inf'), '>=10s'))
+
+    def __init__(self):
+        self._lock = Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.latencies = {}
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, function):
+        "Register a function to be called to get a value for each snapshot"
+        self.gauges[name] = function
+
+    def observe(self, name, seconds):
+        "Record a latency sample"
+        with self._lock:
+            stats = self.latencies.setdefault(
+                name,
+                dict(
+                    count=0,
+                    total=0.0,
+                    max=0.0,
+                    histogram={label: 0 for _, label in self.buckets},
+                ),
+            )
+            stats['count'] += 1
+            stats['total'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            label = next(label for le, label in self.buckets if seconds < le)
+            stats['histogram'][label] += 1
+
+    def snapshot(self):
+        "Returns a dictionary of the current values"
+        with self._lock:
+            res = dict(self.counters)
+            for name, stats in self.latencies.items():
+                res[name] = dict(
+                    count=stats['count'],
+                    mean=round(stats['total'] / stats['count'], 6),
+                    max=round(stats['max'], 6),
+                    histogram=dict(stats['histogram']),
+                )
+        res.update({name: fn() for name, fn in self.gauges.items()})
+        return res
+
+
+class LRUCache(OrderedDict):
+    """
+    A dictionary which holds at most maxsize items, evicting the least
+    recently used item when a new one is added. Not thread-safe.
+
+    >>> c = LRUCache(2)
+    >>> c['a'] = 1
+    >>> c['b'] = 2
+    >>> c['a']
+    1
+    >>> c['c'] = 3
+    >>> list(c)
+    ['a', 'c']
+    >>> c.get('b', 'evicted')
+    'evicted'
+    """
+
+    def __init__(self, maxsize=128):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+class Flusher(object):
+    """
+    Calls flush in a background thread after mark_dirty is called, waiting
+    max_delay seconds first so that a burst of changes is written once rather
+    than once per change. The flush function is never called concurrently.
+    If it raises an exception, the changes are still dirty, and it is called
+    again after a delay which doubles with each consecutive failure (up to
+    max_retry_delay seconds).
+
+    >>> flushes = []
+    >>> f = Flusher(lambda: flushes.append(1), max_delay=60)
+    >>> for i in range(3):
+    ...     f.mark_dirty()
+    >>> f.stop()
+    >>> flushes, f.metrics.snapshot()['coalesced_writes']
+    ([1], 2)
+    """
+
+    max_retry_delay = 60.0
+
+    def __init__(self, flush, max_delay=1.0, name="flusher"):
+        self.log: Logger = getLogger()
+        self._flush = flush
+        self.max_delay = max_delay
+        self.name = name
+        self.metrics = Metrics()
+        self._cond = Condition()
+        self._flush_lock = Lock()
+        self._dirty_since = None
+        self._marks = 0
+        self._failures = 0
+        self._retry_at = None
+        self._thread = None
+        self._stopping = False
+
+    def mark_dirty(self):
+        with self._cond:
+            if self._dirty_since is None:
+                self._dirty_since = time.monotonic()
+            self._marks += 1
+            if self._thread is None and not self._stopping:
+                self._thread = Thread(
+                    target=self._run, name=self.name, daemon=True
+                )
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        with self._cond:
+            while not self._stopping:
+                if self._dirty_since is None:
+                    self._cond.wait()
+                    continue
+                delay = self._dirty_since + self.max_delay - time.monotonic()
+                if self._retry_at is not None:
+                    delay = max(delay, self._retry_at - time.monotonic())
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                self._cond.release()
+                try:
+                    self.flush()
+                finally:
+                    self._cond.acquire()
+
+    def flush(self):
+        """
+        Calls the flush function now, if anything has been marked dirty since
+        it was last called. Returns True if it was called.
+        """
+        with self._flush_lock:
+            with self._cond:
+                since, marks = self._dirty_since, self._marks
+                self._dirty_since, self._marks = None, 0
+            if since is None:
+                return False
+            try:
+                self._flush()
+            except Exception as ex:
+                self.metrics.count('errors')
+                with self._cond:
+                    # the changes were not written, so they are still dirty
+                    if self._dirty_since is None or since < self._dirty_since:
+                        self._dirty_since = since
+                    self._marks += marks
+                    self._failures += 1
+                    retry_delay = min(
+                        max(self.max_delay, 1.0) * 2 ** (self._failures - 1),
+                        self.max_retry_delay,
+                    )
+                    self._retry_at = time.monotonic() + retry_delay
+                self.log.error(
+                    "Flushing failed (retrying in %.1fs): %r", retry_delay, ex
+                )
+                return False
+            with self._cond:
+                self._failures = 0
+                self._retry_at = None
+            self.metrics.count('flushes')
+            self.metrics.count('coalesced_writes', marks - 1)
+            self.metrics.observe('flush_latency', time.monotonic() - since)
+            return True
+
+    def stop(self):
+        "Stops the background thread, after flushing any unflushed changes"
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
 def addrs_in_subnets(addrs, subnets):
     """
     >>> current_subnets={'10.0.0.0/24': ['10.0.0.9', '10.0.0.51',
@@ -6,6 +6,7 @@
 from base64 import b64encode
 from logging import getLogger, Logger
 import os
+import shutil
 from os import geteuid, mkdir, system
 from sys import platform
 import time
@@ -16,7 +17,7 @@ from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
 from cryptography.exceptions import UnsupportedAlgorithm
 
 from .status import main as StatusCommand
-from .csidh import csidh_parameters, CSIDH
+from .csidh import csidh_parameters, make_csidh
 
 try:
     from dbus import Boolean, Interface, SystemBus
@@ -34,6 +35,8 @@ from .notclick import DualUse
 from .constants import (
     _WG_SERVICES,
     _ORGANIZE_KEYS_CONF_FILE,
+    _ORGANIZE_PSK_CACHE_DIR,
+    _ORGANIZE_CSIDH_TABLES_FILE,
 )
 
 from .common import attrdict, KeyFile
@@ -50,6 +53,12 @@ from .common import attrdict, KeyFile
     show_default=True,
     help="YAML configuration file for cryptographic keys",
 )
+@click.option(
+    "--psk-cache-dir",
+    default=_ORGANIZE_PSK_CACHE_DIR,
+    show_default=True,
+    help="Directory of cached CSIDH PSKs, to remove when keys are generated",
+)
 @click.pass_context
 class Configure(attrdict):
     def __init__(self, ctx, **kw):
@@ -120,7 +129,9 @@ class Configure(attrdict):
     def _csidh_keypair_gen(self):
         if self._csidh is None:
             self.log.debug("Initializing CSIDH")
-            self._csidh = CSIDH(**csidh_parameters)
+            self._csidh = make_csidh(
+                csidh_parameters, _ORGANIZE_CSIDH_TABLES_FILE
+            )
         self.log.debug("Generating CSIDH keypair")
         sk = self._csidh.secret_key()
         pk = self._csidh.public_key(sk)
@@ -150,6 +161,8 @@ class Configure(attrdict):
             self.log.info("Generating keys...")
             keys = self.genkeys()
             keys.write_yaml_file(path, mode=0o600, autochown=True)
+            # PSKs computed with the old keys will never be used again
+            shutil.rmtree(self.psk_cache_dir, ignore_errors=True)
         return keys
 
     @DualUse.method()
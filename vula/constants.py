@@ -30,6 +30,9 @@ _ORGANIZE_CACHE_FILE: str = _ORGANIZE_CACHE_BASEDIR + "vula-organize-cache"
 _ORGANIZE_CONF_FILE: str = _ORGANIZE_CACHE_BASEDIR + "vula-organize.yaml"
 _ORGANIZE_KEYS_CONF_FILE: str = _ORGANIZE_CACHE_BASEDIR + "keys.yaml"
 _ORGANIZE_HOSTS_FILE: str = _ORGANIZE_CACHE_BASEDIR + "hosts"
+_ORGANIZE_PSK_CACHE_DIR: str = _ORGANIZE_CACHE_BASEDIR + "csidh-psks/"
+_ORGANIZE_CSIDH_TABLES_FILE: str = _ORGANIZE_CACHE_BASEDIR + "csidh.json"
+_ORGANIZE_JOURNAL_FILE: str = _ORGANIZE_CACHE_BASEDIR + "journal.jsonl"
 _ORGANIZE_UPDATE_TEMP: str = "vula-organize-peer-update-"
 _DEFAULT_TABLE: int = 666
 
@@ -1,13 +1,33 @@
 """
 *vula* CSIDH interface functions.
 """
+
+import hmac
+import json
+import multiprocessing
+import os
+from base64 import b64decode
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from importlib.metadata import version, PackageNotFoundError
+from logging import getLogger
+from threading import Lock
+
+import click
 from hkdf import Hkdf
-from hashlib import sha512
+from hashlib import sha256, sha512
 
+from sibc.common import attrdict
+from sibc.constants import parameters as sibc_parameters
 from sibc.csidh import CSIDH  # noqa: F401
+from sibc.csidh.gae_df import Gae_df
+from sibc.montgomery.curve import MontgomeryCurve
+from sibc.montgomery.isogeny import MontgomeryIsogeny
 from typing import ByteString
 
-from .common import b64_bytes
+from .common import b64_bytes, chown_like_dir_if_root, LRUCache, Metrics
 
 
 csidh_parameters = dict(
@@ -41,6 +61,348 @@ def hkdf(raw_key: ByteString) -> str:
     return psk
 
 
+class _TabledGae_df(Gae_df):
+    """
+    sibc's Gae_df, with the strategy tables given instead of computed.
+    """
+
+    def __init__(self, tables, *args):
+        self._tables = tables
+        super().__init__(*args)
+
+    def strategy_block_cost(self, L, e):
+        return tuple(self._tables)
+
+
+class _TabledCSIDH(CSIDH):
+    """
+    sibc's CSIDH, with the df strategy tables given instead of computed.
+
+    sibc's constructor has no way to take precomputed strategies, so this
+    repeats what it does for montgomery curves in the df style, with a
+    _TabledGae_df in place of its Gae_df.
+    """
+
+    def __init__(
+        self,
+        tables,
+        curvemodel,
+        prime,
+        formula,
+        style,
+        exponent,
+        tuned,
+        multievaluation,
+        uninitialized,
+        verbose,
+    ):
+        if (curvemodel, style) != ('montgomery', 'df'):
+            raise ValueError("tables are only for montgomery curves and df")
+        self.curvemodel = curvemodel
+        self.prime = prime
+        self.style = style
+        self._exponent = exponent
+        self.tuned = tuned
+        self.uninitialized = uninitialized
+        self.multievaluation = multievaluation
+        self.params = attrdict(sibc_parameters['csidh'][prime])
+        self.params.update(self.params[style])
+        self.p_bytes = (self.params.p_bits + 8 - (self.params.p_bits % 8)) // 8
+        self.isogeny = MontgomeryIsogeny(
+            formula, uninitialized=self.uninitialized
+        )
+        self.curve = MontgomeryCurve(prime)
+        self.field = self.curve.field
+        self.formula = self.isogeny(
+            self.curve, self.tuned, self.multievaluation
+        )
+        self.gae = _TabledGae_df(
+            tables, prime, self.tuned, self.curve, self.formula
+        )
+
+
+def make_csidh(parameters=csidh_parameters, tables_file=None):
+    """
+    Returns a CSIDH instance.
+
+    Initializing sibc's CSIDH computes optimal isogeny strategies, which takes
+    about as long as a fifth of a dh operation. If tables_file is given, the
+    strategy tables are read from it instead of being computed (or, if it does
+    not exist or is for different parameters, written to it after computing
+    them).
+    """
+    log = getLogger()
+    if tables_file is None or parameters['style'] != 'df':
+        return CSIDH(**parameters)
+    key = dict(sibc=_sibc_version(), parameters=parameters)
+    try:
+        with open(tables_file) as fh:
+            cached = json.load(fh)
+        if dict(sibc=cached['sibc'], parameters=cached['parameters']) != key:
+            raise ValueError("tables are for different parameters")
+        tables = cached['tables']
+    except FileNotFoundError:
+        tables = None
+    except (OSError, ValueError, KeyError, IndexError) as ex:
+        log.info("Ignoring CSIDH tables file %s: %r", tables_file, ex)
+        tables = None
+    if tables is not None:
+        try:
+            return _TabledCSIDH(tables, **parameters)
+        except Exception as ex:
+            log.warning(
+                "Unable to use CSIDH tables file %s: %r", tables_file, ex
+            )
+    csidh = CSIDH(**parameters)
+    gae = csidh.gae
+    tables = [list(map(float, gae.C_out)), gae.L_out, gae.R_out]
+    tables += [gae.S_out, gae.r_out]
+    try:
+        with click.open_file(tables_file, mode='w', atomic=True) as fh:
+            json.dump(dict(key, tables=tables), fh)
+        chown_like_dir_if_root(tables_file)
+    except OSError as ex:
+        log.info("Unable to write CSIDH tables file: %r", ex)
+    return csidh
+
+
+def _sibc_version():
+    try:
+        return version('sibc')
+    except PackageNotFoundError:
+        return None
+
+
+_worker_csidh = None
+
+
+def _worker_init(parameters, tables_file):
+    global _worker_csidh
+    _worker_csidh = make_csidh(parameters, tables_file)
+
+
+def _worker_warm():
+    return os.getpid()
+
+
+def _worker_dh(sk, pk):
+    return _worker_csidh.dh(sk, pk)
+
+
+class PskCache(object):
+    """
+    A persistent cache of CSIDH PSKs, with one file per peer in directory.
+
+    Entries are keyed by our CSIDH public key and the peer's, so that they are
+    not used after our keys are changed, and each carries an HMAC (keyed from
+    our CSIDH secret key) which is checked when the entry is read.
+
+    >>> import tempfile
+    >>> cache = PskCache(tempfile.mkdtemp(), b'secret', b'public')
+    >>> c = 'Y2Vl'
+    >>> cache.get(c) is None
+    True
+    >>> cache.put(c, 'psk')
+    >>> cache.get(c)
+    'psk'
+    >>> oct(os.stat(cache._path(c)).st_mode & 0o777)
+    '0o600'
+    >>> _ = open(cache._path(c), 'w').write('forged ' + '0' * 64)
+    >>> cache.get(c) is None
+    True
+    """
+
+    def __init__(self, directory, sk, pk):
+        self.log = getLogger()
+        self.directory = directory
+        self._pk = bytes(pk)
+        self._mac_key = Hkdf(
+            salt=None, input_key_material=bytes(sk), hash=sha512
+        ).expand(b"vula-organize-psk-cache-1", 32)
+
+    def _key(self, c):
+        return self._pk + b64decode(str(c))
+
+    def _path(self, c):
+        return os.path.join(self.directory, sha256(self._key(c)).hexdigest())
+
+    def _mac(self, c, psk):
+        return hmac.new(
+            self._mac_key, self._key(c) + psk.encode(), sha256
+        ).hexdigest()
+
+    def get(self, c):
+        "Returns the cached PSK for c, or None"
+        path = self._path(c)
+        try:
+            with open(path) as fh:
+                psk, mac = fh.read().split()
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as ex:
+            self.log.warning("Unreadable PSK cache file %s: %r", path, ex)
+            return None
+        if not hmac.compare_digest(mac, self._mac(c, psk)):
+            self.log.warning("Ignoring PSK cache file %s: bad HMAC", path)
+            return None
+        return psk
+
+    def put(self, c, psk):
+        "Writes the PSK for c to the cache, readable only by us"
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, mode=0o700)
+            chown_like_dir_if_root(self.directory)
+        path = self._path(c)
+        tmp = path + '.tmp'
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as fh:
+                fh.write("%s %s\n" % (psk, self._mac(c, psk)))
+            chown_like_dir_if_root(tmp)
+            os.replace(tmp, path)
+        except OSError as ex:
+            self.log.warning("Unable to write PSK cache file %s: %r", path, ex)
+
+
+class CsidhPool(object):
+    """
+    Computes CSIDH PSKs in a pool of worker processes, so that the organize
+    daemon does not block for the duration of the key agreement.
+
+    The psk method returns the PSK for a CSIDH public key if it has already
+    been computed, and otherwise starts computing it and returns None. When a
+    computation finishes, callback is called with the public key (as a base64
+    string).
+
+    Computed PSKs are kept in memory (up to size of them) and, if cache is a
+    PskCache, on disk.
+    """
+
+    def __init__(
+        self,
+        sk,
+        callback=None,
+        workers=2,
+        cache=None,
+        size=1024,
+        tables_file=None,
+    ):
+        self.log = getLogger()
+        self._sk = bytes(sk)
+        self.callback = callback
+        self.workers = workers
+        self.cache = cache
+        self.tables_file = tables_file
+        self._executor = None
+        self._lock = Lock()
+        self._psks = LRUCache(size)
+        self._pending = {}
+        self.metrics = Metrics()
+        self.metrics.gauge('queue_depth', lambda: len(self._pending))
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self.log.debug("Starting %s CSIDH worker processes", self.workers)
+            # spawn rather than fork, as organize has other threads running
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_worker_init,
+                initargs=(csidh_parameters, self.tables_file),
+            )
+        return self._executor
+
+    def warm(self):
+        """
+        Starts the worker processes now, so that their initialization does
+        not delay the first PSK computation.
+        """
+        with self._lock:
+            for _ in range(self.workers):
+                self.executor.submit(_worker_warm)
+
+    def psk(self, pk, submit=True):
+        """
+        Returns the PSK for pk if it is known, and otherwise returns None after
+        submitting it to be computed (unless submit is False).
+        """
+        pk = str(pk)
+        with self._lock:
+            psk = self._cached(pk)
+            if psk is not None:
+                return psk
+            if not submit or pk in self._pending:
+                return None
+            self.log.debug("Queueing CSIDH PSK for pk %s", pk)
+            self._pending[pk] = time.monotonic()
+            self.metrics.count('submitted')
+            future = self.executor.submit(_worker_dh, self._sk, b64decode(pk))
+        # outside of the lock, as the callback is called immediately if the
+        # future has already failed
+        future.add_done_callback(partial(self._done, pk))
+        return None
+
+    def _cached(self, pk):
+        # must be called with the lock held
+        psk = self._psks.get(pk)
+        if psk is None and self.cache is not None:
+            psk = self.cache.get(pk)
+            if psk is not None:
+                self.metrics.count('disk_hits')
+                self._psks[pk] = psk
+        return psk
+
+    def _store(self, pk, psk):
+        with self._lock:
+            self._psks[pk] = psk
+        if self.cache is not None:
+            self.cache.put(pk, psk)
+
+    def dh(self, pk):
+        """
+        Returns the PSK for pk, waiting for it to be computed if necessary.
+        """
+        psk = self.psk(pk, submit=False)
+        if psk is None:
+            raw_key = self.executor.submit(
+                _worker_dh, self._sk, b64decode(str(pk))
+            ).result()
+            psk = hkdf(raw_key)
+            self._store(str(pk), psk)
+        return psk
+
+    def _done(self, pk, future):
+        with self._lock:
+            started = self._pending.pop(pk)
+        try:
+            psk = hkdf(future.result())
+        except Exception as ex:
+            self.metrics.count('failed')
+            self.log.error("Computing CSIDH PSK for pk %s failed: %r", pk, ex)
+            if isinstance(ex, BrokenProcessPool):
+                # start a new pool on the next submission
+                with self._lock:
+                    self._executor = None
+            return
+        self._store(pk, psk)
+        self.metrics.count('completed')
+        self.metrics.observe('latency', time.monotonic() - started)
+        self.log.debug("Computed CSIDH PSK for pk %s", pk)
+        if self.callback is not None:
+            self.callback(pk)
+
+    def shutdown(self, wait=False):
+        """
+        Stops the worker processes, cancelling the queued computations. If
+        wait is True, this waits for the running ones and for the processes
+        to exit.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+
+
 if __name__ == "__main__":
     import doctest
 
@@ -13,25 +13,29 @@
  addresses for the local network segment are used as WireGuard peers.
 """
 
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from logging import Logger, getLogger
+from threading import Lock
 from typing import Optional
 import click
 from click.exceptions import Exit
 from pyroute2 import IPRoute
 
 import pydbus
+from pydbus.generic import signal
 from gi.repository import GLib
 
 from zeroconf import ServiceBrowser, ServiceInfo, ServiceListener, Zeroconf
 
-from ipaddress import ip_address as ip_addr_parser
+from ipaddress import ip_address as ip_addr_parser, ip_network
 
+from .common import LRUCache, Metrics, addrs_in_subnets, yamlrepr
 from .peer import Descriptor
 
 from .constants import (
     _LABEL,
-    _ORGANIZE_DBUS_NAME,
-    _ORGANIZE_DBUS_PATH,
     _DISCOVER_DBUS_NAME,
 )
 
@@ -43,10 +47,15 @@ class WireGuardServiceListener(ServiceListener):
     https://tools.ietf.org/html/rfc6763#section-6.4
     """
 
-    def __init__(self, callback):
+    def __init__(self, callback, executor=None, metrics=None):
         super(WireGuardServiceListener, self).__init__()
         self.log: Logger = getLogger()
         self.callback = callback
+        self.executor = executor
+        self.metrics = metrics if metrics is not None else Metrics()
+        self._lock = Lock()
+        self._in_flight = {}
+        self._again = {}
 
     def remove_service(
         self, zeroconf: Zeroconf, s_type: str, name: str
@@ -62,7 +71,39 @@ class WireGuardServiceListener(ServiceListener):
         """
         When zeroconf discovers a new WireGuard service it calls *add_service*
         which produces a peer descriptor on *stdout*.
+
+        The service is resolved by the executor if there is one (as resolving
+        can block for seconds), and otherwise in the calling thread. If the
+        name is already being resolved, it is resolved once more afterwards,
+        rather than concurrently.
         """
+        with self._lock:
+            if name in self._in_flight:
+                self._again.setdefault(name, time.monotonic())
+                self.metrics.count('deduplicated')
+                return
+            self._in_flight[name] = time.monotonic()
+        if self.executor is None:
+            self._resolve(zeroconf, s_type, name)
+        else:
+            self.executor.submit(self._resolve, zeroconf, s_type, name)
+
+    def _resolve(self, zeroconf: Zeroconf, s_type: str, name: str) -> None:
+        try:
+            while True:
+                self._resolve_once(zeroconf, s_type, name)
+                with self._lock:
+                    if name not in self._again:
+                        return
+                    self._in_flight[name] = self._again.pop(name)
+        except Exception as ex:
+            self.log.error("Resolving %s failed: %r", name, ex)
+        finally:
+            with self._lock:
+                self._in_flight.pop(name, None)
+                self._again.pop(name, None)
+
+    def _resolve_once(self, zeroconf: Zeroconf, s_type: str, name: str):
         # Typing note:
         # 'Any' works here and while 'Optional[ServiceInfo]' should, it does
         # not unless mypy is called with --no-strict-optional like so:
@@ -70,6 +111,7 @@ class WireGuardServiceListener(ServiceListener):
         #   mypy --ignore-missing-imports  --no-strict-optional discover.py
         info: Optional[ServiceInfo] = zeroconf.get_service_info(s_type, name)
         if info is None:
+            self.metrics.count('unresolved')
             return
         data = {k.decode(): v.decode() for k, v in info.properties.items()}
 
@@ -82,6 +124,11 @@ class WireGuardServiceListener(ServiceListener):
             return
 
         self.callback(desc)
+        # the time from when the service was first seen (since it was last
+        # resolved) until its descriptor was delivered
+        self.metrics.observe(
+            'resolve_latency', time.monotonic() - self._in_flight[name]
+        )
 
     def update_service(self, *a, **kw):
         return self.add_service(*a, **kw)
@@ -94,20 +141,155 @@ class Discover(object):
       <interface name='local.vula.discover1.Listen'>
         <method name='listen'>
           <arg type='as' name='ip_addrs' direction='in'/>
+          <arg type='a{sas}' name='filters' direction='in'/>
+        </method>
+        <method name='stats'>
+          <arg type='s' name='response' direction='out'/>
         </method>
       </interface>
+      <interface name='local.vula.discover1.Descriptors'>
+        <signal name='Descriptors'>
+          <arg type='as' name='descriptors'/>
+        </signal>
+      </interface>
     </node>
     '''
 
+    # Emitted (from the main loop) with batches of the queued descriptors
+    Descriptors = signal()
+
+    # The number of threads for resolving services concurrently
+    resolve_workers = 8
+
+    # The maximum number of descriptors to queue for the Descriptors signal
+    # (the oldest are dropped when it is full), and to emit in one signal
+    queue_size = 1024
+    batch_size = 256
+
+    # The number of vks to remember the last forwarded (vf, s) of, and for
+    # how many seconds a forwarded descriptor suppresses its repeats (so that
+    # organize sees it again if it has since removed the peer)
+    forwarded_cache_size = 4096
+    forwarded_ttl = 300
+
     def __init__(self):
 
         self.callbacks = []
-        self.browsers = {}
+        self.metrics = Metrics()
+        self.queue = deque(maxlen=self.queue_size)
+        self._queue_lock = Lock()
+        self._emitting = False
+        self.metrics.gauge('queue_depth', lambda: len(self.queue))
+        self.metrics.gauge('zeroconf_instances', lambda: len(self.zeroconfs))
+        self.executor = None
+        self.zeroconfs = {}
+        self.networks = {}
+        self.filters = {}
+        self.forwarded = LRUCache(self.forwarded_cache_size)
+        self._forwarded_lock = Lock()
         self.log: Logger = getLogger()
 
     def callback(self, value):
+        reason = self._suppress(value)
+        if reason is not None:
+            self.metrics.count('suppressed_' + reason)
+            self.log.debug("Suppressed descriptor (%s): %s", reason, value)
+            return
         for callback in self.callbacks:
             callback(value)
+        if self.enqueue not in self.callbacks:
+            # when queued, it is only forwarded once it has been emitted
+            self._forwarded(value)
+
+    def _suppress(self, descriptor):
+        """
+        Returns the reason descriptor should not be forwarded, or None if it
+        should be: it is from a network we are no longer listening on, it
+        does not pass the filters, or it is the same as the last one
+        forwarded for its vk (less than forwarded_ttl seconds ago).
+        """
+        if not self._on_listened_network(descriptor):
+            return 'network'
+        filters = self.filters
+        if 'pk' in filters and str(descriptor.pk) in filters['pk']:
+            return 'own'
+        if 'subnets' in filters and not addrs_in_subnets(
+            descriptor.addrs, list(map(ip_network, filters['subnets']))
+        ):
+            return 'subnet'
+        if 'domains' in filters and not any(
+            descriptor.hostname.endswith(domain)
+            for domain in filters['domains']
+        ):
+            return 'domain'
+        with self._forwarded_lock:
+            last = self.forwarded.get(str(descriptor.vk))
+        if (
+            last is not None
+            and last[0] == (descriptor.vf, bytes(descriptor.s))
+            and time.monotonic() - last[1] < self.forwarded_ttl
+        ):
+            return 'repeat'
+        return None
+
+    def _forwarded(self, descriptor):
+        "Records that descriptor has been forwarded, to suppress its repeats"
+        with self._forwarded_lock:
+            self.forwarded[str(descriptor.vk)] = (
+                (descriptor.vf, bytes(descriptor.s)),
+                time.monotonic(),
+            )
+
+    def stats(self):
+        "Returns discover's performance counters"
+        return str(yamlrepr(self.metrics.snapshot()))
+
+    def enqueue(self, descriptor):
+        """
+        Queues descriptor to be emitted in a Descriptors signal. This can be
+        called from any thread, and never blocks on the signal's receivers.
+        """
+        with self._queue_lock:
+            if len(self.queue) == self.queue.maxlen:
+                self.metrics.count('dropped')
+            self.queue.append(descriptor)
+            if not self._emitting:
+                self._emitting = True
+                GLib.idle_add(self._emit)
+
+    def _emit(self):
+        """
+        Emits the queued descriptors, batch_size at a time. Called from the
+        main loop, until it returns False.
+        """
+        with self._queue_lock:
+            batch = [
+                self.queue.popleft()
+                for _ in range(min(len(self.queue), self.batch_size))
+            ]
+            self._emitting = bool(self.queue)
+        if batch:
+            self.Descriptors([str(descriptor) for descriptor in batch])
+            for descriptor in batch:
+                self._forwarded(descriptor)
+            self.metrics.count('emitted', len(batch))
+            self.metrics.count('signals')
+        return self._emitting
+
+    def _on_listened_network(self, descriptor):
+        """
+        Returns True if descriptor has an address on the network of one of
+        the IPs we are listening on. The zeroconf instance keeps receiving on
+        IPs which we have stopped listening on (see listen), so this filters
+        out what it receives from their networks.
+        """
+        if not self.networks or None in self.networks.values():
+            return True
+        return any(
+            addr in network
+            for addr in descriptor.addrs
+            for network in self.networks.values()
+        )
 
     def listen_on_ip_or_if(self, ip_address, interface):
 
@@ -137,59 +319,103 @@ class Discover(object):
                 ip_addr: str = dict(a[0]['attrs'])['IFA_ADDRESS']
 
         if ip_addr:
-            self.listen([ip_addr])
-
-    def listen(self, ip_addrs):
-        for ip_addr in ip_addrs:
-            if ip_addr in self.browsers:
-                self.log.info("Not launching a second browser for %r", ip_addr)
-                continue
-            zeroconf: Zeroconf = Zeroconf(interfaces=[ip_addr])
-            self.log.debug("Starting ServiceBrowser for %r", ip_addr)
-            browser: ServiceBrowser = ServiceBrowser(
-                zeroconf, _LABEL, WireGuardServiceListener(self.callback)
-            )
-            self.browsers[ip_addr] = (zeroconf, browser)
-        for old_ip in list(self.browsers):
-            if old_ip not in ip_addrs:
-                self.log.info(
-                    "Removing old service browser for %r (new ip_addrs=%r)",
-                    old_ip,
-                    ip_addrs,
+            self.listen([ip_addr], {})
+
+    @property
+    def interfaces(self):
+        "The IPs which the zeroconf instances are listening on"
+        return tuple(ip for ips in self.zeroconfs for ip in ips)
+
+    def listen(self, ip_addrs, filters=None):
+        """
+        Listens on ip_addrs, with one zeroconf instance and service browser
+        for all of them.
+
+        filters may contain lists of values for 'pk' (our own pks), 'subnets'
+        and 'domains', to drop the descriptors organize would reject before
+        they are forwarded. When the IPs or filters change, the descriptors
+        which have been forwarded are forgotten, so that they will be
+        forwarded again.
+
+        python-zeroconf can not add or remove the interfaces of a running
+        instance, so new IPs get an instance of their own (shared by the IPs
+        which are added together) instead of the running one being replaced.
+        When IPs are removed, an instance keeps its sockets for them until
+        none of its IPs are listened on, and the descriptors received from
+        their networks are dropped instead.
+        """
+        ip_addrs = list(dict.fromkeys(ip_addrs))
+        filters = dict(filters or {})
+        if set(ip_addrs) != set(self.networks) or filters != self.filters:
+            with self._forwarded_lock:
+                self.forwarded.clear()
+        self.networks = _local_networks(ip_addrs)
+        self.filters = filters
+        for ips in list(self.zeroconfs):
+            if not set(ips) & set(ip_addrs):
+                self._stop(ips)
+        new = [ip for ip in ip_addrs if ip not in self.interfaces]
+        if new:
+            self.log.debug("Starting ServiceBrowser for %r", new)
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.resolve_workers,
+                    thread_name_prefix='resolve',
                 )
-                self.browsers[old_ip][1].cancel()
-                self.browsers[old_ip][0].close()
-                del self.browsers[old_ip]
+            zeroconf = Zeroconf(interfaces=new)
+            browser = ServiceBrowser(
+                zeroconf,
+                _LABEL,
+                WireGuardServiceListener(
+                    self.callback, executor=self.executor, metrics=self.metrics
+                ),
+            )
+            self.zeroconfs[tuple(new)] = zeroconf, browser
+        if set(self.interfaces) != set(ip_addrs):
+            self.log.info(
+                "Ignoring descriptors from %r (new ip_addrs=%r)",
+                sorted(set(self.interfaces) - set(ip_addrs)),
+                ip_addrs,
+            )
+
+    def _stop(self, ips):
+        zeroconf, browser = self.zeroconfs.pop(ips)
+        self.log.info("Stopping ServiceBrowser for %r", ips)
+        browser.cancel()
+        zeroconf.close()
 
     def shutdown(self):
-        for ip, browser in list(self.browsers.items()):
-            del self.browsers[ip]
-            browser.cancel()
+        for ips in list(self.zeroconfs):
+            self._stop(ips)
 
     def is_alive(self):
-        return any(browser.is_alive() for browser in self.browsers.values())
+        return bool(self.zeroconfs) and all(
+            browser.is_alive() for zeroconf, browser in self.zeroconfs.values()
+        )
 
     @classmethod
-    def daemon(cls, use_dbus, ip_address, interface):
+    def daemon(cls, use_dbus, ip_address, interface, queue_size):
 
         """
         This method implements the non-monolithic daemon mode where we run
         Discover in its own process (as we deploy on GNU/systemd).
+
+        The descriptors are sent to organize in Descriptors signals, rather
+        than by calling it, so that discover never waits for organize (which
+        may itself be waiting for discover).
         """
 
         loop = GLib.MainLoop()
 
         discover = cls()
+        discover.queue = deque(maxlen=queue_size)
 
         discover.callbacks.append(lambda d: discover.log.info("%s", d))
 
         if use_dbus:
             discover.log.debug("dbus enabled")
             system_bus = pydbus.SystemBus()
-            process = system_bus.get(
-                _ORGANIZE_DBUS_NAME, _ORGANIZE_DBUS_PATH
-            ).process_descriptor_string
-            discover.callbacks.append(lambda d: process(str(d)))
+            discover.callbacks.append(discover.enqueue)
             system_bus.publish(_DISCOVER_DBUS_NAME, discover)
 
         discover.listen_on_ip_or_if(ip_address, interface)
@@ -197,6 +423,24 @@ class Discover(object):
         loop.run()
 
 
+def _local_networks(ip_addrs):
+    """
+    Returns a dict mapping each of ip_addrs to the network it is configured
+    with on this system, or to None if it is not configured.
+    """
+    networks = dict.fromkeys(ip_addrs)
+    if not ip_addrs:
+        return networks
+    with IPRoute() as ipr:
+        for addr in ipr.get_addr():
+            ip = addr.get_attr('IFA_ADDRESS')
+            if ip in networks:
+                networks[ip] = ip_network(
+                    "%s/%s" % (ip, addr['prefixlen']), strict=False
+                )
+    return networks
+
+
 # FIXME: should we shutdown zeroconf objects upon glib shutdown? probably.
 #        try:
 #            while True:
@@ -231,6 +475,14 @@ class Discover(object):
     help="bind to the primary IP address for the given interface, "
     "automatically choosing which IP to announce",
 )
+@click.option(
+    "--queue-size",
+    type=int,
+    default=Discover.queue_size,
+    show_default=True,
+    help="Maximum number of descriptors to queue for organize (the oldest "
+    "are dropped when it is full)",
+)
 def main(**kwargs):
     Discover.daemon(**kwargs)
 
@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 from schema import Schema, Use, Optional
-from functools import reduce, wraps
+from functools import wraps
 from threading import Lock
 import traceback
 import copy
@@ -19,11 +19,12 @@ class Result(yamlrepr_hl, schemattrdict):
     and the actions, writes, triggers, and trigger_results which resulted from
     the event.
 
-    Although log replay is not yet implemented, the event engine is designed
-    such that replaying the events from a log of result objects should produce
-    an identical state and an identical series of result objects (except for
-    the trigger_results, which depend on the system's actual configuration
-    state which exists outside of the state engine).
+    The event engine is designed such that replaying the events from a log of
+    result objects should produce an identical state and an identical series
+    of result objects (except for the trigger_results, which depend on the
+    system's actual configuration state which exists outside of the state
+    engine). Organize relies on this to recover its state by replaying the
+    events in its journal after the last snapshot (see OrganizeState.replay).
     """
 
     schema = Schema(
@@ -33,6 +34,7 @@ class Result(yamlrepr_hl, schemattrdict):
             'writes': Use(raw),
             Optional('triggers'): Use(raw),
             Optional('trigger_results'): Use(raw),
+            Optional('netlink_calls'): int,
             Optional('error'): object,
             Optional('traceback'): str,
         },
@@ -73,12 +75,19 @@ class Result(yamlrepr_hl, schemattrdict):
             self.triggers.append((name, args))
 
     def run_triggers(self, target):
+        """
+        Runs the triggers on target. If target counts its netlink_calls, the
+        number made while running the triggers is recorded too.
+        """
         assert not self.trigger_results, "triggers should only be run once"
+        calls = getattr(target, 'netlink_calls', None)
         for name, args in self.triggers:
             try:
                 self.trigger_results.append(getattr(target, name)(*args))
             except Exception as ex:
                 self.trigger_results.append(str(ex))
+        if isinstance(calls, int):
+            self.setdefault('netlink_calls', target.netlink_calls - calls)
         return self
 
 
@@ -126,17 +135,56 @@ class Engine(schemattrdict, yamlfile):
     Result = Result
 
     def __init__(self, *a, **kw):
+        self._init_engine()
+        super(Engine, self).__init__(*a, **kw)
+
+    def _init_engine(self):
         self._lock = Lock()
         self.result = None
         self.next_state = None
+        self._copies = None
         self.save = lambda *a: None
         self.debug_log = lambda *a: None
         self.trigger_target = None
-        super(Engine, self).__init__(*a, **kw)
+
+    def _working_copy(self):
+        """
+        Returns a new engine with the same committed state, which shares its
+        values (and is not validated again), and which has none of this
+        engine's hooks set. Events can be run on it to see their results
+        without changing this engine's state.
+        """
+        new = type(self).__new__(type(self))
+        new._init_engine()
+        new._as_dict = None
+        dict.update(new, self)
+        return new
 
     def record(self, result):
         pass
 
+    def log_commit(self, result):
+        """
+        Called with the lock held after an event has changed the state, and
+        before it is saved, so that subclasses can log the events which
+        changed the state in the order they were committed in.
+
+        It may return a function which waits until the logged event is
+        durable; the event calls it after releasing the lock, and before
+        running the triggers and returning. If it raises, the event's result
+        has its error (although the state has been changed).
+        """
+        return None
+
+    def _validate(self, next_state):
+        """
+        Returns the validated version of next_state, or raises an exception if
+        it is not valid. Subclasses may override this to avoid re-validating
+        parts of the state which were not written to by the current event
+        (which are available in self.result.writes).
+        """
+        return self.schema.validate(next_state)
+
     def event(method):
         """
         Decorator for event methods
@@ -155,20 +203,29 @@ class Engine(schemattrdict, yamlfile):
                 error=None,
             )
             error = None
+            wait = None
             self._lock.acquire()
             try:
-                self.next_state = copy.deepcopy(self._dict())
+                # next_state starts out sharing all of its values with the
+                # current state; write methods copy the containers along the
+                # path they write to (see _writable), so the cost of an event
+                # does not depend on the size of the state.
+                self.next_state = dict(self._dict())
+                self._copies = {id(self.next_state): self.next_state}
                 self.result = res
                 # run event method on a copy of our state
                 method(self, *a, **kw)
-                # confirm event produced a new valid state
-                new_state = self.schema.validate(self.next_state)
-                if raw(new_state) == raw(self):
+                # untouched subtrees are shared, so comparing only visits the
+                # parts of the state which were written to
+                if not res.writes or self.next_state == self._dict():
                     self.debug_log("state unchanged")
                 else:
+                    # confirm event produced a new valid state
+                    new_state = self._validate(self.next_state)
                     # apply new state, cheating the ro_dict
                     dict.update(self, new_state)
                     self._as_dict = None  # part of careful ro_dict cheating
+                    wait = self.log_commit(res)
                     self.save()
             except Exception as ex:
                 error = [ex, traceback.format_exc()]
@@ -177,7 +234,16 @@ class Engine(schemattrdict, yamlfile):
                 res = self.Result(**res)
             finally:
                 self.result = None
+                self.next_state = None
+                self._copies = None
                 self._lock.release()
+            if wait is not None:
+                try:
+                    wait()
+                except Exception as ex:
+                    res = res._dict()
+                    res.update(error=ex, traceback=traceback.format_exc())
+                    res = self.Result(**res)
             if self.trigger_target:
                 res.run_triggers(self.trigger_target)
             self.record(res)
@@ -234,17 +300,33 @@ class Engine(schemattrdict, yamlfile):
 
             if type(path) is str:
                 path = path.split('.')
-            if len(path) == 1:
-                target = self.next_state
-                key = path[0]
-            else:
-                target = reduce(lambda a, b: a[b], path[:-1], self.next_state)
-                key = path[-1]
 
-            method(self, target, key, raw(value))
+            method(self, self._writable(path[:-1]), path[-1], raw(value))
 
         return _method
 
+    def _writable(self, path, target=None):
+        """
+        Returns the container at path in next_state (or in target, which must
+        itself be writable), after replacing it and each of its ancestors
+        with a shallow copy if it has not already been copied during the
+        current event.
+
+        The containers in next_state are shared with the committed state (and
+        with the cached serializations of its sub-objects) until they are
+        written to, so they must never be modified in place without first
+        being made writable by this method.
+        """
+        if target is None:
+            target = self.next_state
+        for key in path:
+            value = target[key]
+            if id(value) not in self._copies:
+                value = target[key] = copy.copy(value)
+                self._copies[id(value)] = value
+            target = value
+        return target
+
     @write
     def _SET(self, target, key, value):
         target[key] = value
@@ -260,10 +342,11 @@ class Engine(schemattrdict, yamlfile):
                 frozenset(raw(target[key])) | set([value])
             )
         elif isinstance(target[key], dict):
+            target = self._writable((key,), target)
             if isinstance(value, dict):
-                target[key].update(value)
+                target.update(value)
             else:
-                target[key].update({value: True})
+                target.update({value: True})
         else:
             raise ValueError("Can't add type: %r" % type(target[key]))
 
@@ -278,7 +361,7 @@ class Engine(schemattrdict, yamlfile):
                 frozenset(raw(target[key])) - set([raw(value)])
             )
         elif isinstance(target[key], dict):
-            del target[key][value]
+            del self._writable((key,), target)[value]
         else:
             raise ValueError("Can't remove type: %r" % type(target[key]))
 
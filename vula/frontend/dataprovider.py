@@ -1,4 +1,6 @@
-import re
+import json
+import time
+from datetime import timedelta
 
 import pydbus
 import yaml
@@ -12,72 +14,51 @@ class DataProvider:
             _ORGANIZE_DBUS_NAME, _ORGANIZE_DBUS_PATH
         )
 
-        def escape_ansi(line):
-            ansi_escape = re.compile(
-                r"(?:\x1B[@-_]|[\x80-\x9F])[0-?]*[ -/]*[@-~]"
+        def ago(timestamp):
+            return "%s ago" % (
+                timedelta(seconds=int(time.time() - timestamp)),
             )
-            return ansi_escape.sub('', line)
 
-        # Get all peer ids from the dbus
-        ids = organize.peer_ids("enabled")
+        # Get all enabled peers and their wireguard stats in one call
+        summaries = json.loads(organize.list_peers("enabled", [], []))
 
         peers = []
+        for summary in summaries:
+            stats = summary["stats"] or {}
+            peers.append(
+                {
+                    "name": summary["name"],
+                    "id": summary["id"],
+                    "other_names": ", ".join(summary["other_names"]) or None,
+                    "status": " ".join(
+                        [
+                            ("disabled", "enabled")[summary["enabled"]],
+                            ("unpinned", "pinned")[summary["pinned"]],
+                            ("unverified", "verified")[summary["verified"]],
+                        ]
+                        + (["gateway"] if summary["use_as_gateway"] else [])
+                    ),
+                    "endpoint": summary["endpoint"],
+                    "allowed_ips": ", ".join(summary["allowed_ips"]),
+                    "latest_signature": ago(summary["latest_signature"]),
+                    "latest_handshake": (
+                        ago(stats["latest_handshake"])
+                        if stats.get("latest_handshake")
+                        else "none"
+                    ),
+                    "wg_pubkey": summary["wg_pubkey"],
+                }
+            )
 
-        # Loop over all ids in the list
-        for id in ids:
-            # Create empty dict for peer
-            peer_dict = {
-                "name": None,
-                "id": None,
-                "other_names": None,
-                "status": None,
-                "endpoint": None,
-                "allowed_ip": None,
-                "latest_signature": None,
-                "latest_handshake": None,
-                "wg_pubkey": None,
-            }
-
-            # Fill in the data
-            peer_raw = organize.show_peer(id)
-            peer_clear = escape_ansi(peer_raw)
-            peer_lines = peer_clear.split("\n")
-
-            peer_dict["name"] = peer_lines[0].lstrip().split(": ")[1]
-            peer_dict["id"] = peer_lines[1].lstrip().split(": ")[1]
-            if "other names" in peer_lines[2]:
-                peer_dict["other_names"] = (
-                    peer_lines[2].lstrip().split(": ")[1]
-                )
-                peer_dict["status"] = peer_lines[3].lstrip().split(": ")[1]
-                peer_dict["endpoint"] = peer_lines[4].lstrip().split(": ")[1]
-                peer_dict["allowed_ips"] = (
-                    peer_lines[5].lstrip().split(": ")[1]
-                )
-                peer_dict["latest_signature"] = (
-                    peer_lines[6].lstrip().split(": ")[1]
-                )
-                peer_dict["latest_handshake"] = (
-                    peer_lines[7].lstrip().split(": ")[1]
-                )
-                peer_dict["wg_pubkey"] = peer_lines[8].lstrip().split(": ")[1]
-            else:
-                peer_dict["status"] = peer_lines[2].lstrip().split(": ")[1]
-                peer_dict["endpoint"] = peer_lines[3].lstrip().split(": ")[1]
-                peer_dict["allowed_ips"] = (
-                    peer_lines[4].lstrip().split(": ")[1]
-                )
-                peer_dict["latest_signature"] = (
-                    peer_lines[5].lstrip().split(": ")[1]
-                )
-                peer_dict["latest_handshake"] = (
-                    peer_lines[6].lstrip().split(": ")[1]
-                )
-                peer_dict["wg_pubkey"] = peer_lines[7].lstrip().split(": ")[1]
+        return peers
 
-            peers.append(peer_dict)
+    def count_peers(self):
+        organize = pydbus.SystemBus().get(
+            _ORGANIZE_DBUS_NAME, _ORGANIZE_DBUS_PATH
+        )
 
-        return peers
+        # Only the ids are needed, so organize does not query wireguard
+        return len(json.loads(organize.list_peers("enabled", [], ["id"])))
 
     def get_prefs(self):
         organize = pydbus.SystemBus().get(
@@ -94,9 +94,9 @@ class Peers(tk.Frame):
     def update_loop(self):
         # function to update the GUI after adding
         # and removing peers (checks number of peers)
-        peers = self.data.get_peers()
-        if len(peers) > 0:
-            if len(peers) == self.num_peers_after:
+        num_peers = self.data.count_peers()
+        if num_peers > 0:
+            if num_peers == self.num_peers_after:
                 try:
                     self.display_peers(True)
                     self.display_peers(False)
@@ -104,7 +104,7 @@ class Peers(tk.Frame):
                 except Exception as e:
                     print(e)
 
-            if len(peers) == self.num_peers_after_remove:
+            if num_peers == self.num_peers_after_remove:
                 try:
                     self.display_peers(True)
                     self.display_peers(False)
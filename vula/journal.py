@@ -0,0 +1,333 @@
+"""
+*vula* event journal.
+
+The organize daemon appends each event which changes its state to a journal
+of JSON lines, so that the state can be recovered by replaying the events
+after the last snapshot (the state file) instead of writing the whole state
+after every event. If the record_events pref is set, the results of all events
+are appended to it too (instead of to the event_log list in the state, which
+made the state file grow without bound).
+"""
+
+from __future__ import annotations
+
+import atexit
+import json
+import os
+import time
+from logging import Logger, getLogger
+from queue import Queue
+from threading import Event, Thread
+from typing import Iterator, Optional
+
+from .common import chown_like_dir_if_root, raw
+
+_ROTATE = object()
+_STOP = object()
+
+
+class Journal(object):
+    """
+    An append-only journal stored as JSON lines in path.
+
+    When the journal is larger than max_bytes, or its first entry is older
+    than max_age seconds, it is renamed to path.1 (and path.1 to path.2, etc,
+    keeping at most keep old files) and a new one is started.
+
+    Entries are serialized and written by a background thread, so appending
+    only costs a queue put. Each entry is a dict of the (raw) fields given,
+    and the time it was appended. If fsync is True, the journal is synced to
+    disk after each batch of entries is written. append_synced waits until
+    its entry has been written and synced, whatever fsync is; append_durable
+    queues an entry and returns a function which does that waiting, so that
+    callers can wait without holding their locks. The entries which are
+    waited for are synced together (after at most group_commit of them).
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'journal')
+    >>> journal = Journal(path, max_bytes=80, keep=1)
+    >>> for i in range(4):
+    ...     journal.append(seq=i, event='E%s' % (i % 2,), peers=['a'])
+    >>> journal.flush()
+    >>> [e['seq'] for e in journal.read()]
+    [2, 3]
+    >>> journal.append_synced(seq=4, event='E0', peers=[])
+    >>> [e['seq'] for e in journal.read()]
+    [3, 4]
+    >>> wait = journal.append_durable(seq=5, event='E1', peers=['a'])
+    >>> wait()
+    >>> [e['seq'] for e in journal.read()]
+    [4, 5]
+    >>> [e['seq'] for e in journal.read(event='E1', peers='a')]
+    [5]
+    >>> [e['seq'] for e in journal.tail('seq', 2)], journal.last('seq')
+    ([4, 5], 5)
+    >>> journal.close()
+    """
+
+    # The maximum number of waited-for entries which are synced together
+    group_commit = 64
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = 16 * 1024 * 1024,
+        max_age: float = 7 * 86400,
+        keep: int = 4,
+        fsync: bool = False,
+    ):
+        self.log: Logger = getLogger()
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.keep = keep
+        self.fsync = fsync
+        self._queue: Queue = Queue()
+        self._thread: Optional[Thread] = None
+        self._fh = None
+        self._size = 0
+        self._started = None
+        # the waiters of the entries written since the last sync
+        self._waiters: list = []
+
+    def append(self, **fields):
+        """
+        Queues an entry with the given fields to be written to the journal.
+        """
+        self._put(fields, None)
+
+    def append_synced(self, **fields):
+        """
+        Appends an entry with the given fields to the journal, and waits until
+        it (and the entries queued before it) have been written and synced to
+        disk. Raises the exception which writing or syncing it raised, if
+        any.
+        """
+        self.append_durable(**fields)()
+
+    def append_durable(self, **fields):
+        """
+        Queues an entry with the given fields to be written to the journal,
+        and returns a function which waits until it has been written and
+        synced to disk (and raises the exception which prevented that, if
+        any).
+        """
+        waiter = _Waiter()
+        self._put(fields, waiter)
+        return waiter.wait
+
+    def _put(self, fields, waiter):
+        if self._thread is None:
+            self._thread = Thread(
+                target=self._writer, name="journal", daemon=True
+            )
+            self._thread.start()
+            # so that short-lived (commandline) instances don't lose entries
+            atexit.register(self.close)
+        self._queue.put((time.time(), fields, waiter))
+
+    def rotate(self):
+        """
+        Starts a new journal file after the queued entries are written.
+        """
+        if self._thread is None:
+            self._rotate()
+        else:
+            self._queue.put(_ROTATE)
+
+    def flush(self):
+        "Waits until all of the queued entries have been written"
+        self._queue.join()
+
+    def close(self):
+        "Writes the queued entries and stops the writer thread"
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+
+    def _writer(self):
+        while True:
+            item = self._queue.get()
+            error = None
+            try:
+                if item is _STOP:
+                    self._close_file()
+                    return
+                if item is _ROTATE:
+                    self._rotate()
+                else:
+                    t, fields, waiter = item
+                    try:
+                        self._write(t, fields)
+                    finally:
+                        # (after writing, as a rotation syncs and releases
+                        # the waiters of the entries written before it)
+                        if waiter is not None:
+                            self._waiters.append(waiter)
+                if self._fh is not None and (
+                    self._queue.empty()
+                    or len(self._waiters) >= self.group_commit
+                ):
+                    self._sync()
+            except Exception as ex:
+                self.log.error("Unable to write journal entry: %r", ex)
+                error = ex
+            finally:
+                # the waiters' entries have been synced when the file was
+                # synced or closed, unless writing or syncing failed
+                if error is not None or self._fh is None:
+                    self._release(error)
+                self._queue.task_done()
+
+    def _sync(self):
+        self._fh.flush()
+        if self.fsync or self._waiters:
+            os.fsync(self._fh.fileno())
+            self._release(None)
+
+    def _release(self, error):
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            waiter.set(error)
+
+    def _write(self, t, fields):
+        line = json.dumps(raw(dict(fields, time=t)))
+        if self._fh is None:
+            self._open()
+        if self._size and (
+            self._size + len(line) >= self.max_bytes
+            or t - self._started >= self.max_age
+        ):
+            self._rotate()
+            self._open()
+        if not self._size:
+            self._started = t
+        self._fh.write(line + "\n")
+        self._size += len(line) + 1
+
+    def _open(self):
+        new = not os.path.exists(self.path)
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self._fh = os.fdopen(fd, 'a', encoding='utf-8')
+        if new:
+            chown_like_dir_if_root(self.path)
+        self._size = self._fh.tell()
+        self._started = None
+        if self._size:
+            first = next(self._entries(self.path), None)
+            self._started = first['time'] if first else time.time()
+
+    def _close_file(self):
+        if self._fh is not None:
+            try:
+                if self._waiters:
+                    self._sync()
+            finally:
+                self._fh.close()
+                self._fh = None
+
+    def _rotate(self):
+        self._close_file()
+        if not os.path.exists(self.path):
+            return
+        self.log.debug("Rotating journal %s", self.path)
+        for n in range(self.keep, 0, -1):
+            older = "%s.%s" % (self.path, n - 1) if n > 1 else self.path
+            if os.path.exists(older):
+                os.replace(older, "%s.%s" % (self.path, n))
+        if not self.keep:
+            os.unlink(self.path)
+
+    def _files(self):
+        old = ["%s.%s" % (self.path, n) for n in range(self.keep, 0, -1)]
+        return [f for f in old + [self.path] if os.path.exists(f)]
+
+    def _entries(self, path) -> Iterator[dict]:
+        try:
+            with open(path, encoding='utf-8') as fh:
+                for line in fh:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        # a partially written last line
+                        continue
+        except FileNotFoundError:
+            # rotated while we were reading the older files
+            return
+
+    def read(self, since=None, until=None, **filters) -> Iterator[dict]:
+        """
+        Yields the entries in the journal (including the rotated files),
+        oldest first. since and until limit the entries' times, and each
+        filter requires the entry's field of that name to be equal to (or, if
+        it is a list, to contain) the filter's value.
+        """
+        for path in self._files():
+            for entry in self._entries(path):
+                t = entry.get('time', 0)
+                if since is not None and t < since:
+                    continue
+                if until is not None and t > until:
+                    continue
+                if all(_matches(entry.get(k), v) for k, v in filters.items()):
+                    yield entry
+
+    def tail(self, field, after) -> Iterator[dict]:
+        """
+        Yields the entries whose field is greater than after, oldest first.
+
+        The field's values must increase through the journal, so that only
+        the files which can contain such entries need to be read.
+        """
+        files = self._files()
+        start = 0
+        for i in reversed(range(len(files))):
+            first = next(
+                (e for e in self._entries(files[i]) if field in e), None
+            )
+            if first is not None and first[field] <= after:
+                start = i
+                break
+        for path in files[start:]:
+            for entry in self._entries(path):
+                if entry.get(field, after) > after:
+                    yield entry
+
+    def last(self, field):
+        """
+        Returns the last value of field in the journal, or None.
+        """
+        for path in reversed(self._files()):
+            value = None
+            for entry in self._entries(path):
+                value = entry.get(field, value)
+            if value is not None:
+                return value
+        return None
+
+
+class _Waiter(object):
+    """
+    The outcome of writing and syncing a journal entry, which is set by the
+    writer thread.
+    """
+
+    def __init__(self):
+        self._done = Event()
+        self._error = None
+
+    def set(self, error):
+        self._error = error
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+
+
+def _matches(field, value):
+    if isinstance(field, list):
+        return value in field
+    return field == value
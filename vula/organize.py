@@ -7,26 +7,32 @@
 """
 from __future__ import annotations
 
+import json
 import os
 import pdb
+import signal
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from ipaddress import (
     ip_address,
     ip_network,
 )
 from logging import Logger, getLogger
 from platform import node
+from threading import Lock
 import time
 
 from gi.repository import GLib
 
 import click
 import pydbus
-from schema import Schema, And, Use, Optional as Optional_
+from schema import Schema, SchemaError, And, Use, Optional as Optional_
 from pathlib import Path
 
 from .common import (
     attrdict,
     schemattrdict,
+    Bug,
     b64_bytes,
     yamlrepr,
     yamlrepr_hl,
@@ -34,10 +40,14 @@ from .common import (
     addrs_in_subnets,
     raw,
     chown_like_dir_if_root,
-    memoize,
+    Flusher,
+    LRUCache,
+    Metrics,
+    yamlfile,
 )
 from .engine import Engine, Result
 from .constants import (
+    _DATE_FMT,
     _DEFAULT_INTERFACE,
     _DEFAULT_TABLE,
     _FWMARK,
@@ -46,25 +56,37 @@ from .constants import (
     _ORGANIZE_CONF_FILE,
     _ORGANIZE_HOSTS_FILE,
     _ORGANIZE_KEYS_CONF_FILE,
+    _ORGANIZE_PSK_CACHE_DIR,
+    _ORGANIZE_CSIDH_TABLES_FILE,
+    _ORGANIZE_JOURNAL_FILE,
     _ORGANIZE_DBUS_NAME,
     _DISCOVER_DBUS_NAME,
     _DISCOVER_DBUS_PATH,
     _PUBLISH_DBUS_NAME,
     _PUBLISH_DBUS_PATH,
     _WG_PORT,
-    IPv4_GW_ROUTES,
 )
 from .configure import Configure
 
 from .notclick import DualUse
-from .csidh import hkdf, csidh_parameters, CSIDH
-from .peer import Descriptor, Peers, PeerCommands
+from .csidh import CsidhPool, PskCache
+from .journal import Journal
+from .peer import Descriptor, Peer, Peers, PeersIndex, PeerCommands
 from .prefs import Prefs
 from .discover import Discover
 from .publish import Publish
 from .sys import Sys
 
 
+class _StateSnapshot(yamlfile):
+    """
+    A copy of the committed OrganizeState, for writing to the state file. The
+    file's header contains the journal_seq of the last event it includes.
+    """
+
+    json_format = 'vula-organize-state'
+
+
 class SystemState(schemattrdict):
 
     """
@@ -144,17 +166,208 @@ class OrganizeState(Engine, yamlrepr_hl):
         prefs=Prefs.default, system_state={}, peers={}, event_log=[]
     )
 
+    json_format = _StateSnapshot.json_format
+
     restricted = [
         "peers.*.descriptor"
     ]  # FIXME: implement filter for 1-op direct events?
 
+    # The types of the top-level values of the state, used for validating
+    # them individually (see _validate).
+    item_types = dict(prefs=Prefs, peers=Peers, system_state=SystemState)
+
+    # How the state is validated after each event: 'incremental' re-validates
+    # only the values which were written to, and only checks the peers which
+    # were written to for conflicts. 'full' validates the whole state with the
+    # schema (as is always done when loading a state file). 'check' does both
+    # and raises a Bug if they disagree, for debugging the former.
+    validation = 'incremental'
+
+    def _validate(self, next_state):
+        if self.validation == 'full':
+            return super(OrganizeState, self)._validate(next_state)
+        if self.validation == 'check':
+            return self._check_validation(next_state)
+        return self._validate_incrementally(next_state)
+
+    def _check_validation(self, next_state):
+        """
+        Validates next_state both incrementally and fully, and raises a Bug if
+        the two methods do not agree.
+        """
+        results = []
+        for validate in (
+            self._validate_incrementally,
+            super(OrganizeState, self)._validate,
+        ):
+            try:
+                results.append(validate(next_state))
+            except Exception as ex:
+                results.append(ex)
+        incremental, full = results
+        if isinstance(full, Exception):
+            if not isinstance(incremental, Exception):
+                raise Bug(
+                    "incremental validation missed an error: %r" % (full,)
+                )
+            raise full
+        if isinstance(incremental, Exception) or raw(incremental) != raw(full):
+            raise Bug(
+                "incremental validation returned %r instead of %r"
+                % (incremental, full)
+            )
+        peers = incremental['peers']
+        if peers.index != PeersIndex(peers.values()):
+            raise Bug("peers index was not updated correctly")
+        return incremental
+
+    def _touched(self):
+        """
+        Returns a dict mapping each top-level key written to during the current
+        event to the set of its own keys which were written to, or to None if
+        it was replaced entirely.
+        """
+        touched = {}
+        for operation, path, value in self.result.writes:
+            if type(path) is str:
+                path = path.split('.')
+            if len(path) > 1:
+                keys = {path[1]}
+            elif operation == 'SET':
+                keys = None
+            else:
+                keys = set(value) if isinstance(value, dict) else {value}
+            seen = touched.get(path[0], set())
+            if seen is not None:
+                touched[path[0]] = None if keys is None else seen | keys
+        return touched
+
+    def _validate_incrementally(self, next_state):
+        """
+        Returns the validated next state, reusing the current state's values
+        (and peers) which were not written to during this event.
+        """
+        new_state = dict(self)
+        for key, keys in self._touched().items():
+            if key not in self.item_types:
+                new_state[key] = next_state[key]
+            elif key == 'peers' and keys is not None:
+                peers, old = next_state['peers'], self.peers
+                new_state['peers'] = old._updated(
+                    {k: peers[k] for k in keys if k in peers},
+                    removed=[k for k in keys if k not in peers and k in old],
+                )
+                conflicts = new_state['peers'].conflicts_with(keys)
+                if conflicts:
+                    raise SchemaError("conflicting peers: %s" % (conflicts,))
+            else:
+                new_state[key] = self.item_types[key](next_state[key])
+                if key == 'peers' and new_state['peers'].conflicts:
+                    raise SchemaError(
+                        "conflicting peers: %s"
+                        % (new_state['peers'].conflicts,)
+                    )
+        return new_state
+
     def _check_freshness(self, descriptor):
         # FIXME: check dt and vf here
         return True
 
+    # The Journal which the events which change the state are appended to,
+    # and which results are recorded in if the record_events pref is set. (The
+    # event_log in the state is no longer appended to, and is only kept so
+    # that old state files can still be loaded.)
+    journal = None
+
+    # The sequence number of the last event which changed the state, which is
+    # stored with each event in the journal and with each snapshot.
+    journal_seq = 0
+
+    # If True, each event which changes the state is written and synced to
+    # the journal before the event returns (but after the lock is released),
+    # rather than in the background.
+    sync_commits = False
+
+    # The types which the arguments of events replayed from the journal
+    # (where they are stored as raw values) are converted back to.
+    event_arg_types = dict(
+        INCOMING_DESCRIPTOR=(Descriptor,),
+        INCOMING_DESCRIPTORS=(lambda ds: [Descriptor(d) for d in ds],),
+        NEW_SYSTEM_STATE=(SystemState,),
+    )
+
+    def log_commit(self, res):
+        self.journal_seq += 1
+        if self.journal is not None:
+            append = (
+                self.journal.append_durable
+                if self.sync_commits
+                else self.journal.append
+            )
+            return append(
+                kind='commit',
+                seq=self.journal_seq,
+                event=res.event[0],
+                args=res.event[1:],
+            )
+
     def record(self, res):
-        if self.prefs.record_events:
-            self.event_log.append(raw(res))
+        if self.journal is not None and self.prefs.record_events:
+            self.journal.append(
+                kind='result',
+                event=res.event[0],
+                peers=self._result_peers(res),
+                result=res,
+            )
+
+    def snapshot(self):
+        """
+        Returns a copy of the committed state, and the journal_seq of the last
+        event it includes. The copy is shallow, but events replace the values
+        they write to instead of modifying them, so it is not affected by
+        later events and can be serialized without holding the lock.
+        """
+        with self._lock:
+            return _StateSnapshot(self), self.journal_seq
+
+    def replay(self, entries):
+        """
+        Replays the events of the journal's commit entries, yielding their
+        results. This must be done before the journal and trigger_target are
+        set, as the events' triggers have already been run and they have
+        already been journaled.
+        """
+        assert self.journal is None and self.trigger_target is None
+        for entry in entries:
+            name, args = entry['event'], entry['args']
+            types = self.event_arg_types.get(name, ())
+            args = [t(a) for t, a in zip(types, args)] + args[len(types) :]
+            res = getattr(self, 'event_' + name)(*args)
+            self.journal_seq = entry['seq']
+            yield res
+
+    @staticmethod
+    def _result_peers(res):
+        """
+        Returns the ids of the peers which res's event wrote to (or which sent
+        its descriptor).
+        """
+        peers = set()
+        for operation, path, value in res.writes:
+            if type(path) is str:
+                path = path.split('.')
+            if path[0] != 'peers':
+                continue
+            if len(path) > 1:
+                peers.add(str(path[1]))
+            elif isinstance(value, dict):
+                peers.update(map(str, value))
+            else:
+                peers.add(str(value))
+        for arg in res.event[1:]:
+            if isinstance(arg, Descriptor):
+                peers.add(str(arg.vk))
+        return sorted(peers)
 
     @Engine.event
     def event_VERIFY_AND_PIN_PEER(self, vk, hostname):
@@ -214,7 +427,7 @@ class OrganizeState(Engine, yamlrepr_hl):
 
     @Engine.event
     def event_RELEASE_GATEWAY(self):
-        cur_gw = list(self.peers.limit(use_as_gateway=True).values())
+        cur_gw = self.peers.gateway_peers
         if cur_gw:
             self.action_EDIT(
                 'SET', ['peers', cur_gw[0].id, 'use_as_gateway'], False
@@ -227,16 +440,65 @@ class OrganizeState(Engine, yamlrepr_hl):
     def action_EDIT(self, operation, path, value):
         getattr(self, '_' + operation)(path, value)
         if path[0] == 'peers':
-            # bug: this doesn't work for the REMOVE operation where there is no
-            # path[1] but the peer remove command calls event_USER_REMOVE_PEER
-            # so that is ok for now
-            self.result.add_triggers(sync_peer=(path[1],))
+            if len(path) == 1:
+                # removing (or setting) a whole peer
+                vk = value if operation == 'REMOVE' else path[-1]
+            else:
+                vk = path[1]
+            self._add_peer_triggers(vk)
         elif path[0] == 'prefs':
             self.result.add_triggers(get_new_system_state=())
-        # FIXME: with more granular actions for peers and prefs, we could
-        # remove this call remove_unknown trigger. but for now, it is still
-        # necessary.
-        self.result.add_triggers(remove_unknown=())
+
+    def _add_peer_triggers(self, vk):
+        """
+        Adds the triggers needed to apply the current event's changes to the
+        peer vk to the system: routes which the peer no longer has (or all of
+        them, if it was removed) are removed, and then the peer is synced.
+        """
+        old = self.peers.get(vk)
+        new = self.next_state['peers'].get(vk)
+        if new is None:
+            if old is not None:
+                self._add_removed_peer_triggers(old)
+            return
+        new = Peer(new)
+        if old is not None:
+            stale = set(map(str, old.routes)) - set(map(str, new.routes))
+            if stale:
+                self.result.add_triggers(remove_routes=(tuple(sorted(stale)),))
+            if old.use_as_gateway and not new.use_as_gateway:
+                self.result.add_triggers(remove_gateway_routes=())
+        self.result.add_triggers(sync_peer=(vk,))
+
+    def _add_removed_peer_triggers(self, peer):
+        self.result.add_triggers(
+            remove_wg_peer=(str(peer.wg_pk),),
+            remove_routes=(tuple(map(str, peer.routes)),),
+        )
+        if peer.use_as_gateway:
+            self.result.add_triggers(remove_gateway_routes=())
+
+    @Engine.event
+    def event_PSK_READY(self, c):
+        """
+        The CSIDH PSK for the CSIDH public key c has been computed. The PSK is
+        not part of the state (it is a secret, derived from our keys and the
+        peer's descriptor), so this only needs to resync the peers using it,
+        which were configured without an endpoint while it was pending.
+        """
+        peers = [
+            peer
+            for peer in self.peers.enabled_peers
+            if str(peer.descriptor.c) == c
+        ]
+        for peer in peers:
+            self.action_SYNC_PEER(peer.id)
+        if not peers:
+            self.action_IGNORE("no enabled peer with this csidh key")
+
+    @Engine.action
+    def action_SYNC_PEER(self, vk):
+        self.result.add_triggers(sync_peer=(vk,))
 
     @Engine.event
     def event_NEW_SYSTEM_STATE(self, new_system_state):
@@ -246,7 +508,7 @@ class OrganizeState(Engine, yamlrepr_hl):
     def action_ADJUST_TO_NEW_SYSTEM_STATE(self, new_system_state):
         # IPv6 analysis: not ipv6 ready
         # Please enhance this function to support ipv6
-        cur_gw = list(self.peers.limit(use_as_gateway=True).values())
+        cur_gw = self.peers.gateway_peers
         cur_gw = cur_gw and cur_gw[0]
         if (
             cur_gw
@@ -258,7 +520,9 @@ class OrganizeState(Engine, yamlrepr_hl):
             # if a non-pinned peer had our gateway IP but no longer does,
             # remove its gateway flag
             self._SET(('peers', cur_gw.id, 'use_as_gateway'), False)
-            self.result.add_triggers(remove_routes=(IPv4_GW_ROUTES,))
+            self.result.add_triggers(
+                remove_gateway_routes=(), sync_peer=(cur_gw.id,)
+            )
         if not (cur_gw and cur_gw.pinned):
             # if there isn't a pinned peer acting as the gateway.
             # FIXME: this could set two peers as the gateway if the system has
@@ -273,7 +537,7 @@ class OrganizeState(Engine, yamlrepr_hl):
                     # multiple default routes, but only one can get
                     # allowedips=/0 so we just take the first one.)
                     break
-        for peer in self.peers.limit(pinned=False).values():
+        for peer in [p for p in self.peers.values() if not p.pinned]:
             if not addrs_in_subnets(
                 peer.enabled_ips, new_system_state.current_subnets
             ):
@@ -331,6 +595,61 @@ class OrganizeState(Engine, yamlrepr_hl):
         else:
             self.action_ACCEPT_NEW_PEER(descriptor)
 
+    @Engine.event
+    def event_INCOMING_DESCRIPTORS(self, descriptors):
+        """
+        Processes a batch of descriptors in one transaction. Each descriptor
+        is processed by an INCOMING_DESCRIPTOR event on a working copy of the
+        state (so that it sees the changes made for the previous ones), and
+        the event's actions, writes and triggers are added to this event's.
+        A descriptor whose event fails is rejected. Duplicate triggers are
+        only run once, and peers which a later descriptor removed are not
+        synced.
+        """
+        state = self._working_copy()
+        state.validation = self.validation
+        for descriptor in descriptors:
+            res = state.event_INCOMING_DESCRIPTOR(descriptor)
+            if not res.ok:
+                self.action_REJECT(descriptor, "error: %s" % (res.error,))
+                continue
+            self.result.actions.extend(res.actions)
+            self.result.triggers.extend(res.triggers)
+            for operation, path, value in res.writes:
+                getattr(self, '_' + operation)(path, value)
+        # each trigger only needs to run once, after the last of the changes
+        # it is for (eg, one sync_peer for a peer updated many times)
+        triggers = list(dict.fromkeys(reversed(self.result.triggers)))
+        peers = self.next_state['peers']
+        self.result.triggers[:] = [
+            (name, args)
+            for name, args in reversed(triggers)
+            if not (name == 'sync_peer' and args[0] not in peers)
+        ]
+
+    # The actions which decide what happens to each descriptor of an
+    # INCOMING_DESCRIPTOR(S) event; each descriptor has exactly one of them.
+    descriptor_outcomes = dict(
+        ACCEPT_NEW_PEER="accepted",
+        UPDATE_PEER_DESCRIPTOR="updated",
+        IGNORE="ignored",
+        REJECT="rejected",
+    )
+
+    @classmethod
+    def descriptor_results(cls, res):
+        """
+        Yields the outcome of each descriptor of an INCOMING_DESCRIPTOR(S)
+        event's result, as an (outcome, reason) tuple.
+        """
+        for action, *args in res.actions:
+            if action not in cls.descriptor_outcomes:
+                continue
+            reason = args[-1] if action in ('IGNORE', 'REJECT') else None
+            if isinstance(reason, (tuple, list)):
+                reason = reason[0]
+            yield cls.descriptor_outcomes[action], reason
+
     @Engine.action
     def action_ACCEPT_NEW_PEER(self, descriptor):
         peer = descriptor.make_peer(
@@ -374,16 +693,7 @@ class OrganizeState(Engine, yamlrepr_hl):
         # IPv6 analysis: not ipv6 ready.
         # Please enhance this function to support ipv6
         self._REMOVE('peers', peer.id)
-        self.result.add_triggers(
-            remove_wg_peer=(str(peer.wg_pk),),
-            remove_routes=(tuple(map(str, peer.routes)),),
-        )
-        if peer.use_as_gateway:
-            # FIXME: this doesn't specify the routing table. maybe need to make
-            # triggers api accept kwargs too?
-            self.result.add_triggers(remove_routes=(IPv4_GW_ROUTES,))
-            # these routes are currently only removed because we still call
-            # sync (aka full repair) on system state change
+        self._add_removed_peer_triggers(peer)
 
     @Engine.action
     def action_REJECT(self, descriptor, reason):
@@ -423,7 +733,7 @@ class OrganizeState(Engine, yamlrepr_hl):
     "--state-file",
     default=_ORGANIZE_CONF_FILE,
     show_default=True,
-    help="YAML state file",
+    help="State file (YAML or JSON; see --state-format)",
 )
 @click.option(
     "-k",
@@ -453,6 +763,171 @@ class OrganizeState(Engine, yamlrepr_hl):
     show_default=True,
     help="path to base directory for organize state",
 )
+@click.option(
+    "--validation",
+    type=click.Choice(['incremental', 'full', 'check']),
+    default='incremental',
+    show_default=True,
+    help="How to validate the state after each event ('check' does both "
+    "and compares them, for debugging)",
+)
+@click.option(
+    "--psk-cache-dir",
+    default=_ORGANIZE_PSK_CACHE_DIR,
+    show_default=True,
+    help="Directory for caching CSIDH PSKs across restarts",
+)
+@click.option(
+    "--netlink-window",
+    type=float,
+    default=Sys.netlink_window,
+    show_default=True,
+    help="Seconds to wait for more netlink events before updating the system "
+    "state",
+)
+@click.option(
+    "--netlink-max-latency",
+    type=float,
+    default=Sys.netlink_max_latency,
+    show_default=True,
+    help="Maximum seconds to postpone a system state update while netlink "
+    "events keep arriving",
+)
+@click.option(
+    "--full-resync-interval",
+    type=float,
+    default=Sys.full_resync_interval,
+    show_default=True,
+    help="Maximum age in seconds of the netlink-updated address and gateway "
+    "model before it is rebuilt from a full dump",
+)
+@click.option(
+    "--descriptor-refresh",
+    type=int,
+    default=43200,
+    show_default=True,
+    help="Seconds after which our descriptors are signed again with a new "
+    "vf, even if they have not changed (they are valid for 86400 seconds)",
+)
+@click.option(
+    "--repair-interval",
+    type=int,
+    default=300,
+    show_default=True,
+    help="Seconds between full repairs (if the auto_repair pref is set)",
+)
+@click.option(
+    "--csidh-tables-file",
+    default=_ORGANIZE_CSIDH_TABLES_FILE,
+    show_default=True,
+    help="File for caching sibc's precomputed CSIDH strategy tables",
+)
+@click.option(
+    "--journal-file",
+    default=_ORGANIZE_JOURNAL_FILE,
+    show_default=True,
+    help="Event journal file (the events after the last snapshot are "
+    "replayed from it when organize starts)",
+)
+@click.option(
+    "--journal-max-bytes",
+    type=int,
+    default=16 * 1024 * 1024,
+    show_default=True,
+    help="Size at which the event journal is rotated",
+)
+@click.option(
+    "--journal-max-age",
+    type=int,
+    default=7 * 86400,
+    show_default=True,
+    help="Age in seconds at which the event journal is rotated",
+)
+@click.option(
+    "--journal-keep",
+    type=int,
+    default=4,
+    show_default=True,
+    help="Number of rotated event journal files to keep",
+)
+@click.option(
+    "--state-format",
+    type=click.Choice(list(yamlfile.file_formats)),
+    default='yaml',
+    show_default=True,
+    help="Format to write the state file in (either can be read, so changing "
+    "it migrates the state file)",
+)
+@click.option(
+    "--snapshot-interval",
+    type=int,
+    default=60,
+    show_default=True,
+    help="Maximum seconds between saving the state file (events after it are "
+    "replayed from the journal when organize starts)",
+)
+@click.option(
+    "--snapshot-events",
+    type=int,
+    default=1000,
+    show_default=True,
+    help="Maximum number of events between saving the state file",
+)
+@click.option(
+    "--flush-delay",
+    type=float,
+    default=1.0,
+    show_default=True,
+    help="Seconds to wait for more changes before writing the hosts file "
+    "(and the state file, when a snapshot is due)",
+)
+@click.option(
+    "--fsync",
+    type=click.Choice(['none', 'state', 'all']),
+    default='state',
+    show_default=True,
+    help="What to sync to disk: state (the state file, and each change to "
+    "the state in the journal before the change is acknowledged), all (also "
+    "the hosts file and the rest of the journal), or none (changes are "
+    "journaled in the background, so a crash or power loss can lose changes "
+    "made since the last snapshot)",
+)
+@click.option(
+    "--signature-cache-size",
+    type=int,
+    default=4096,
+    show_default=True,
+    help="Number of descriptor signature verification results to cache",
+)
+@click.option(
+    "--ingest-delay",
+    type=float,
+    default=0.1,
+    show_default=True,
+    help="Seconds to wait for more descriptors from discover before "
+    "processing them together",
+)
+@click.option(
+    "--ingest-max-batch",
+    type=int,
+    default=256,
+    show_default=True,
+    help="Maximum number of descriptors from discover to process together",
+)
+@click.option(
+    "--verify-workers",
+    type=int,
+    default=4,
+    show_default=True,
+    help="Number of threads for parsing and verifying imported descriptors",
+)
+@click.option(
+    "--csidh-workers",
+    type=int,
+    default=2,
+    show_default=True,
+    help="Number of processes for computing CSIDH PSKs",
+)
 @click.pass_context
 class Organize(attrdict):
     """
@@ -480,6 +955,9 @@ class Organize(attrdict):
             <arg type='b' name='interactive' direction='in'/>
             <arg type='s' name='response' direction='out'/>
         </method>
+        <method name='stats'>
+          <arg type='s' name='response' direction='out'/>
+        </method>
       </interface>
       <interface name='local.vula.organize1.Peers'>
         <method name='show_peer'>
@@ -494,6 +972,12 @@ class Organize(attrdict):
           <arg type='s' name='which' direction='in'/>
           <arg type='as' name='response' direction='out'/>
         </method>
+        <method name='list_peers'>
+          <arg type='s' name='which' direction='in'/>
+          <arg type='as' name='queries' direction='in'/>
+          <arg type='as' name='fields' direction='in'/>
+          <arg type='s' name='response' direction='out'/>
+        </method>
         <method name='rediscover'>
           <arg type='s' name='response' direction='out'/>
         </method>
@@ -535,6 +1019,10 @@ class Organize(attrdict):
           <arg type='s' name='descriptor' direction='in'/>
           <arg type='s' name='response' direction='out'/>
         </method>
+        <method name='process_descriptor_strings'>
+          <arg type='as' name='descriptors' direction='in'/>
+          <arg type='s' name='response' direction='out'/>
+        </method>
       </interface>
       <interface name='local.vula.organize1.Prefs'>
         <method name='show_prefs'>
@@ -566,34 +1054,99 @@ class Organize(attrdict):
         self.update(**kw)
         self.log: Logger = getLogger()
         self.log.debug("Debug level logging enabled")
-        self._configure = Configure(keys_conf_file=self.keys_file)
-        self._csidh_dh = None
+        self._configure = Configure(
+            keys_conf_file=self.keys_file, psk_cache_dir=self.psk_cache_dir
+        )
+        self._csidh = None
+        self._main_loop = None
         self._keys = self._configure.generate_or_read_keys()
         self.sys = Sys(self)
+        self.sys.netlink_window = self.netlink_window
+        self.sys.netlink_max_latency = self.netlink_max_latency
+        self.sys.full_resync_interval = self.full_resync_interval
+        self._journal = Journal(
+            self.journal_file,
+            max_bytes=self.journal_max_bytes,
+            max_age=self.journal_max_age,
+            keep=self.journal_keep,
+            fsync=self.fsync == 'all',
+        )
+        self._flusher = Flusher(self._flush, max_delay=self.flush_delay)
         self._state: OrganizeState = self._load_state()
+        self._snapshot_time = time.monotonic()
+        self._snapshot_seq = self._state.journal_seq
+        self._state.journal = self._journal
+        self._state.sync_commits = self.fsync != 'none'
         self._state.trigger_target = self.sys
-        self._state.save = self.save
+        self._state.validation = self.validation
+        self._state.save = self._committed
         self._state.debug_log = self.log.debug
         self._latest_descriptors = {}
+        self._signed_descriptors = {}
+        self._last_vf = 0
+        self._listening = None
+        self._publish_metrics = Metrics()
+        self._hosts = None
+        self._signatures = LRUCache(self.signature_cache_size)
+        self._signatures_lock = Lock()
+        self._verifier = None
+        self._ingest_queue = deque()
+        self._ingester = Flusher(
+            self._ingest, max_delay=self.ingest_delay, name="ingest"
+        )
+        self._ingester.metrics.gauge(
+            'queue_depth', lambda: len(self._ingest_queue)
+        )
+        self._descriptor_metrics = Metrics()
+        self._descriptor_metrics.gauge(
+            'signature_cache_hit_rate', self._signature_cache_hit_rate
+        )
 
         if ctx.invoked_subcommand is None:
             self.run(monolithic=False)
 
+    @property
+    def csidh(self):
+        if self._csidh is None:
+            self._csidh = CsidhPool(
+                self._keys.pq_csidhP512_sec_key,
+                callback=self._psk_ready,
+                workers=self.csidh_workers,
+                tables_file=self.csidh_tables_file,
+                cache=PskCache(
+                    self.psk_cache_dir,
+                    self._keys.pq_csidhP512_sec_key,
+                    self._keys.pq_csidhP512_pub_key,
+                ),
+            )
+        return self._csidh
+
     def csidh_dh(self, pk):
-        if self._csidh_dh is None:
-            self.log.debug("Initializing CSIDH")
-            csidh = CSIDH(**csidh_parameters)
-            sk = self._keys.pq_csidhP512_sec_key
+        "Returns the CSIDH PSK for pk, blocking until it has been computed"
+        return self.csidh.dh(pk)
 
-            @memoize
-            def _csidh_dh(pk):
-                self.log.debug("Generating CSIDH PSK for pk {}".format(pk))
-                return csidh.dh(sk, pk)
+    def csidh_psk(self, pk, submit=True):
+        """
+        Returns the CSIDH PSK for pk if it has been computed already, or else
+        None (after submitting it to be computed, unless submit is False). A
+        PSK_READY event will occur when the computation is finished.
+        """
+        return self.csidh.psk(pk, submit=submit)
+
+    def _psk_ready(self, pk):
+        """
+        Called in the CSIDH pool's callback thread when the PSK for pk has
+        been computed. The PSK_READY event (and its triggers) are run in the
+        main loop, if there is one.
+        """
+        if self._main_loop is None:
+            self.state.event_PSK_READY(pk)
+        else:
+            GLib.idle_add(self._psk_ready_idle, pk)
 
-            self._csidh_dh = _csidh_dh
-        raw_key = self._csidh_dh(pk)
-        psk = hkdf(raw_key)
-        return psk
+    def _psk_ready_idle(self, pk):
+        self.state.event_PSK_READY(pk)
+        return False  # (so that it is only called once)
 
     @property
     def our_wg_pk(self):
@@ -602,25 +1155,58 @@ class Organize(attrdict):
     def our_latest_descriptors(self):
         return repr(jsonrepr(self._latest_descriptors))
 
+    def _service_descriptor_fields(self, ip_addrs: str) -> dict:
+        "Returns the fields of our descriptor for ip_addrs, except its vf"
+        return {
+            "pk": self._keys.wg_Curve25519_pub_key,
+            "c": self._keys.pq_csidhP512_pub_key,
+            "addrs": ip_addrs,
+            "vk": self._keys.vk_Ed25519_pub_key,
+            "dt": "86400",
+            "port": str(self.port),
+            "hostname": node() + _DOMAIN,
+            "r": '',
+            "e": False,
+        }
+
     def _construct_service_descriptor(
         self, ip_addrs: str, vf: int
     ) -> Descriptor:
         self.log.info("Constructing service descriptor id: %s", vf)
         return Descriptor(
-            {
-                "pk": self._keys.wg_Curve25519_pub_key,
-                "c": self._keys.pq_csidhP512_pub_key,
-                "addrs": ip_addrs,
-                "vk": self._keys.vk_Ed25519_pub_key,
-                "vf": vf,
-                "dt": "86400",
-                "port": str(self.port),
-                "hostname": node() + _DOMAIN,
-                "r": '',
-                "e": False,
-            }
+            dict(self._service_descriptor_fields(ip_addrs), vf=vf)
         ).sign(self._keys.vk_Ed25519_sec_key)
 
+    def _service_descriptor(self, ip_addrs: str) -> dict:
+        """
+        Returns our signed descriptor for ip_addrs, as a dict of strings.
+
+        The last one signed for ip_addrs is reused while its other fields
+        are unchanged, until it is descriptor_refresh seconds old. A new
+        one's vf is always greater than the last one's, so that peers do
+        not ignore it as a replay.
+        """
+        fields = self._service_descriptor_fields(ip_addrs)
+        last = self._signed_descriptors.get(ip_addrs)
+        now = int(time.time())
+        if (
+            last is not None
+            and last[0] == fields
+            and now - int(last[1]['vf']) < self.descriptor_refresh
+        ):
+            self._publish_metrics.count('signatures_reused')
+            return last[1]
+        self._last_vf = vf = max(now, self._last_vf + 1)
+        desc = {
+            k: str(v)
+            for k, v in self._construct_service_descriptor(ip_addrs, vf)
+            ._dict()
+            .items()
+        }
+        self._signed_descriptors[ip_addrs] = (fields, desc)
+        self._publish_metrics.count('signatures')
+        return desc
+
     @DualUse.method()
     def get_new_system_state(self):
         old_state = self.state.system_state.copy()
@@ -631,24 +1217,27 @@ class Organize(attrdict):
         if old_state == new_system_state:
             self.log.info("system state unchanged")
         else:
-            # FIXME: ensure that triggers do everything necessary, and then
-            # remove this full repair sync call here:
-            self.sync()
             self._instruct_zeroconf()
         return res
 
     def _load_state(self):
         """
-        Deserializes the state object from disk and returns it
+        Deserializes the state object from disk and returns it, after
+        replaying the events which were journaled after it was saved.
         """
         self.log.debug("Loading state file")
+        seq = None
         try:
-            state = OrganizeState.from_yaml_file(self.state_file)
+            state, header, self._state_file_format = OrganizeState.read_file(
+                self.state_file
+            )
+            seq = header.get('journal_seq')
             self.log.debug("Loaded state with %s peers" % (len(state.peers),))
         except Exception as ex:
             self.log.info("Couldn't load state file: %r", ex)
 
             state = OrganizeState()
+            self._state_file_format = None
 
             if os.path.exists(self.state_file):
                 self.log.info(
@@ -659,12 +1248,39 @@ class Organize(attrdict):
                 )
             self.log.debug("Created new OrganizeState")
 
+        if seq is None:
+            # the state file predates the journal (or doesn't exist), so which
+            # of the journal's events it includes is unknown
+            state.journal_seq = self._journal.last('seq') or 0
+        else:
+            state.journal_seq = seq
+            self._replay_journal(state)
+
         if state.event_log:
             self.log.info(
-                "event_log contains %s entries" % (len(state.event_log),)
+                "event_log contains %s entries (events are now recorded in "
+                "the journal instead)" % (len(state.event_log),)
             )
         return state
 
+    def _replay_journal(self, state):
+        start = time.monotonic()
+        entries = list(self._journal.tail('seq', state.journal_seq))
+        if entries and entries[0]['seq'] != state.journal_seq + 1:
+            self.log.warning(
+                "Events %s to %s are missing from the journal",
+                state.journal_seq + 1,
+                entries[0]['seq'] - 1,
+            )
+        errors = sum(not res.ok for res in state.replay(entries))
+        if entries:
+            self.log.info(
+                "Replayed %s events (%s errors) from the journal in %.3fs",
+                len(entries),
+                errors,
+                time.monotonic() - start,
+            )
+
     @property
     def state(self):
         return self._state
@@ -678,17 +1294,25 @@ class Organize(attrdict):
         return self._state.prefs
 
     @DualUse.method()
-    def _write_hosts_file(self):
+    def _write_hosts_file(self, peers=None):
         """
         Write the hosts file
+
+        It is only rewritten when a name or address has changed since it was
+        last written.
         """
+        if peers is None:
+            peers = self.peers
         hosts_file: str = _ORGANIZE_HOSTS_FILE
         hosts = {
             name: list(peer.descriptor.addrs)[0]
             # XXX make this use the "best ip" logic
-            for peer in self.peers.limit(enabled=True).values()
+            for peer in peers.enabled_peers
             for name in peer.enabled_names
         }
+        if hosts == self._hosts:
+            self._flusher.metrics.count('hosts_unchanged')
+            return False
         Path(hosts_file).touch(mode=0o644)
         with click.open_file(
             hosts_file, mode='w', encoding='utf-8', atomic=True
@@ -697,19 +1321,78 @@ class Organize(attrdict):
                 "\n".join("%s %s" % (ip, host) for host, ip in hosts.items())
                 + "\n"
             )
+            if self.fsync == 'all':
+                fh.flush()
+                os.fsync(fh.fileno())
         chown_like_dir_if_root(hosts_file)
+        self._hosts = hosts
+        self._flusher.metrics.count('hosts_written')
         return True
 
     @DualUse.method()
     def save(self):
         """
-        Save state to disk
+        Save a snapshot of the state to disk
 
         (should be no-op if run from commandline in a new organize instance)
         """
-        self.state.write_yaml_file(self.state_file, mode=0o600, autochown=True)
-        self.log.info("vula state file updated: %i peers", len(self.peers))
-        self._write_hosts_file()
+        state, seq = self.state.snapshot()
+        self._write_snapshot(state, seq)
+        self._write_hosts_file(state['peers'])
+
+    def _shutdown(self):
+        """
+        Processes the queued descriptors, writes any unsaved changes, and
+        stops the ingest, verifier, flusher, and journal threads and the CSIDH
+        worker processes.
+        """
+        self._ingester.stop()
+        # each call processes at most ingest_max_batch of them
+        while self._ingest_queue:
+            self._ingest()
+        if self._verifier is not None:
+            self._verifier.shutdown()
+        if self._csidh is not None:
+            self._csidh.shutdown(wait=True)
+        self._flusher.stop()
+        if self.state.journal_seq != self._snapshot_seq:
+            self.save()
+        self._journal.close()
+
+    def _committed(self):
+        """
+        Called by the state engine, with its lock held, after each event which
+        changed the state (and was appended to the journal). The changes are
+        written by the flusher's thread, after up to flush_delay seconds.
+        """
+        self._flusher.mark_dirty()
+
+    def _flush(self):
+        """
+        Writes the hosts file, and a snapshot if the last one is older than
+        snapshot_interval or snapshot_events events.
+        """
+        state, seq = self.state.snapshot()
+        if (
+            time.monotonic() - self._snapshot_time >= self.snapshot_interval
+            or seq - self._snapshot_seq >= self.snapshot_events
+        ):
+            self._write_snapshot(state, seq)
+        self._write_hosts_file(state['peers'])
+
+    def _write_snapshot(self, state, seq):
+        getattr(state, 'write_%s_file' % (self.state_format,))(
+            self.state_file,
+            mode=0o600,
+            autochown=True,
+            fsync=self.fsync != 'none',
+            header=dict(journal_seq=seq),
+        )
+        self._state_file_format = self.state_format
+        self._snapshot_time = time.monotonic()
+        self._snapshot_seq = seq
+        self._flusher.metrics.count('snapshots')
+        self.log.info("vula state file updated: %i peers", len(state['peers']))
 
     @DualUse.method()
     def verify_and_pin_peer(self, vk, hostname):
@@ -730,14 +1413,13 @@ class Organize(attrdict):
         res = []
         res += self.sys.sync_interface(dryrun=dryrun)
         res += self.sys.sync_iprules(dryrun=dryrun)
-        for peer in self.peers.values():
-            self.log.debug("syncing peer %s", peer.name_and_id)
-            try:
-                peer_res = self.sys.sync_peer(peer.id, dryrun)
-            except Exception as ex:
-                peer_res = repr(ex)
-            res.append(peer_res)
-        res += self.sys.remove_unknown(dryrun=dryrun)
+        # dump the wg peers and routes once, rather than once per peer
+        with self.sys.snapshot():
+            # disabled peers are removed by remove_unknown, below
+            res += self.sys.sync_peers(
+                [peer.id for peer in self.peers.enabled_peers], dryrun
+            )
+            res += self.sys.remove_unknown(dryrun=dryrun)
         res = list(filter(None, res))
         if res and not firstrun:
             pass
@@ -754,7 +1436,8 @@ class Organize(attrdict):
 
     @DualUse.method()
     def rediscover(self):
-        self.discover.listen([])
+        self.discover.listen([], {})
+        self._listening = None
         self._instruct_zeroconf()
         return ",".join(map(str, self.state.system_state.current_ips))
 
@@ -789,64 +1472,133 @@ class Organize(attrdict):
         if not no_dbus:
             system_bus = pydbus.SystemBus()
             system_bus.publish(_ORGANIZE_DBUS_NAME, self)
-            main_loop = GLib.MainLoop()
+            main_loop = self._main_loop = GLib.MainLoop()
 
         if monolithic or no_dbus:
             self.discover = Discover()
-            self.discover.callbacks.append(self.process_descriptor)
+            self.discover.callbacks.append(self.ingest_descriptor)
             self.publish = Publish()
         else:
             self.discover = system_bus.get(
                 _DISCOVER_DBUS_NAME, _DISCOVER_DBUS_PATH
             )
+            system_bus.subscribe(
+                sender=_DISCOVER_DBUS_NAME,
+                iface='local.vula.discover1.Descriptors',
+                signal='Descriptors',
+                signal_fired=self._discovered,
+            )
             self.publish = system_bus.get(
                 _PUBLISH_DBUS_NAME, _PUBLISH_DBUS_PATH
             )
 
+        self.csidh.warm()
+
+        if self._state_file_format not in (None, self.state_format):
+            self.log.info(
+                "Migrating the state file from %s to %s",
+                self._state_file_format,
+                self.state_format,
+            )
+            self.save()
+
         # remove old listener, if there is one
-        self.discover.listen([])
+        self.discover.listen([], {})
 
-        self.get_new_system_state()
+        # subscribe to netlink events before reading the system state, so
+        # that no change is missed between the two
         self.sys.start_monitor()
+        self.get_new_system_state()
         self._instruct_zeroconf()
         self.sync()
 
         if not no_dbus:
+            GLib.timeout_add_seconds(self.repair_interval, self._auto_repair)
+            GLib.timeout_add_seconds(
+                max(1, self.descriptor_refresh // 10),
+                self._refresh_descriptors,
+            )
             self.log.info("calling GLib.MainLoop().run()")
-            main_loop.run()
+            GLib.unix_signal_add(
+                GLib.PRIORITY_HIGH, signal.SIGTERM, self._sigterm, main_loop
+            )
+            try:
+                main_loop.run()
+            finally:
+                self._shutdown()
 
-    def _instruct_zeroconf(self):
+    def _sigterm(self, main_loop):
+        self.log.info("Received SIGTERM; saving state and exiting")
+        main_loop.quit()
+        return False
+
+    def _auto_repair(self):
+        """
+        Called periodically from the main loop. Changes are applied to the
+        system by the triggers of each event, so this normally finds nothing
+        to do; anything it does repair is logged.
+        """
+        if self.prefs.auto_repair:
+            res = self.sync()
+            if res:
+                self.log.info("auto repair: %s", res)
+        return True
 
+    def _instruct_zeroconf(self):
+        """
+        Tells discover which IPs to listen on, and publish which descriptors
+        to announce on them. Neither is called again if what it would be
+        told has not changed, so that peers are only sent a new announcement
+        (and re-verify it) when our descriptor has changed or been
+        refreshed.
+        """
         descriptors = {}
-        vf: int = int(time.time())
+        signed = {}
         for net, ips in self.state.system_state.current_subnets.items():
-            desc = {
-                k: str(v)
-                for k, v in self._construct_service_descriptor(
-                    ",".join(str(ip) for ip in ips), vf
-                )
-                ._dict()
-                .items()
-            }
+            ip_addrs = ",".join(str(ip) for ip in ips)
+            desc = self._service_descriptor(ip_addrs)
+            signed[ip_addrs] = self._signed_descriptors[ip_addrs]
             for ip in ips:
                 descriptors[str(ip)] = desc
+        # forget the descriptors for addresses we no longer have
+        self._signed_descriptors = signed
         current_ips = list(map(str, self.state.system_state.current_ips))
+        filters = dict(
+            pk=[str(self.state.system_state.our_wg_pk)],
+            subnets=list(map(str, self.state.system_state.current_subnets)),
+            domains=list(self.prefs.local_domains),
+        )
+        if (current_ips, filters) != self._listening:
+            self.log.info("discovering on %s", current_ips)
+            self.discover.listen(current_ips, filters)
+            self._listening = (current_ips, filters)
+        if descriptors == self._latest_descriptors:
+            self.log.debug("Our descriptors are unchanged")
+            self._publish_metrics.count('publishes_skipped')
+            return
         self.log.info(
-            "discovering on {ips} and publishing {pub}".format(
-                ips=current_ips,
+            "publishing {pub}".format(
                 pub='on same'
                 if list(descriptors.keys()) == current_ips
                 else descriptors,
             )
         )
-        self.discover.listen(current_ips)
         self.publish.listen(descriptors)
+        self._publish_metrics.count('publishes')
         self._latest_descriptors = descriptors
         self.log.info("Current IP(s): {}".format(current_ips))
         self.log.info(
             "Current descriptors: {}".format(self._latest_descriptors)
         )
 
+    def _refresh_descriptors(self):
+        """
+        Called periodically from the main loop, to re-sign and publish our
+        descriptors when they are older than descriptor_refresh.
+        """
+        self._instruct_zeroconf()
+        return True
+
     @DualUse.method(opts=(click.argument('query', type=str),))
     def show_peer(self, query):
         """
@@ -859,6 +1611,76 @@ class Organize(attrdict):
             else "No peer matched query %r" % (query,)
         )
 
+    @DualUse.method(
+        opts=(
+            click.option(
+                '-w',
+                '--which',
+                type=click.Choice(['all', 'enabled', 'disabled']),
+                default='enabled',
+            ),
+            click.option(
+                '-f',
+                '--field',
+                'fields',
+                type=click.Choice(Peer.summary_fields),
+                multiple=True,
+                help="Field to include (default: all of them)",
+            ),
+            click.argument('queries', nargs=-1),
+        )
+    )
+    def list_peers(self, which='enabled', queries=(), fields=()):
+        """
+        Returns a JSON list of the summaries of peers, with their wireguard
+        stats.
+
+        which selects all, enabled, or disabled peers, and queries (vks,
+        hostnames or IPs) limit the list to the peers they match, in order.
+        If fields are given, each summary has only those fields (which are
+        the only ones computed), and the wireguard stats are only fetched if
+        the stats field is one of them. Unknown fields raise ValueError.
+        """
+        fields = list(fields)
+        unknown = [f for f in fields if f not in Peer.summary_fields]
+        if unknown:
+            raise ValueError(
+                "Unknown peer field(s) %s; the fields are: %s"
+                % (
+                    ", ".join(map(repr, unknown)),
+                    ", ".join(Peer.summary_fields),
+                )
+            )
+        if which == 'all':
+            candidates = list(self.peers.values())
+        else:
+            assert which in ('enabled', 'disabled'), which
+            candidates = [
+                peer
+                for peer in self.peers.values()
+                if bool(peer.enabled) == (which == 'enabled')
+            ]
+        if queries:
+            ids = set(peer.id for peer in candidates)
+            matches = (self.peers.query(query) for query in queries)
+            candidates = list(
+                {
+                    peer.id: peer
+                    for peer in matches
+                    if peer and peer.id in ids
+                }.values()
+            )
+        if not fields or 'stats' in fields:
+            stats = self.sys.get_stats()
+        else:
+            stats = {}
+        return json.dumps(
+            [
+                peer.summary(stats.get(str(peer.descriptor.pk)), fields)
+                for peer in candidates
+            ]
+        )
+
     @DualUse.method(opts=(click.argument('query', type=str),))
     def peer_descriptor(self, query):
         """
@@ -890,11 +1712,25 @@ class Organize(attrdict):
 
     def process_descriptor(self: Organize, descriptor: Descriptor):
 
-        if not descriptor.verify_signature():
+        # zeroconf delivers the same descriptor repeatedly, so drop the ones
+        # the engine would ignore as replays before verifying them.
+        if self._is_replay(descriptor):
+            return str(
+                yamlrepr(
+                    Result(
+                        event=('INCOMING_DESCRIPTOR', descriptor),
+                        actions=[('IGNORE', descriptor, "replay")],
+                        writes=[],
+                    )
+                )
+            )
+
+        if not self._verify_signature(descriptor):
             self.log.info(
                 "Discarded descriptor with invalid signature: %r"
                 % (descriptor,)
             )
+            self._descriptor_metrics.count('invalid_signatures')
             return
 
         res = self.state.event_INCOMING_DESCRIPTOR(descriptor)
@@ -904,18 +1740,169 @@ class Organize(attrdict):
         #    self.sync()
         return str(yamlrepr(res))
 
+    def process_descriptor_strings(self: Organize, descriptors: list):
+        """
+        Processes many descriptors at once: they are parsed and verified in
+        parallel, and then the valid ones are processed in one
+        INCOMING_DESCRIPTORS event. Returns a line with the outcome for each
+        descriptor.
+        """
+        return "\n".join(
+            "%s: %s" % (n, status)
+            for n, status in enumerate(
+                self._process_descriptors(descriptors), 1
+            )
+        )
+
+    def _process_descriptors(self: Organize, descriptors: list) -> list:
+        """
+        Processes a batch of descriptors (or descriptor strings) in one
+        INCOMING_DESCRIPTORS event, and returns the outcome for each.
+        """
+        if self._verifier is None:
+            self._verifier = ThreadPoolExecutor(
+                max_workers=self.verify_workers, thread_name_prefix='verify'
+            )
+        checked = list(self._verifier.map(self._check_descriptor, descriptors))
+        valid = [d for d in checked if isinstance(d, Descriptor)]
+        if valid:
+            res = self.state.event_INCOMING_DESCRIPTORS(valid)
+            results = self.state.descriptor_results(res)
+        statuses = []
+        for descriptor in checked:
+            if not isinstance(descriptor, Descriptor):
+                status = descriptor
+            elif not res.ok:
+                status = "error: %s" % (res.error,)
+            else:
+                outcome, reason = next(results)
+                status = "%s %s" % (outcome, descriptor.hostname)
+                if reason:
+                    status += " (%s)" % (reason,)
+            statuses.append(status)
+        return statuses
+
+    def _check_descriptor(self: Organize, descriptor):
+        """
+        Returns the descriptor (parsed, if it is a string) if it has a valid
+        signature and is not a replay, and otherwise a string saying why it
+        is not.
+        """
+        if not isinstance(descriptor, Descriptor):
+            try:
+                descriptor = Descriptor.parse(descriptor)
+            except Exception as ex:
+                return "unparseable descriptor (%s)" % (ex,)
+            if descriptor is None:
+                return "unparseable descriptor"
+        if self._is_replay(descriptor):
+            return "ignored %s (replay)" % (descriptor.hostname,)
+        if not self._verify_signature(descriptor):
+            self._descriptor_metrics.count('invalid_signatures')
+            return "invalid signature"
+        return descriptor
+
+    def ingest_descriptor(self: Organize, descriptor):
+        """
+        Queues a descriptor (or descriptor string) from discover to be
+        processed with the others which arrive within ingest_delay seconds,
+        in one INCOMING_DESCRIPTORS event.
+        """
+        self._ingest_queue.append(descriptor)
+        self._ingester.mark_dirty()
+
+    def _discovered(self: Organize, sender, path, iface, signal, args):
+        """
+        Handles discover's Descriptors signal, by queueing its descriptors.
+        """
+        for descriptor in args[0]:
+            self.ingest_descriptor(descriptor)
+
+    def _ingest(self: Organize):
+        """
+        Processes up to ingest_max_batch queued descriptors. Called from the
+        ingester's thread.
+        """
+        queue = self._ingest_queue
+        batch = [
+            queue.popleft()
+            for _ in range(min(len(queue), self.ingest_max_batch))
+        ]
+        try:
+            statuses = self._process_descriptors(batch)
+        except Exception as ex:
+            # so that one bad descriptor does not lose the whole batch
+            self._ingester.metrics.count('batch_errors')
+            self.log.error(
+                "Ingesting %s descriptors failed (%r); retrying them one at "
+                "a time",
+                len(batch),
+                ex,
+            )
+            statuses = [self._process_descriptor(d) for d in batch]
+        self._ingester.metrics.count('descriptors', len(batch))
+        self.log.debug("Ingested %s descriptors: %r", len(batch), statuses)
+        if queue:
+            self._ingester.mark_dirty()
+
+    def _process_descriptor(self: Organize, descriptor) -> str:
+        """
+        Processes one descriptor (in its own INCOMING_DESCRIPTORS event), and
+        returns its outcome, which is an error if it raised an exception.
+        """
+        try:
+            return self._process_descriptors([descriptor])[0]
+        except Exception as ex:
+            self._ingester.metrics.count('errors')
+            self.log.error("Unable to process descriptor: %r", ex)
+            return "error: %r" % (ex,)
+
+    def _is_replay(self: Organize, descriptor: Descriptor) -> bool:
+        """
+        Returns True if descriptor would be ignored by the engine as a replay
+        (which is checked before its signature is verified).
+        """
+        existing_peer = self.peers.get(str(descriptor.vk))
+        if existing_peer and descriptor.vf <= existing_peer.descriptor.vf:
+            self._descriptor_metrics.count('replays_dropped')
+            return True
+        return False
+
+    def _verify_signature(self: Organize, descriptor: Descriptor) -> bool:
+        """
+        Returns descriptor.verify_signature(), which is cached for the
+        descriptor's signed bytes and signature.
+        """
+        key = (descriptor._build_sig_buf(), bytes(descriptor.s))
+        with self._signatures_lock:
+            valid = self._signatures.get(key)
+        if valid is not None:
+            self._descriptor_metrics.count('signature_cache_hits')
+            return valid
+        self._descriptor_metrics.count('signature_cache_misses')
+        valid = descriptor.verify_signature()
+        with self._signatures_lock:
+            self._signatures[key] = valid
+        return valid
+
+    def _signature_cache_hit_rate(self):
+        counters = self._descriptor_metrics.counters
+        hits = counters.get('signature_cache_hits', 0)
+        total = hits + counters.get('signature_cache_misses', 0)
+        return round(hits / total, 3) if total else None
+
     def get_vk_by_name(self, hostname):
         return self.peers.with_hostname(hostname).id
 
     def peer_ids(self, which):
-        peers = self.peers
-        if which == 'disabled':
-            peers = peers.limit(enabled=False)
-        elif which == 'enabled':
-            peers = peers.limit(enabled=True)
-        else:
-            assert which == 'all'
-        return list(peers.keys())
+        if which == 'all':
+            return list(self.peers)
+        assert which in ('enabled', 'disabled')
+        return [
+            vk
+            for vk, peer in self.peers.items()
+            if bool(peer.enabled) == (which == 'enabled')
+        ]
 
     def dump_state(self, interactive, dbus_context):
         if dbus_context.is_authorized(
@@ -937,6 +1924,22 @@ class Organize(attrdict):
         else:
             return "Forbidden"
 
+    @DualUse.method()
+    def stats(self):
+        """
+        Print performance counters
+        """
+        stats = {
+            'sys': self.sys.metrics.snapshot(),
+            'persistence': self._flusher.metrics.snapshot(),
+            'descriptors': self._descriptor_metrics.snapshot(),
+            'ingest': self._ingester.metrics.snapshot(),
+            'publish': self._publish_metrics.snapshot(),
+        }
+        if self._csidh is not None:
+            stats['csidh'] = self._csidh.metrics.snapshot()
+        return str(yamlrepr(stats))
+
     def set_peer(self, vk, path, value):
         res = self.state.event_USER_EDIT('SET', ['peers', vk] + path, value)
         return str(jsonrepr(res))
@@ -969,17 +1972,74 @@ class Organize(attrdict):
         )
 
     @DualUse.method()
-    def eventlog(self):
-        return "\n".join(
-            "{event}: {actions} {writes} {triggers}".format(
-                event=result.event[0],
-                actions=[action[0] for action in result.actions],
-                writes=[write[0] for write in result.writes],
-                triggers=[trigger[0] for trigger in result.triggers],
-            )
-            for result in map(Result, self.state.event_log)
+    @click.option(
+        '-a',
+        '--all',
+        'from_start',
+        is_flag=True,
+        help="Replay the whole journal onto an empty state, instead of the "
+        "events after the state file's snapshot onto it",
+    )
+    def replay(self, from_start=False):
+        """
+        Replay the journal offline and report the events per second
+        """
+        if from_start:
+            state = OrganizeState()
+            entries = list(self._journal.read(kind='commit'))
+        else:
+            state, header, _ = OrganizeState.read_file(self.state_file)
+            seq = header.get('journal_seq') or 0
+            entries = list(self._journal.tail('seq', seq))
+        state.validation = self.validation
+        start = time.monotonic()
+        errors = sum(not res.ok for res in state.replay(entries))
+        elapsed = time.monotonic() - start
+        return "replayed %s events (%s errors) in %.3fs: %.1f events/s" % (
+            len(entries),
+            errors,
+            elapsed,
+            len(entries) / elapsed if elapsed else 0,
         )
 
+    @DualUse.method()
+    @click.option(
+        '--since', type=click.DateTime(), help="Only show events since then"
+    )
+    @click.option(
+        '--until', type=click.DateTime(), help="Only show events until then"
+    )
+    @click.option('--peer', help="Only show events concerning this peer id")
+    @click.option('--event', help="Only show events of this type")
+    def eventlog(self, since=None, until=None, peer=None, event=None):
+        """
+        Show the events recorded in the journal
+        """
+        filters = dict(kind='result')
+        if peer is not None:
+            filters['peers'] = peer
+        if event is not None:
+            filters['event'] = event
+        lines = []
+        for entry in self._journal.read(
+            since=since and since.timestamp(),
+            until=until and until.timestamp(),
+            **filters,
+        ):
+            result = Result(entry['result'])
+            lines.append(
+                "{time} {event}: {actions} {writes} {triggers}".format(
+                    time=time.strftime(
+                        _DATE_FMT, time.localtime(entry['time'])
+                    ),
+                    event=result.event[0],
+                    actions=[action[0] for action in result.actions],
+                    writes=[write[0] for write in result.writes],
+                    triggers=[trigger[0] for trigger in result.triggers],
+                )
+            )
+        return "\n".join(lines)
+
 
 Organize.cli.add_command(PeerCommands.cli, name='peer')
 
@@ -12,6 +12,7 @@ from .notclick import shell_complete_helper
 from ipaddress import (
     IPv4Address,
     IPv6Address,
+    ip_address,
     ip_network,
 )
 from nacl.signing import SigningKey, VerifyKey
@@ -43,7 +44,6 @@ from .common import (
     int_range,
     Flexibool,
     yamlrepr,
-    yamlrepr_hl,
     queryable,
     schemadict,
     Length,
@@ -598,76 +598,151 @@ class Peer(schemattrdict):
         return "%s:%s" % (self.endpoint_addr, self.descriptor.port)
 
     def wg_config(self: Peer, csidh_psk):
-        return attrdict(
+        """
+        Returns the peer's wireguard configuration. If csidh_psk is None
+        (because it has not been computed yet) the endpoint is omitted, so that
+        packets to the peer are dropped rather than sent without the PSK.
+        """
+        config = attrdict(
             public_key=str(self.descriptor.pk),
-            endpoint_addr=str(self.endpoint_addr),
-            endpoint_port=self.descriptor.port,
             allowed_ips=list(map(str, self.allowed_ips)),
-            preshared_key=csidh_psk,
         )
+        if csidh_psk is not None:
+            config.update(
+                endpoint_addr=str(self.endpoint_addr),
+                endpoint_port=self.descriptor.port,
+                preshared_key=csidh_psk,
+            )
+        return config
+
+    # The fields of a summary, and how each is computed from the peer and its
+    # wireguard stats
+    _summary_getters = dict(
+        name=lambda peer, stats: peer.name,
+        id=lambda peer, stats: peer.id,
+        other_names=lambda peer, stats: peer.other_names,
+        enabled=lambda peer, stats: bool(peer.enabled),
+        pinned=lambda peer, stats: bool(peer.pinned),
+        verified=lambda peer, stats: bool(peer.verified),
+        use_as_gateway=lambda peer, stats: bool(peer.use_as_gateway),
+        endpoint=lambda peer, stats: peer.endpoint,
+        allowed_ips=lambda peer, stats: [str(net) for net in peer.allowed_ips],
+        disabled_ips=lambda peer, stats: [str(ip) for ip in peer.disabled_ips],
+        latest_signature=lambda peer, stats: peer.descriptor.vf,
+        wg_pubkey=lambda peer, stats: str(peer.descriptor.pk),
+        stats=lambda peer, stats: dict(stats) if stats else None,
+    )
+    summary_fields = tuple(_summary_getters)
+
+    def summary(self, stats=None, fields=None):
+        """
+        Returns the peer's status as a dict of plain (JSON-serializable)
+        values. stats are its wireguard stats, or None if wireguard does not
+        have the peer. If fields are given, only they are computed and
+        returned (they must be in summary_fields).
+        """
+        return {
+            field: self._summary_getters[field](self, stats)
+            for field in (fields or self.summary_fields)
+        }
 
     def show(self, stats=None):
-        green_or_yellow = (
-            green if self.pinned and self.verified and self.enabled else yellow
-        )
-        return "\n  ".join(
-            bold(label) + ': ' + str(value) if label else str(value)
-            for label, value in {
-                green_or_yellow('peer'): green_or_yellow(self.name),
-                'id': self.id,
-                red('warning'): (
-                    None if stats else red('wireguard peer is not configured')
-                ),
-                'other names': ", ".join(self.other_names),
-                'status': " ".join(
-                    filter(
-                        None,
-                        [
-                            (red("disabled"), green("enabled"))[self.enabled],
-                            (yellow("unpinned"), green("pinned"))[self.pinned],
-                            (
-                                (red if self.pinned else yellow)("unverified"),
-                                green("verified"),
-                            )[self.verified],
-                            ('', bold(blue("gateway")))[self.use_as_gateway],
-                        ],
-                    )
-                ),
-                'endpoint': self.endpoint,
-                'allowed ips': ", ".join(map(str, self.allowed_ips)),
-                'disabled ips': ", ".join(map(str, self.disabled_ips)),
-                'latest signature': (
-                    str(
-                        timedelta(
-                            seconds=int(time.time() - self.descriptor.vf)
-                        ),
-                    )
-                    + ' ago'
-                ),
-                'latest handshake': (
-                    str(
-                        timedelta(
-                            seconds=int(
-                                time.time() - stats['latest_handshake']
-                            )
-                        ),
-                    )
-                    + ' ago'
-                    if stats and stats.get('latest_handshake')
-                    else yellow('none')
-                ),
-                'transfer': (
-                    stats
-                    and sum(stats.values())
-                    and "{rx_bytes} received, {tx_bytes} sent".format(
-                        **format_byte_stats(stats)
-                    )
-                ),
-                'wg pubkey': self.descriptor.pk,
-            }.items()
-            if value not in (None, False, '')
+        return show_summary(self.summary(stats))
+
+
+class PeersIndex(object):
+    """
+    Secondary indexes of the peers in a Peers object.
+
+    Each index is a dict mapping a key to a tuple of peer ids:
+
+        names: enabled names of enabled peers
+        nicknames: enabled nicknames of enabled peers
+        hostnames: descriptor hostnames of enabled peers
+        pks: wireguard public keys of enabled peers
+        ips: enabled IP addresses of enabled peers
+        addrs: descriptor IP addresses of enabled peers
+        enabled, pinned, gateways: ids of the peers which are enabled, pinned,
+            or used as the gateway (each mapped to a tuple of just itself)
+
+    Peers objects are immutable, so rather than being modified, an index is
+    derived from the index of the Peers object it was derived from (see
+    Peers._updated), which only costs as much as the changed peers' entries.
+    """
+
+    indexes = (
+        'names',
+        'nicknames',
+        'hostnames',
+        'pks',
+        'ips',
+        'addrs',
+        'enabled',
+        'pinned',
+        'gateways',
+    )
+
+    def __init__(self, peers=()):
+        for name in self.indexes:
+            setattr(self, name, {})
+        for peer in peers:
+            self._add(peer)
+
+    @staticmethod
+    def _entries(peer):
+        "Returns the (index, key) pairs for a peer"
+        entries = []
+        if peer.pinned:
+            entries.append(('pinned', peer.id))
+        if peer.get('use_as_gateway'):
+            entries.append(('gateways', peer.id))
+        if peer.enabled:
+            entries += (
+                [('enabled', peer.id), ('pks', peer.wg_pk)]
+                + [('hostnames', peer.descriptor.hostname)]
+                + [('names', name) for name in peer.enabled_names]
+                + [('nicknames', n) for n, on in peer.nicknames.items() if on]
+                + [('ips', ip) for ip in peer.enabled_ips]
+                + [('addrs', ip) for ip in peer.descriptor.addrs]
+            )
+        return dict.fromkeys(entries)
+
+    def _add(self, peer):
+        for name, key in self._entries(peer):
+            index = getattr(self, name)
+            index[key] = index.get(key, ()) + (peer.id,)
+
+    def _remove(self, peer):
+        for name, key in self._entries(peer):
+            index = getattr(self, name)
+            ids = tuple(_id for _id in index[key] if _id != peer.id)
+            if ids:
+                index[key] = ids
+            else:
+                del index[key]
+
+    def __eq__(self, other):
+        "Indexes are equal if they contain the same ids for the same keys"
+        return all(
+            {k: set(v) for k, v in getattr(self, name).items()}
+            == {k: set(v) for k, v in getattr(other, name).items()}
+            for name in self.indexes
         )
 
+    def updated(self, old_peers, new_peers):
+        """
+        Returns a new index with the entries for old_peers replaced by those
+        for new_peers.
+        """
+        new = PeersIndex()
+        for name in self.indexes:
+            setattr(new, name, dict(getattr(self, name)))
+        for peer in old_peers:
+            new._remove(peer)
+        for peer in new_peers:
+            new._add(peer)
+        return new
+
 
 class Peers(yamlrepr, queryable, schemadict):
 
@@ -685,8 +760,46 @@ class Peers(yamlrepr, queryable, schemadict):
         },
     )
 
+    @property
+    def index(self):
+        "The PeersIndex for this object, which is built when first needed"
+        if getattr(self, '_index', None) is None:
+            self._index = PeersIndex(self.values())
+        return self._index
+
+    def _updated(self, changed, removed=()):
+        new = super(Peers, self)._updated(changed, removed)
+        if getattr(self, '_index', None) is not None:
+            new._index = self._index.updated(
+                [self[_id] for _id in (*changed, *removed) if _id in self],
+                [new[_id] for _id in changed],
+            )
+        return new
+
+    def _lookup(self, index, *keys):
+        "Returns list of peers with any of the keys in the named index"
+        index = getattr(self.index, index)
+        return [
+            self[_id]
+            for _id in dict.fromkeys(
+                _id for key in keys for _id in index.get(key, ())
+            )
+        ]
+
+    @property
+    def enabled_peers(self):
+        return self._lookup('enabled', *self.index.enabled)
+
+    @property
+    def pinned_peers(self):
+        return self._lookup('pinned', *self.index.pinned)
+
+    @property
+    def gateway_peers(self):
+        return self._lookup('gateways', *self.index.gateways)
+
     def with_hostname(self: Peers, name: str):
-        res = self.limit(enabled=True).by('nicknames').get(name, [])
+        res = self._lookup('nicknames', name)
         if len(res) > 1:
             raise Bug(
                 # this should not be possible, as both the state logic and
@@ -702,7 +815,7 @@ class Peers(yamlrepr, queryable, schemadict):
         # IPv6 analysis: not ipv6 ready
         # Please enhance this function to support ipv6
         ip = IPv4Address(ip)
-        res = self.limit(enabled=True).by('IPv4addrs').get(ip, [])
+        res = self._lookup('ips', ip)
         if len(res) > 1:
             raise ConsistencyError(
                 # this should also not be possible, because the state logic
@@ -717,58 +830,78 @@ class Peers(yamlrepr, queryable, schemadict):
     @property
     def conflicts(self):
         "returns comma-separated list of colliding peer ids"
-        enabled_gws = list(
-            self.limit(use_as_gateway=True, enabled=True).values()
-        )
+        enabled_gws = [
+            peer
+            for peer in self.gateway_peers
+            if peer.id in self.index.enabled
+        ]
         res = ",".join(
             [
                 peer.id
-                for peer in self.limit(enabled=True).values()
-                if self.conflicts_for_descriptor(peer.descriptor)
+                for peer in self.values()
+                if peer.enabled
+                and self.conflicts_for_descriptor(peer.descriptor)
             ]
             + [peer.id for peer in enabled_gws if len(enabled_gws) > 1]
         )
         return res
 
+    def conflicts_with(self, ids):
+        """
+        Returns comma-separated list of the peer ids which the conflicts
+        property would return, assuming that only the peers with the given ids
+        can be involved in any conflict (eg, because they are the only ones
+        which have changed since the last time there were no conflicts).
+        """
+        peers = self._lookup('enabled', *ids)
+        res = {}
+        for peer in peers:
+            if self.conflicts_for_descriptor(peer.descriptor):
+                res[peer.id] = True
+            # the peers whose descriptors conflict with this peer
+            for other in (
+                self._lookup('hostnames', *peer.enabled_names)
+                + self._lookup('pks', peer.wg_pk)
+                + self._lookup('addrs', *peer.enabled_ips)
+            ):
+                if other.id != peer.id:
+                    res[other.id] = True
+        if any(peer.get('use_as_gateway') for peer in peers):
+            enabled_gws = [
+                _id for _id in self.index.gateways if _id in self.index.enabled
+            ]
+            if len(enabled_gws) > 1:
+                res.update(dict.fromkeys(enabled_gws, True))
+        return ",".join(res)
+
     def conflicts_for_descriptor(self, desc):
         """
         Returns list of enabled peers a descriptor has a conflicting wg_pk,
         hostname, or IP address with (ignoring itself).
         """
-        return list(
-            {
-                conflict.id: conflict
-                for conflict in self.limit(enabled=True)
-                .by('enabled_names')
-                .get(desc.hostname, [])
-                + self.limit(enabled=True).by('wg_pk').get(desc.pk, [])
-                + sum(
-                    (
-                        self.limit(enabled=True).by('IPv4addrs').get(ip, [])
-                        for ip in desc.IPv4addrs
-                    ),
-                    [],
-                )
-                + sum(
-                    (
-                        self.limit(enabled=True).by('IPv6addrs').get(ip, [])
-                        for ip in desc.IPv6addrs
-                    ),
-                    [],
-                )
-                if conflict.id != desc.id
+        return [
+            conflict
+            for conflict in {
+                peer.id: peer
+                for peer in self._lookup('names', desc.hostname)
+                + self._lookup('pks', desc.pk)
+                + self._lookup('ips', *desc.addrs)
             }.values()
-        )
+            if conflict.id != desc.id
+        ]
 
     def query(self, query):
         """
         Returns peer by vk, hostname, or IP. None if no match.
         """
-        peer = (
-            self.by('id').get(query)
-            or self.limit(enabled=True).by('enabled_names').get(query)
-            or self.limit(enabled=True).by('enabled_ips_str').get(query)
-        )
+        if query in self:
+            return self[query]
+        peer = self._lookup('names', query)
+        if not peer:
+            try:
+                peer = self._lookup('ips', ip_address(query))
+            except ValueError:
+                pass
         if peer:
             assert len(peer) == 1, ("this should not be possible:", peer)
             return peer[0]
@@ -776,6 +909,73 @@ class Peers(yamlrepr, queryable, schemadict):
             return None
 
 
+def show_summary(peer):
+    """
+    Returns the human-readable description of a peer from its summary.
+    """
+    stats = peer['stats']
+    green_or_yellow = (
+        green
+        if peer['pinned'] and peer['verified'] and peer['enabled']
+        else yellow
+    )
+    return "\n  ".join(
+        bold(label) + ': ' + str(value) if label else str(value)
+        for label, value in {
+            green_or_yellow('peer'): green_or_yellow(peer['name']),
+            'id': peer['id'],
+            red('warning'): (
+                None if stats else red('wireguard peer is not configured')
+            ),
+            'other names': ", ".join(peer['other_names']),
+            'status': " ".join(
+                filter(
+                    None,
+                    [
+                        (red("disabled"), green("enabled"))[peer['enabled']],
+                        (yellow("unpinned"), green("pinned"))[peer['pinned']],
+                        (
+                            (red if peer['pinned'] else yellow)("unverified"),
+                            green("verified"),
+                        )[peer['verified']],
+                        ('', bold(blue("gateway")))[peer['use_as_gateway']],
+                    ],
+                )
+            ),
+            'endpoint': peer['endpoint'],
+            'allowed ips': ", ".join(peer['allowed_ips']),
+            'disabled ips': ", ".join(peer['disabled_ips']),
+            'latest signature': (
+                str(
+                    timedelta(
+                        seconds=int(time.time() - peer['latest_signature'])
+                    ),
+                )
+                + ' ago'
+            ),
+            'latest handshake': (
+                str(
+                    timedelta(
+                        seconds=int(time.time() - stats['latest_handshake'])
+                    ),
+                )
+                + ' ago'
+                if stats and stats.get('latest_handshake')
+                else yellow('none')
+            ),
+            'transfer': (
+                stats
+                and sum(stats.values())
+                and "{rx_bytes} received, {tx_bytes} sent".format(
+                    **format_byte_stats(stats)
+                )
+            ),
+            'wg pubkey': peer['wg_pubkey'],
+        }.items()
+        if value not in (None, False, '')
+    )
+
+
 def _ac_get_peer_ids(ctx, args, incomplete):
     organize = (
         ctx.meta.get('Organize', {}).get('magic_instance')
@@ -852,10 +1052,23 @@ class PeerCommands(object):
 
         With no arguments, all enabled peers are shown.
 
-        Peer arguments can be specified as ID, name, or IP, unless options are also
-        specified, in which case arguments must (currently) be IDs.
+        Peer arguments can be specified as ID, name, or IP. If an option is
+        also specified, only the matching peers it selects are shown.
         """
 
+        if not (descriptor or qrcode):
+            summaries = json.loads(
+                self.organize.list_peers(
+                    which or ('all' if peers else 'enabled'), list(peers), []
+                )
+            )
+            if peers and not summaries:
+                res = ["No peer matched %s" % (", ".join(map(repr, peers)),)]
+            else:
+                res = [show_summary(summary) for summary in summaries]
+            echo_maybepager("\n\n".join(res))
+            return
+
         available = self.organize.peer_ids(which if which else 'enabled')
 
         queries = (
@@ -876,10 +1089,8 @@ class PeerCommands(object):
                 else:
                     res.append("{vk} {hostname} {addrs}".format(**desc))
                 res.append(desc.qr_code)
-            elif descriptor:
-                res.append(self.organize.peer_descriptor(query))
             else:
-                res.append(self.organize.show_peer(query))
+                res.append(self.organize.peer_descriptor(query))
 
         echo_maybepager(("\n" if descriptor else "\n\n").join(res))
 
@@ -891,11 +1102,15 @@ class PeerCommands(object):
 
         Reads from standard input if a file is not specified.
 
-        Prints the result of processing each descriptor.
+        Prints the outcome for each descriptor, by its line number.
 
         Can consume the output of "vula peer show --descriptor" from another
         system, or the output of "vula discover --no-dbus --interface eth0".
+
+        The descriptors are sent to organize, which processes them in one
+        transaction, all at once.
         """
+        lines = []
         while True:
             line = file.readline()
             line = line.split(':')[
@@ -903,12 +1118,9 @@ class PeerCommands(object):
             ].strip()  # strip timestamp from discover logs, if present
             if not line:
                 break
-            line = line.strip()
-            res = self.organize.process_descriptor_string(line)
-            if res:
-                click.echo(yamlrepr_hl.from_yaml(res))
-            else:
-                click.echo("process_descriptor_string returned None 🤔")
+            lines.append(line)
+        if lines:
+            click.echo(self.organize.process_descriptor_strings(lines))
 
     @DualUse.object(short_help="Add and remove peer addresses")
     @click.pass_context
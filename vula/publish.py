@@ -3,7 +3,7 @@
  informed by Organize over dbus or as controlled by organize in monolith mode.
 
 >>> p = Publish()
->>> type(p.zeroconfs)
+>>> type(p.services)
 <class 'dict'>
 >>> type(p.log)
 <class 'logging.RootLogger'>
@@ -43,26 +43,39 @@ class Publish(object):
 
         self.log: Logger = getLogger()
         self.zeroconfs = {}
+        self.services = {}
 
     def listen(self, new_announcements):
-        # First we remove all old zeroconf listeners that are not in our new
-        # instructions
-        for ip, zc in list(self.zeroconfs.items()):
-            if ip not in new_announcements:
-                self.log.info("Removing old service announcement for %r", ip)
-                zc.close()
-                del self.zeroconfs[ip]
-        # Now we add a zeroconf listener for each new IP and ServiceInfo if it
-        # is not already existing, else we update the old zc object with the
-        # new desc
-        for ip_addr, desc in new_announcements.items():
-            self.log.debug(
-                "Starting mDNS service announcement for %r", ip_addr
+        """
+        Announces the descriptor for each IP (or comma-separated IPs) in
+        new_announcements, on those IPs only.
+
+        The IPs which are announced with the same descriptor (our addresses
+        on one network) share a zeroconf instance, so that each network's
+        descriptor (and the addresses in it) is only announced on that
+        network. An instance is kept while its IPs are still announced, and
+        its service is only updated when its descriptor has changed.
+        """
+        groups = {}
+        for ip_addrs, desc in new_announcements.items():
+            group = groups.setdefault(
+                tuple(sorted(desc.items())), dict(ips=[], desc=desc)
             )
-            name: str = node() + "." + _LABEL
+            group['ips'].extend(map(str, comma_separated_IPs(ip_addrs)))
+        announcements = {
+            tuple(dict.fromkeys(group['ips'])): group['desc']
+            for group in groups.values()
+        }
+        for ips, zeroconf in list(self.zeroconfs.items()):
+            if ips not in announcements:
+                self.log.info("Removing old service announcement for %r", ips)
+                zeroconf.close()
+                del self.zeroconfs[ips]
+                self.services.pop(ips, None)
+        for ips, desc in announcements.items():
             service_info: ServiceInfo = ServiceInfo(
                 _LABEL,
-                name=name,
+                name=node() + "." + _LABEL,
                 addresses=[
                     ip_address(ip).packed for ip in desc['addrs'].split(',')
                 ],
@@ -70,25 +83,36 @@ class Publish(object):
                 properties=desc,
                 server=desc['hostname'],
             )
-            zeroconf = self.zeroconfs.get(ip_addr)
-            if zeroconf:
+            zeroconf = self.zeroconfs.get(ips)
+            if zeroconf is None:
+                self.log.debug(
+                    "Starting mDNS service announcement for %r", ips
+                )
+                zeroconf = self.zeroconfs[ips] = Zeroconf(interfaces=list(ips))
+            elif ips in self.services:
+                if self.services[ips].properties == service_info.properties:
+                    continue
                 # Do update dance
                 self.log.debug("Updating vula service: %s", service_info)
                 zeroconf.update_service(service_info)
-                self.log.debug("Updating vula service.")
-
-            else:
-                zeroconf = self.zeroconfs[ip_addr] = Zeroconf(
-                    interfaces=list(map(str, comma_separated_IPs(ip_addr)))
+                self.services[ips] = service_info
+                continue
+            self.log.debug("Registering vula service: %s", service_info)
+            try:
+                zeroconf.register_service(service_info)
+                self.services[ips] = service_info
+                self.log.debug("Registered vula mDNS publishing service.")
+            except NonUniqueNameException:
+                self.log.debug(
+                    "Unable to register vula mDNS publishing service."
                 )
-                self.log.debug("Registering vula service: %s", service_info)
-                try:
-                    zeroconf.register_service(service_info)
-                    self.log.debug("Registered vula mDNS publishing service.")
-                except NonUniqueNameException:
-                    self.log.debug(
-                        "Unable to register vula mDNS publishing service."
-                    )
+
+    def shutdown(self):
+        for ips, zeroconf in self.zeroconfs.items():
+            self.log.info("Stopping mDNS announcements on %r", ips)
+            zeroconf.close()
+        self.zeroconfs = {}
+        self.services = {}
 
     @classmethod
     def daemon(cls):
@@ -1,15 +1,44 @@
 from ipaddress import ip_address, ip_network
-from pyroute2 import IPRoute
+from pyroute2 import IPRoute, WireGuard
 from socket import AddressFamily
 from .wg import Interface as WgInterface
 from .constants import _LINUX_MAIN_ROUTING_TABLE, IPv4_GW_ROUTES
+from .common import Metrics
 import threading
+import time
+from contextlib import contextmanager
 from pyroute2 import IPRSocket
 
 # FIXME: find where the larger canonical version of this table lives
 SCOPES = {0: 'global', 253: 'static'}
 
 
+class _NetlinkCounter(object):
+    """
+    Wraps a pyroute2 object, calling count for each call to its methods (each
+    of which makes at least one netlink request). The object is constructed
+    (by calling factory) when it is first used.
+    """
+
+    def __init__(self, factory, count):
+        self._factory = factory
+        self._wrapped = None
+        self._count = count
+
+    def __getattr__(self, name):
+        if self._wrapped is None:
+            self._wrapped = self._factory()
+        attr = getattr(self._wrapped, name)
+        if not callable(attr):
+            return attr
+
+        def call(*a, **kw):
+            self._count()
+            return attr(*a, **kw)
+
+        return call
+
+
 class Sys(object):
     """
     This  object provides all of the pyroute2-based system integration.
@@ -19,25 +48,89 @@ class Sys(object):
     interface. We should reduce the number of public methods here to a minimum,
     and later we can reimplement this object using other means on other
     platforms.
+
+    Netlink events are coalesced: a burst of them (as happens when changing
+    networks) results in one system state update, which happens once no event
+    has arrived for netlink_window seconds, or netlink_max_latency seconds
+    after the first event of the burst, whichever is sooner.
+
+    While the monitor is running, the addresses and gateways are kept in a
+    model which is updated from the netlink messages themselves, rather than
+    by dumping all addresses and routes for every update. The model is rebuilt
+    from a full dump if it is older than full_resync_interval seconds, if a
+    message could not be applied to it, or after a link changed (as the
+    kernel removes the routes of a link which goes down without sending a
+    message for each of them).
     """
 
+    netlink_window = 0.25
+    netlink_max_latency = 2.0
+    full_resync_interval = 300
+
     def __init__(self, organize):
         self.organize = organize
         self.log = organize.log if organize else None
         self.wg_name = self.organize.interface if organize else None
-        self.ipr = IPRoute()
-        self.wgi = WgInterface(self.wg_name, ipr=self.ipr)
+        self.metrics = Metrics()
+        self.ipr = _NetlinkCounter(IPRoute, self._count_netlink_call)
+        self.wg = _NetlinkCounter(WireGuard, self._count_netlink_call)
         self._monitor_thread = None
         self._stop_monitor = False
+        self._pending_cond = threading.Condition()
+        self._pending_since = None
+        self._pending_latest = None
+        self._flush_lock = threading.Lock()
+        self._flush_thread = None
+        self._model_lock = threading.Lock()
+        self._resync_lock = threading.Lock()
+        self._resync_deltas = None
+        self._addrs = None
+        self._gateway_routes = None
+        self._resynced = None
+        self._allowed = (None, {})
+        self._local = threading.local()
 
     def start_monitor(self):
+        """
+        Starts the monitor thread. The netlink socket is bound before this
+        returns, so a system state read after it is called is updated with
+        every change which happens after it was read.
+        """
         self._stop_monitor = False
         if self._monitor_thread is None:
+            ip = IPRSocket()
+            ip.bind()
             self._monitor_thread = threading.Thread(
-                target=self._monitor
-            )  # , args=(1,))
+                target=self._monitor, args=(ip,)
+            )
             self._monitor_thread.start()
 
+    @property
+    def wgi(self):
+        """
+        The wireguard interface. Each thread has its own, so that the peers
+        cached by one thread's query (or snapshot) are never replaced or
+        updated by another thread while it uses them.
+        """
+        wgi = getattr(self._local, 'wgi', None)
+        if wgi is None:
+            wgi = self._local.wgi = WgInterface(
+                self.wg_name, ipr=self.ipr, wg=self.wg
+            )
+        return wgi
+
+    def _count_netlink_call(self):
+        self.metrics.count('netlink_calls')
+        self._local.netlink_calls = self.netlink_calls + 1
+
+    @property
+    def netlink_calls(self):
+        """
+        The number of netlink requests made so far by the calling thread (the
+        netlink_calls metric counts those of all threads)
+        """
+        return getattr(self._local, 'netlink_calls', 0)
+
     def get_stats(self):
         """
         Get the statistics
@@ -56,10 +149,7 @@ class Sys(object):
         """
         self._stop_monitor = True
 
-    def _monitor(self):
-
-        ip = IPRSocket()
-        ip.bind()
+    def _monitor(self, ip):
         while True:
             msg = ip.get()
             if len(msg) != 1:
@@ -75,9 +165,12 @@ class Sys(object):
                 'RTM_NEWADDR',
                 'RTM_DELROUTE',
                 'RTM_NEWROUTE',
+                'RTM_DELLINK',
+                'RTM_NEWLINK',
             ]:
                 self.log.debug("acting on netlink message: %r", msg)
-                self.get_new_system_state()
+                self._apply_netlink_message(msg[0])
+                self._netlink_event()
             elif event == 'RTM_NEWNEIGH':
                 # this happens often, so we don't even debug log it
                 pass
@@ -90,46 +183,231 @@ class Sys(object):
             if self._stop_monitor:
                 self.log.info("Stopping netlink monitor thread")
                 break
+        self._flush_netlink_events()
         self._monitor_thread = None
         ip.close()
 
-    def _get_system_state(self):
+    def _netlink_event(self):
+        """
+        Schedules a system state update, postponing an already scheduled one
+        (but not beyond netlink_max_latency after the first pending event).
+        """
+        self.metrics.count('netlink_events')
+        with self._pending_cond:
+            now = time.monotonic()
+            if self._pending_since is None:
+                self._pending_since = now
+            self._pending_latest = now
+            if self._flush_thread is None:
+                self._flush_thread = threading.Thread(
+                    target=self._netlink_flusher,
+                    name="netlink-flusher",
+                    daemon=True,
+                )
+                self._flush_thread.start()
+            self._pending_cond.notify()
+
+    def _netlink_flusher(self):
+        """
+        Runs in a background thread, flushing the pending netlink events when
+        their deadline passes.
+        """
+        with self._pending_cond:
+            while True:
+                if self._pending_since is None:
+                    self._pending_cond.wait()
+                    continue
+                deadline = min(
+                    self._pending_latest + self.netlink_window,
+                    self._pending_since + self.netlink_max_latency,
+                )
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self._pending_cond.wait(delay)
+                    continue
+                self._pending_cond.release()
+                try:
+                    self._flush_netlink_events()
+                except Exception as ex:
+                    self.log.error("Updating the system state failed: %r", ex)
+                finally:
+                    self._pending_cond.acquire()
+
+    def _flush_netlink_events(self):
+        """
+        Updates the system state if there are pending netlink events.
+        """
+        with self._flush_lock:
+            with self._pending_cond:
+                if self._pending_since is None:
+                    return
+                self._pending_since = self._pending_latest = None
+            self.metrics.count('netlink_events_processed')
+            self.get_new_system_state()
+
+    @staticmethod
+    def _addr_entry(msg):
+        """
+        Returns the model's key and value for an RTM_*ADDR message.
 
-        "WIP"
+        >>> Sys._addr_entry({'index': 2, 'prefixlen': 24, 'attrs': [
+        ...     ('IFA_ADDRESS', '10.0.0.2'), ('IFA_LABEL', 'eth0')]})
+        ((2, '10.0.0.2', 24), ('eth0', '10.0.0.2', 24))
+        """
+        attrs = dict(msg['attrs'])
+        addr = attrs['IFA_ADDRESS']
+        key = (msg['index'], addr, msg['prefixlen'])
+        return key, (attrs.get('IFA_LABEL', ''), addr, msg['prefixlen'])
 
-        addrs = self.ipr.get_addr()
+    @staticmethod
+    def _route_entry(msg):
+        """
+        Returns the model's key and value for an RTM_*ROUTE message, or None
+        if the route has no gateway.
 
-        gateways = list(
-            set(
-                r.get_attrs('RTA_GATEWAY')[0]
-                for r in self.ipr.get_routes()
-                if r.get_attrs('RTA_GATEWAY')
-            )
+        >>> Sys._route_entry({'family': 2, 'table': 254, 'dst_len': 0,
+        ...     'attrs': [('RTA_GATEWAY', '10.0.0.1'), ('RTA_OIF', 2)]})
+        ((2, 254, None, 0, None, 2, '10.0.0.1'), '10.0.0.1')
+        """
+        attrs = dict(msg['attrs'])
+        gateway = attrs.get('RTA_GATEWAY')
+        if gateway is None:
+            return None
+        key = (
+            msg['family'],
+            attrs.get('RTA_TABLE', msg['table']),
+            attrs.get('RTA_DST'),
+            msg['dst_len'],
+            attrs.get('RTA_PRIORITY'),
+            attrs.get('RTA_OIF'),
+            gateway,
         )
+        return key, gateway
 
-        current_subnets = {}
-
-        for a in addrs:
-            addr = ip_address(dict(a['attrs'])['IFA_ADDRESS'])
-            iface = dict(a['attrs']).get('IFA_LABEL', '')
-            this_subnet = ip_network(
-                "%s/%s" % (addr, a['prefixlen']), strict=False
+    def _apply_netlink_message(self, msg):
+        """
+        Updates the address and gateway model from a netlink message.
+        """
+        event = msg.get('event')
+        try:
+            if event in ('RTM_NEWLINK', 'RTM_DELLINK'):
+                # a link which goes down (or away) loses its routes (and
+                # addresses) without a message for each of them
+                self.log.debug("Link changed; the model will be resynced")
+                delta = None
+            elif event in ('RTM_NEWADDR', 'RTM_DELADDR'):
+                delta = event, '_addrs', self._addr_entry(msg)
+            else:
+                delta = event, '_gateway_routes', self._route_entry(msg)
+        except (KeyError, TypeError, ValueError) as ex:
+            self.log.info(
+                "Unable to apply netlink message (%r); the model will be "
+                "resynced",
+                ex,
             )
-            if not any(
-                [
+            delta = None
+        with self._model_lock:
+            if self._resync_deltas is not None:
+                # a dump is in progress, which may not include this change
+                self._resync_deltas.append(delta)
+            if delta is None:
+                self._resynced = None
+            else:
+                self._apply_delta(delta, self._addrs, self._gateway_routes)
+
+    @staticmethod
+    def _apply_delta(delta, addrs, gateway_routes):
+        event, attr, entry = delta
+        model = addrs if attr == '_addrs' else gateway_routes
+        if model is None or entry is None:
+            return
+        key, value = entry
+        if event.startswith('RTM_NEW'):
+            model[key] = value
+        else:
+            model.pop(key, None)
+
+    def _resync_model(self):
+        """
+        Rebuilds the model from a full dump. The messages which the monitor
+        applies while the dump is in progress are replayed onto it (applying
+        them is idempotent, so it does not matter whether the dump already
+        includes them).
+        """
+        with self._resync_lock:
+            with self._model_lock:
+                self._resync_deltas = []
+            try:
+                addrs = dict(map(self._addr_entry, self.ipr.get_addr()))
+                gateway_routes = dict(
+                    filter(None, map(self._route_entry, self.ipr.get_routes()))
+                )
+            except BaseException:
+                with self._model_lock:
+                    self._resync_deltas = None
+                raise
+            with self._model_lock:
+                deltas, self._resync_deltas = self._resync_deltas, None
+                for delta in filter(None, deltas):
+                    self._apply_delta(delta, addrs, gateway_routes)
+                self._addrs = addrs
+                self._gateway_routes = gateway_routes
+                # if a message could not be applied, resync again next time
+                self._resynced = None if None in deltas else time.monotonic()
+            self.metrics.count('full_resyncs')
+            if deltas:
+                self.metrics.count('resync_replayed_deltas', len(deltas))
+
+    def _is_allowed(self, iface, addr):
+        """
+        Returns True if the address is allowed by the current prefs. Results
+        are cached until the prefs change.
+        """
+        prefs = self.organize.prefs
+        if self._allowed[0] is not prefs:
+            self._allowed = (prefs, {})
+        cache = self._allowed[1]
+        if (iface, addr) not in cache:
+            cache[iface, addr] = (
+                any(
                     iface.startswith(prefix)
-                    for prefix in self.organize.prefs.iface_prefix_allowed
-                ]
-            ):
-                continue
+                    for prefix in prefs.iface_prefix_allowed
+                )
+                and any(addr in subnet for subnet in prefs.subnets_allowed)
+                and not any(
+                    addr in subnet for subnet in prefs.subnets_forbidden
+                )
+            )
+        return cache[iface, addr]
+
+    def _get_system_state(self):
+        """
+        Returns the allowed subnets (with our addresses in each) and the
+        gateways, from the model (which is resynced first if necessary).
+        """
+        with self._model_lock:
+            stale = (
+                self._addrs is None
+                or self._gateway_routes is None
+                or self._monitor_thread is None
+                or self._resynced is None
+                or time.monotonic() - self._resynced
+                > self.full_resync_interval
+            )
+        if stale:
+            self._resync_model()
+        with self._model_lock:
+            addrs = list(self._addrs.values())
+            gateways = list(set(self._gateway_routes.values()))
+
+        current_subnets = {}
 
-            if any(
-                addr in subnet
-                for subnet in self.organize.prefs.subnets_allowed
-            ) and not any(
-                addr in subnet
-                for subnet in self.organize.prefs.subnets_forbidden
-            ):
+        for iface, addr, prefixlen in addrs:
+            addr = ip_address(addr)
+            if self._is_allowed(iface, addr):
+                this_subnet = ip_network(
+                    "%s/%s" % (addr, prefixlen), strict=False
+                )
                 current_subnets.setdefault(this_subnet, []).append(addr)
 
         return current_subnets, gateways
@@ -137,6 +415,96 @@ class Sys(object):
     def get_new_system_state(self):
         return self.organize.get_new_system_state()
 
+    @contextmanager
+    def snapshot(self):
+        """
+        Within this context, the wireguard peers and the routes are dumped only
+        once (on entry); Sys methods called in the same thread use the dumped
+        copies, and update them as they make changes, instead of querying the
+        kernel again for each peer and route. The copies are the thread's own,
+        so snapshots in other threads do not affect them.
+        """
+        self.wgi.query()
+        self._local.snapshot = dict(
+            routes=self._dump_routes(), dsts=None, links={}
+        )
+        try:
+            yield self
+        finally:
+            self._local.snapshot = None
+
+    def _snapshot(self):
+        return getattr(self._local, 'snapshot', None)
+
+    def _dump_routes(self):
+        """
+        Returns all routes, with their attrs as dicts, and (if they have an
+        RTA_DST) a dst key in cidr notation.
+        """
+        routes = []
+        for route in self.ipr.get_routes():
+            # flatten attrs list to dict (api allows duplicate keys - but we
+            # don't)
+            route = dict(route, attrs=dict(route['attrs']))
+            if 'RTA_DST' in route['attrs']:
+                route['dst'] = "%s/%s" % (
+                    route['attrs']['RTA_DST'],
+                    route['dst_len'],
+                )
+            routes.append(route)
+        return routes
+
+    def _routes(self):
+        snapshot = self._snapshot()
+        return self._dump_routes() if snapshot is None else snapshot['routes']
+
+    def _route_exists(self, dst, table):
+        snapshot = self._snapshot()
+        if snapshot is None:
+            return bool(self.ipr.route("show", dst=dst, table=table))
+        if snapshot['dsts'] is None:
+            snapshot['dsts'] = {
+                (r['attrs'].get('RTA_TABLE'), r['dst'])
+                for r in snapshot['routes']
+                if 'dst' in r
+            }
+        return (table, dst) in snapshot['dsts']
+
+    def _route_added(self, dst, table, oif):
+        snapshot = self._snapshot()
+        if snapshot is not None:
+            addr, dst_len = dst.split('/')
+            snapshot['routes'].append(
+                dict(
+                    dst=dst,
+                    dst_len=int(dst_len),
+                    scope=253,  # RT_SCOPE_LINK
+                    attrs=dict(RTA_TABLE=table, RTA_DST=addr, RTA_OIF=oif),
+                )
+            )
+            snapshot['dsts'] = None
+
+    def _route_removed(self, dst, table):
+        snapshot = self._snapshot()
+        if snapshot is not None:
+            snapshot['routes'] = [
+                r
+                for r in snapshot['routes']
+                if not (
+                    r.get('dst') == dst
+                    and r['attrs'].get('RTA_TABLE') == table
+                )
+            ]
+            snapshot['dsts'] = None
+
+    def _link_lookup(self, ifname):
+        snapshot = self._snapshot()
+        if snapshot is None:
+            return self.ipr.link_lookup(ifname=ifname)
+        if ifname not in snapshot['links']:
+            snapshot['links'][ifname] = self.ipr.link_lookup(ifname=ifname)
+        return snapshot['links'][ifname]
+
     def sync_interface(self, dryrun=False):
         return self.wgi.sync_interface(
             private_key=str(self.organize._keys.wg_Curve25519_sec_key),
@@ -147,7 +515,8 @@ class Sys(object):
 
     def sync_peer(self, vk: str, dryrun: bool = False):
         """
-        Syncs peer's wg config and routes. Returns a string.
+        Syncs peer's wg config and routes, or removes them if the peer is
+        disabled. Returns a string.
         """
         # IPv6 analysis: not ipv6 ready.
         # Please enhance this function to support ipv6
@@ -155,31 +524,103 @@ class Sys(object):
         res = []
         if peer.enabled:
             self.log.debug("syncing enabled peer %s", peer.name)
-            csidh_psk = self.organize.csidh_dh(peer.descriptor.c)
             res.append(
-                self.wgi.apply_peerconfig(peer.wg_config(csidh_psk), dryrun)
+                self.wgi.apply_peerconfig(
+                    self._wg_config(peer, dryrun),
+                    dryrun,
+                    refresh=self._snapshot() is None,
+                )
             )
+            res.extend(self._sync_peer_routes(peer, dryrun))
+            self.log.debug("organize.Peer.sync result: %r", res)
+        else:
+            self.log.debug("syncing disabled peer %s", peer.name)
+            if self._snapshot() is None:
+                self.wgi.query()
+            pk = str(peer.wg_pk)
+            if any(p['public_key'] == pk for p in self.wgi.peers):
+                res.append(self.remove_wg_peer(pk, dryrun))
             res.append(
-                self.sync_routes(
-                    peer.routes,
-                    table=self.organize.table,
-                    dryrun=dryrun,
-                )
+                self.remove_routes(list(map(str, peer.routes)), dryrun=dryrun)
             )
             if peer.use_as_gateway:
-                res.append(
-                    self.sync_routes(
-                        [*IPv4_GW_ROUTES],
-                        table=_LINUX_MAIN_ROUTING_TABLE,
-                        dryrun=dryrun,
+                res.append(self.remove_gateway_routes(dryrun))
+        res = filter(None, res)
+        return "\n".join(res)
+
+    def sync_peers(self, vks, dryrun: bool = False):
+        """
+        Syncs the wg configs and routes of many enabled peers, setting all of
+        the wg peers which need it in as few netlink messages as possible.
+        Returns a list with a string for each peer, as sync_peer would.
+        """
+        res, configs = {}, {}
+        for vk in vks:
+            try:
+                configs[vk] = self._wg_config(self.organize.peers[vk], dryrun)
+            except Exception as ex:
+                res[vk] = repr(ex)
+        try:
+            wg_res = self.wgi.apply_peerconfigs(
+                list(configs.values()),
+                dryrun,
+                refresh=self._snapshot() is None,
+            )
+        except Exception as ex:
+            # one bad peer should not prevent the others from being set
+            self.log.error("Setting wg peers failed (%r); retrying singly", ex)
+            wg_res = []
+            for vk in configs:
+                try:
+                    wg_res.append(
+                        self.wgi.apply_peerconfig(
+                            self._wg_config(self.organize.peers[vk], dryrun),
+                            dryrun,
+                        )
                     )
+                except Exception as ex:
+                    wg_res.append(repr(ex))
+        for vk, peer_wg_res in zip(configs, wg_res):
+            peer_res = [peer_wg_res]
+            try:
+                peer_res += self._sync_peer_routes(
+                    self.organize.peers[vk], dryrun
                 )
-            self.log.debug("organize.Peer.sync result: %r", res)
+            except Exception as ex:
+                peer_res.append(repr(ex))
+            res[vk] = "\n".join(filter(None, peer_res))
+        return [res[vk] for vk in vks]
+
+    def _wg_config(self, peer, dryrun):
+        if dryrun:
+            csidh_psk = self.organize.csidh_dh(peer.descriptor.c)
         else:
-            # FIXME: this should go away with triggers, but hasn't yet?
-            self.remove_unknown()
-        res = filter(None, res)
-        return "\n".join(res)
+            csidh_psk = self.organize.csidh_psk(peer.descriptor.c)
+            if csidh_psk is None:
+                self.log.info(
+                    "CSIDH PSK for %s is pending; configuring it without "
+                    "an endpoint until it is ready",
+                    peer.name,
+                )
+        return peer.wg_config(csidh_psk)
+
+    def _sync_peer_routes(self, peer, dryrun):
+        res = [
+            self.sync_routes(
+                peer.routes,
+                table=self.organize.table,
+                dryrun=dryrun,
+            )
+        ]
+        if peer.use_as_gateway:
+            res.append(
+                self.sync_routes(
+                    [*IPv4_GW_ROUTES],
+                    table=_LINUX_MAIN_ROUTING_TABLE,
+                    dryrun=dryrun,
+                )
+            )
+        return res
 
     def sync_iprules(self, dryrun=False):
         routing_table = self.organize.table
@@ -221,7 +662,9 @@ class Sys(object):
 
     def remove_wg_peer(self, pk, dryrun=False):
         return self.wgi.apply_peerconfig(
-            dict(public_key=pk, remove=True), dryrun
+            dict(public_key=pk, remove=True),
+            dryrun,
+            refresh=self._snapshot() is None,
         )
 
     def remove_routes(self, dests, table=None, dev=None, dryrun=False):
@@ -240,6 +683,7 @@ class Sys(object):
         for route in self.get_route_entries(dests, table, dev):
             if not dryrun:
                 self.ipr.route("del", **route)
+                self._route_removed(route['dst'], route['table'])
             res.append(
                 "ip route del {dst} dev {dev} table {table}".format(
                     dst=route['dst'],
@@ -249,6 +693,15 @@ class Sys(object):
             )
         return "\n".join(res)
 
+    def remove_gateway_routes(self, dryrun=False):
+        """
+        Remove the routes which direct all traffic to the gateway peer from the
+        main routing table.
+        """
+        return self.remove_routes(
+            IPv4_GW_ROUTES, table=_LINUX_MAIN_ROUTING_TABLE, dryrun=dryrun
+        )
+
     def get_route_entries(self, dests=None, table=None, dev=None):
         """
         Query for routes. Returns a dict suitable for applying (with **) to
@@ -259,17 +712,9 @@ class Sys(object):
         route possibly from a larger match, and returning it with the wrong
         table, as get_routes does).
         """
-        current_routes = self.ipr.get_routes()
+        current_routes = self._routes()
         if dev:
-            oif = self.ipr.link_lookup(ifname=dev)[0]
-        # flatten attrs list to dict (api allows duplicate keys - but we don't)
-        [r.update(attrs=dict(r['attrs'])) for r in current_routes]
-        # install dst key with cidr notation
-        [
-            r.update(dst=r['attrs']['RTA_DST'] + "/" + str(r['dst_len']))
-            for r in current_routes
-            if 'RTA_DST' in r['attrs']
-        ]
+            oif = self._link_lookup(dev)[0]
         res = [
             dict(
                 dst=r['dst'],
@@ -287,11 +732,9 @@ class Sys(object):
 
     def remove_unknown(self, dryrun=False):
         """
-        This is currently the code path where disabled and removed peers get
-        their routes and wg peer configs removed. In the future, deferred
-        actions from the event engine should remove the specific things that we
-        know need to be removed, and then this method will actually only be
-        used to remove rogue entries.
+        Removes wg peers and routes which do not belong to any enabled peer.
+        Disabled and removed peers' configs are removed by triggers, so this is
+        only used by the full repair (sync) to remove rogue entries.
         """
         # IPv6 analysis: not ipv6 ready
         # Please enhance this function to support ipv6
@@ -299,28 +742,38 @@ class Sys(object):
         res = []
         enabled_pks = [
             str(peer.descriptor.pk)
-            for peer in self.organize.peers.limit(enabled=True).values()
+            for peer in self.organize.peers.enabled_peers
         ]
-        for peer in self.wgi.peers:
-            if peer['public_key'] not in enabled_pks:
-                if not dryrun:
-                    res.append(self.remove_wg_peer(peer['public_key'], dryrun))
-                    self.log.info(
-                        "Removing unexpected peer pk: (%s)", peer['public_key']
-                    )
-                res.append(
-                    "wg set {interface} peer {pk} remove".format(
-                        interface=self.wg_name, pk=peer['public_key']
-                    )
+        unknown_pks = [
+            peer['public_key']
+            for peer in self.wgi.peers
+            if peer['public_key'] not in enabled_pks
+        ]
+        if unknown_pks and not dryrun:
+            for pk in unknown_pks:
+                self.log.info("Removing unexpected peer pk: (%s)", pk)
+            removed = self.wgi.apply_peerconfigs(
+                [dict(public_key=pk, remove=True) for pk in unknown_pks],
+                dryrun,
+                refresh=self._snapshot() is None,
+            )
+        else:
+            removed = [None] * len(unknown_pks)
+        for pk, removed_res in zip(unknown_pks, removed):
+            if removed_res is not None:
+                res.append(removed_res)
+            res.append(
+                "wg set {interface} peer {pk} remove".format(
+                    interface=self.wg_name, pk=pk
                 )
+            )
         expected_routes = [
             str(dst)
-            for peer in self.organize.peers.limit(enabled=True).values()
+            for peer in self.organize.peers.enabled_peers
             for dst in peer.allowed_ips
         ]
 
-        current_routes = self.ipr.get_routes()
-        [r.update(attrs=dict(r['attrs'])) for r in current_routes]
+        current_routes = self._routes()
         our_current_routes = [
             r
             for r in current_routes
@@ -335,6 +788,7 @@ class Sys(object):
                     self.ipr.route(
                         'del', table=routing_table, dst=str(dst), scope=scope
                     )
+                    self._route_removed(dst, routing_table)
                 if scope in SCOPES:
                     # this is strictly cosmetic
                     # the printed "ip route" command is runnable with the scope
@@ -345,7 +799,7 @@ class Sys(object):
                         dst=dst, table=routing_table, scope=scope
                     )
                 )
-        if not self.organize.peers.limit(use_as_gateway=True, enabled=True):
+        if not any(peer.enabled for peer in self.organize.peers.gateway_peers):
 
             default_routes = [
                 r
@@ -365,6 +819,7 @@ class Sys(object):
                         dst=str(dst),
                         scope=scope,
                     )
+                    self._route_removed(dst, _LINUX_MAIN_ROUTING_TABLE)
                 if scope in SCOPES:
                     # this is strictly cosmetic
                     # the printed "ip route" command is runnable with the scope
@@ -386,13 +841,12 @@ class Sys(object):
         res = []
         self.log.debug("looking for routes for: %r", dests)
 
-        oif_idx = self.ipr.link_lookup(ifname=self.wg_name)
+        oif_idx = self._link_lookup(self.wg_name)
 
         system_state = self.organize.state.system_state
 
         for dest in map(ip_network, dests):
-            routes = self.ipr.route("show", dst=str(dest), table=table)
-            if not routes:
+            if not self._route_exists(str(dest), table):
                 src = None
                 for net in system_state.current_subnets:
                     # note: current_subnets is consulted to find a source
@@ -425,8 +879,10 @@ class Sys(object):
                         scope='link',
                         prefsrc=str(src) if src else None,
                     )
+                    self._route_added(
+                        str(dest), table, oif_idx[0] if oif_idx else None
+                    )
             else:
-                for route in routes:
-                    self.log.debug("found existing route for %s", dest)
+                self.log.debug("found existing route for %s", dest)
 
         return "\n".join(res)
@@ -18,7 +18,12 @@ from pyroute2 import (
     WireGuard as PyRoute2WireGuard,
     IPRoute,
 )
-from pyroute2.netlink import nla as netlink_atom
+from pyroute2.netlink import nla as netlink_atom, NLM_F_REQUEST, NLM_F_ACK
+from pyroute2.netlink.generic.wireguard import (
+    wgmsg,
+    WG_CMD_SET_DEVICE,
+    WG_GENL_VERSION,
+)
 from base64 import b64encode, b64decode  # noqa: F401
 from ipaddress import ip_address, ip_network
 from schema import Schema, And, Or, Use, Optional
@@ -35,6 +40,11 @@ from .common import (
 )
 
 
+# Like wg(8), we limit the size of the messages used to set many peers at once
+# to what fits in the kernel's default netlink buffer.
+_WG_SET_MAX_MESSAGE_SIZE = 8192
+
+
 def _wg_interface_list():
     """
     This returns a list of the current wireguard interfaces' names.
@@ -257,10 +267,12 @@ class Interface(attrdict, yamlrepr_hl):
     etc.
     """
 
-    def __init__(self, name, ipr=None):
+    def __init__(self, name, ipr=None, wg=None):
         self.log: Logger = getLogger()
         self.name = name
-        self._wg = PyRoute2WireGuard()
+        if wg is None:
+            wg = PyRoute2WireGuard()
+        self._wg = wg
         if ipr is None:
             ipr = IPRoute()
         self._if_index = None
@@ -360,15 +372,65 @@ class Interface(attrdict, yamlrepr_hl):
         self.log.debug("WireGuard.set(%r, **%r) -> %r", self.name, kwargs, res)
         return res
 
-    def apply_peerconfig(self, new: attrdict, dryrun=False):
+    def apply_peerconfig(self, new: attrdict, dryrun=False, refresh=True):
         """
         This sets only the keys that have changed, and returns a list of the
         new keys that needed to be set. Due to a bug in PyRoute2 and/or Linux,
         it is necessary to always set the allowed_ips if anything is set, so
         this does that.
+
+        If refresh is False, the peers from the last query are compared to
+        instead of querying again (and are updated with any changes made), so
+        that many peers can be applied with one query.
         """
-        self.query()
+        if refresh:
+            self.query()
         cur = self._peers_by_pubkey.get(new["public_key"])
+        res, new = self._peerconfig_changes(new, cur)
+        if new is not None:
+            for line in res:
+                self.log.info("[#] %s", line)
+
+            if not dryrun:
+                self.set(peer=new)
+                self._update_cached_peer(cur, new)
+
+        res = "\n".join(filter(None, res))
+        return res
+
+    def apply_peerconfigs(self, configs, dryrun=False, refresh=True):
+        """
+        This is apply_peerconfig for many peers at once. The interface is
+        queried at most once, and the changed peers are set using as few
+        netlink messages as possible (see set_peers). It returns a list with
+        the output of apply_peerconfig for each config.
+        """
+        if refresh:
+            self.query()
+        peers = self._peers_by_pubkey
+        results, todo = [], []
+        for new in configs:
+            cur = peers.get(new["public_key"])
+            res, new = self._peerconfig_changes(new, cur)
+            if new is not None:
+                for line in res:
+                    self.log.info("[#] %s", line)
+                todo.append((cur, new))
+            results.append("\n".join(filter(None, res)))
+
+        if todo and not dryrun:
+            self.set_peers([new for cur, new in todo])
+            for cur, new in todo:
+                self._update_cached_peer(cur, new)
+        return results
+
+    def _peerconfig_changes(self, new, cur):
+        """
+        Compares the peer config new to the current config cur (which is None
+        if the peer does not exist). Returns a list of lines describing the
+        changes, and the peer config which needs to be set (or None if there
+        is nothing to set).
+        """
         res = []
         if cur:
 
@@ -407,9 +469,11 @@ class Interface(attrdict, yamlrepr_hl):
                 new['endpoint_addr'] = cur['endpoint_addr']
         else:
             if new.get('remove'):
-                return "# can't remove non-existent wireguard peer %s" % (
-                    new['public_key'],
+                res.append(
+                    "# can't remove non-existent wireguard peer %s"
+                    % (new['public_key'],)
                 )
+                return res, None
 
         if (
             cur
@@ -418,47 +482,117 @@ class Interface(attrdict, yamlrepr_hl):
         ):
             # pyroute2/wg bug workaround
             self.log.debug("apply_peerconfig: no wg update necessary")
+            return res, None
 
+        if cur:
+            res.append(
+                '# reconfigure wireguard peer %s' % (new['public_key'],)
+            )
         else:
-            if cur:
-                res.append(
-                    '# reconfigure wireguard peer %s' % (new['public_key'],)
-                )
-            else:
-                res.append(
-                    '# configure new wireguard peer %s' % (new['public_key'],)
-                )
-
             res.append(
-                "vula wg set {interface} peer {pk} "
-                "{remove}{endpoint}{args}{allowed_ips}".format(
-                    remove="remove " if new.get('remove') else "",
-                    endpoint="endpoint %s:%s "
+                '# configure new wireguard peer %s' % (new['public_key'],)
+            )
+
+        res.append(
+            "vula wg set {interface} peer {pk} "
+            "{remove}{endpoint}{args}{allowed_ips}".format(
+                remove="remove " if new.get('remove') else "",
+                endpoint=(
+                    "endpoint %s:%s "
                     % (new['endpoint_addr'], new['endpoint_port'])
                     if (new.get('endpoint_addr') and new.get('endpoint_port'))
-                    else '',
-                    args="".join(
-                        "%s %s " % (k, v)
-                        for k, v in new.items()
-                        if k in ('persistent_keepalive', 'preshared_key')
-                    ),
-                    allowed_ips='allowed-ips %s '
+                    else ''
+                ),
+                args="".join(
+                    "%s %s " % (k, v)
+                    for k, v in new.items()
+                    if k in ('persistent_keepalive', 'preshared_key')
+                ),
+                allowed_ips=(
+                    'allowed-ips %s '
                     % ",".join(ip for ip in new.get('allowed_ips', ()))
                     if 'allowed_ips' in new
-                    else "",
-                    interface=self.name,
-                    pk=new['public_key'],
-                )
+                    else ""
+                ),
+                interface=self.name,
+                pk=new['public_key'],
             )
+        )
 
-            for line in res:
-                self.log.info("[#] %s", line)
+        return res, new
 
-            if not dryrun:
-                self.set(peer=new)
+    def set_peers(self, peers):
+        """
+        Sets many peers with one WG_CMD_SET_DEVICE message, where pyroute2's
+        WireGuard.set would send one message per peer. If the peers do not fit
+        in one message of _WG_SET_MAX_MESSAGE_SIZE bytes, they are split into
+        as many messages as are necessary.
 
-        res = "\n".join(filter(None, res))
-        return res
+        This uses pyroute2 internals (its peer encoder, nlm_request and prid),
+        which the supported pyroute2 versions (see the Pipfile) have; if they
+        are missing, each peer is set with WireGuard.set instead.
+
+        Returns the number of messages sent.
+        """
+        # pyroute2 >= 0.9 keeps the peer encoder on the asyncore object
+        encoder = getattr(self._wg, 'asyncore', self._wg)
+        if not all(
+            hasattr(obj, attr)
+            for obj, attr in (
+                (encoder, '_wg_set_peer'),
+                (self._wg, 'nlm_request'),
+                (self._wg, 'prid'),
+            )
+        ):
+            self.log.debug(
+                "pyroute2 can not batch peers; setting them one at a time"
+            )
+            for peer in peers:
+                self.set(peer=peer)
+            return len(peers)
+        base_size = len(self._set_peers_msg([]).data)
+        batches, size = [], base_size
+        for peer in peers:
+            scratch = wgmsg()
+            encoder._wg_set_peer(scratch, peer)
+            ((_, (attr,)),) = scratch['attrs']
+            attr_size = len(self._set_peers_msg([attr]).data) - base_size
+            if not batches or size + attr_size > _WG_SET_MAX_MESSAGE_SIZE:
+                batches.append([])
+                size = base_size
+            batches[-1].append(attr)
+            size += attr_size
+        for batch in batches:
+            self.log.debug(
+                "Setting %s peers of %s in one message", len(batch), self.name
+            )
+            self._wg.nlm_request(
+                self._set_peers_msg(batch),
+                msg_type=self._wg.prid,
+                msg_flags=NLM_F_REQUEST | NLM_F_ACK,
+            )
+        return len(batches)
+
+    def _set_peers_msg(self, peer_attrs):
+        msg = wgmsg()
+        msg['cmd'] = WG_CMD_SET_DEVICE
+        msg['version'] = WG_GENL_VERSION
+        msg['attrs'].append(['WGDEVICE_A_IFNAME', self.name])
+        # the kernel only reads one WGDEVICE_A_PEERS attribute, so all of the
+        # peers must be in it
+        msg['attrs'].append(['WGDEVICE_A_PEERS', peer_attrs])
+        msg.encode()
+        return msg
+
+    def _update_cached_peer(self, cur, new):
+        """
+        Updates the peers from the last query as if it had been repeated after
+        the new peer config was set.
+        """
+        peers = [p for p in self.peers if p['public_key'] != new['public_key']]
+        if not new.get('remove'):
+            peers.append(PeerConfig(dict(cur or {}, **new)))
+        self['peers'] = peers
 
     @property
     def peers(self):